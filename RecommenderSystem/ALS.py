@@ -0,0 +1,276 @@
+# Code description:
+# Matrix factorization of the implicit ratings by alternating least squares (ALS), as an alternative to UserCF
+# Serving UserCF costs a neighbor search plus a scan of the neighbors' histories, which grows with the number of users.
+# Here every user u and program i get a vector of `factors` numbers, x_u and y_i, trained offline so that x_u . y_i
+# approximates the preference p_ui (1 if u has watched i, else 0) weighted by the confidence c_ui = 1 + alpha * r_ui,
+# r_ui being the implicit score. Serving a user is then one product x_u . Y over the candidates: the cost depends on the
+# number of factors and candidates, not on the number of users.
+# Training alternates between the two sides; with the other side fixed every vector is the solution of a small
+# factors x factors linear system
+#   x_u = (Y^T Y + Y^T (C_u - I) Y + regularization * I)^-1 Y^T C_u p_u
+# where only the programs u has watched contribute to the middle term. The systems of a block of users are built with
+# sparse products and solved as one batch; the blocks are spread over threads (numpy releases the GIL while it works).
+# The trained model is saved next to the compiled model (ALS_MODEL_FILE in its directory), where recommender.py,
+# batch_recommend.py and recommend_service.py find it for the method 'als' and for ALS in the hybrid.
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+from CB import selectTopN
+from item_filters import createSeenMask
+
+# File of the ALS model in the directory of a compiled model
+ALS_MODEL_FILE = 'als.npz'
+
+
+# ALS model
+# Parameter Description:
+# users_names / items_names: names in the row order of user_factors / item_factors (the row / column order of the rating matrix)
+# user_factors: users x factors, item_factors: items x factors
+class ALSModel:
+
+    def __init__(self, users_names, items_names, user_factors, item_factors):
+        self.users_names = list(users_names)
+        self.items_names = list(items_names)
+        self.users_index = {name: i for i, name in enumerate(self.users_names)}
+        self.items_index = {name: j for j, name in enumerate(self.items_names)}
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+
+    @property
+    def factors(self):
+        return self.user_factors.shape[1]
+
+    def __contains__(self, user_name):
+        return user_name in self.users_index
+
+
+# Solve the vectors of the rows start..end-1 of one side, the other side's vectors being fixed
+# Parameter Description:
+# confidences: CSR rows x columns of the confidences c - 1 = alpha * r of the watched pairs
+# fixed: columns x factors vectors of the other side, gram: fixed^T fixed + regularization * I
+def solveBlock(confidences, fixed, gram, start, end):
+
+    block = confidences[start:end]
+    factors = fixed.shape[1]
+    watched_factors = fixed[block.indices]
+
+    # Sum of (c - 1) y y^T over the watched columns of every row, as a sparse product over the outer products
+    outer = (watched_factors[:, :, np.newaxis] * watched_factors[:, np.newaxis, :]).reshape(len(block.indices), factors * factors)
+    weights = sparse.csr_matrix((block.data, np.arange(len(block.indices)), block.indptr), shape=(end - start, len(block.indices)))
+    A = gram[np.newaxis] + np.asarray(weights @ outer).reshape(end - start, factors, factors)
+
+    # Y^T C_u p_u = sum of c y over the watched columns (p is 0 elsewhere)
+    b = np.asarray(sparse.csr_matrix((block.data + 1.0, block.indices, block.indptr), shape=block.shape) @ fixed)
+
+    return np.linalg.solve(A, b[:, :, np.newaxis])[:, :, 0]
+
+
+# Cut the rows into consecutive blocks holding about block_ratings watched pairs each (a longer row is a block by itself)
+def ratingBlocks(indptr, block_ratings):
+
+    rows_num = len(indptr) - 1
+    blocks = []
+    start = 0
+    while start < rows_num:
+        end = int(np.searchsorted(indptr, indptr[start] + block_ratings, side='right')) - 1
+        end = min(max(end, start + 1), rows_num)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+# Recompute all vectors of one side
+def solveSide(confidences, fixed, regularization, block_ratings, executor):
+
+    factors = fixed.shape[1]
+    gram = fixed.T @ fixed + regularization * np.eye(factors)
+    solved = np.empty((confidences.shape[0], factors))
+
+    blocks = ratingBlocks(confidences.indptr, block_ratings)
+    results = executor.map(lambda block: solveBlock(confidences, fixed, gram, block[0], block[1]), blocks)
+    for ((start, end), block_solved) in zip(blocks, results):
+        solved[start:end] = block_solved
+
+    return solved
+
+
+# Train the factors on a users x items rating matrix
+# Parameter Description:
+# users_to_items: CSR rating matrix (e.g. RatingStore.users_to_items), only positive implicit scores count as watched
+# factors: length of the vectors
+# regularization: weight of the penalty on the vector lengths
+# alpha: confidence gained per unit of implicit score
+# iterations: number of (users, items) alternations
+# block_ratings: watched pairs whose systems are built and solved together (block_ratings x factors^2 floats per thread)
+# threads: size of the thread pool, None uses all cores
+# seed: seed of the random start
+# Returns (user_factors, item_factors)
+@instrumentation.timed('als.trainALS')
+def trainALS(users_to_items, factors=32, regularization=0.1, alpha=40.0, iterations=15, block_ratings=4096, threads=None, seed=0):
+
+    ratings = sparse.csr_matrix(users_to_items, dtype=np.float64, copy=True)
+    ratings.data[ratings.data < 0] = 0.0
+    ratings.eliminate_zeros()
+    ratings.sort_indices()
+
+    user_confidences = ratings * alpha
+    item_confidences = user_confidences.T.tocsr()
+    item_confidences.sort_indices()
+
+    random = np.random.default_rng(seed)
+    user_factors = random.normal(0.0, 0.01, (ratings.shape[0], factors))
+    item_factors = random.normal(0.0, 0.01, (ratings.shape[1], factors))
+
+    with ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+        for iteration in range(iterations):
+            with instrumentation.stage('als.iteration'):
+                user_factors = solveSide(user_confidences, item_factors, regularization, block_ratings, executor)
+                item_factors = solveSide(item_confidences, user_factors, regularization, block_ratings, executor)
+
+    return (user_factors, item_factors)
+
+
+def createALSModelFromStore(rating_store, factors=32, regularization=0.1, alpha=40.0, iterations=15, block_ratings=4096, threads=None, seed=0):
+    (user_factors, item_factors) = trainALS(rating_store.users_to_items, factors, regularization, alpha, iterations, block_ratings, threads, seed)
+    return ALSModel(rating_store.users_names, rating_store.items_names, user_factors, item_factors)
+
+
+# ALS recommendation for one user
+# Parameter Description:
+# users_dict: {user name: [[program name, implicit score], ...]}, see UserCF.createUsersDict
+# als_model: ALSModel
+# all_items_names_to_be_recommend: the alternative recommended program set
+# Returns recommend_items_sorted = [[program name, the user's level of interest in the program], ...], in descending order
+# Programs the user has watched and programs the model has no vector for (nobody had watched them) are not recommended
+@instrumentation.timed('als.alsCF')
+def alsCF(user_name, users_dict, als_model, all_items_names_to_be_recommend):
+
+    if user_name not in als_model:
+        return []
+
+    items_user_saw = set()
+    for item in users_dict[user_name]:
+        items_user_saw.add(item[0])
+
+    names = [name for name in all_items_names_to_be_recommend if name in als_model.items_index and name not in items_user_saw]
+    columns = np.array([als_model.items_index[name] for name in names], dtype=np.int64)
+    scores = als_model.item_factors[columns] @ als_model.user_factors[als_model.users_index[user_name]]
+
+    recommend_items_sorted = [[names[k], float(scores[k])] for k in range(len(names))]
+    recommend_items_sorted.sort(key=lambda item: item[1], reverse=True)
+
+    return recommend_items_sorted
+
+
+# ALS for a block of users at once
+# Parameter Description:
+# user_factors / candidates_factors: factors of the users and of the candidates (rows of item_factors at candidates_columns)
+# users_to_items: CSR rating matrix of the users, columns in the row order of item_factors
+# rows, candidates_columns, N, seen_items, item_filters: as in UserCF.userCFBatch
+# Returns (top_indices, top_scores), both len(rows) x N, candidate positions as in CB.selectTopN
+@instrumentation.timed('als.alsBatch')
+def alsBatch(user_factors, candidates_factors, users_to_items, rows, candidates_columns, N, seen_items=None, item_filters=None):
+
+    rows = np.asarray(rows, dtype=np.int64)
+    candidates_columns = np.asarray(candidates_columns, dtype=np.int64)
+    known = candidates_columns >= 0
+
+    scores = np.full((len(rows), len(candidates_columns)), -np.inf)
+    scores[:, known] = user_factors[rows] @ candidates_factors[known].T
+
+    # Programs the user has watched himself are not recommended
+    watched = users_to_items[rows][:, candidates_columns[known]].toarray() > 0
+    scores[:, known] = np.where(watched, -np.inf, scores[:, known])
+    if seen_items is not None:
+        scores[createSeenMask(seen_items, rows, len(candidates_columns))] = -np.inf
+    if item_filters is not None:
+        item_filters.apply(scores, rows)
+
+    if instrumentation.enabled:
+        instrumentation.count('als.candidates_scored', np.count_nonzero(np.isfinite(scores)))
+
+    return selectTopN(scores, N)
+
+
+# ALS as an engine of hybrid_fusion.HybridRecommender: engine(rows, k) -> (top_indices, top_scores)
+# Parameter Description:
+# als_model: ALSModel trained on the ratings of users_to_items
+# users_to_items: CSR rating (or watched 01) matrix of the users, only used to leave out the programs they have watched
+# candidates_columns, item_filters: as in HybridRecommender
+class ALSEngine:
+
+    def __init__(self, als_model, users_to_items, candidates_columns, item_filters=None):
+        self.user_factors = als_model.user_factors
+        self.candidates_columns = np.asarray(candidates_columns, dtype=np.int64)
+        # Factors of the candidates gathered once, zero rows for candidates without a vector (they are masked out)
+        self.candidates_factors = np.zeros((len(self.candidates_columns), als_model.factors))
+        known = self.candidates_columns >= 0
+        self.candidates_factors[known] = als_model.item_factors[self.candidates_columns[known]]
+        self.users_to_items = users_to_items
+        self.item_filters = item_filters
+
+    def __call__(self, rows, k):
+        return alsBatch(self.user_factors, self.candidates_factors, self.users_to_items, rows, self.candidates_columns, k,
+                        item_filters=self.item_filters)
+
+
+# Save the model as an uncompressed .npz file
+def saveALSModel(als_model, path):
+    np.savez(path, users_names=np.array(als_model.users_names, dtype=str), items_names=np.array(als_model.items_names, dtype=str),
+             user_factors=als_model.user_factors, item_factors=als_model.item_factors)
+
+
+# Load a model saved by saveALSModel
+def loadALSModel(path):
+    with np.load(path, allow_pickle=False) as data:
+        return ALSModel(data['users_names'].tolist(), data['items_names'].tolist(), data['user_factors'], data['item_factors'])
+
+
+# Path of the ALS model saved next to a compiled model
+def alsModelPath(model_dir):
+    return os.path.join(model_dir, ALS_MODEL_FILE)
+
+
+# Raise ValueError unless als_model was trained on the users and programs of rating_store, in the same order
+def checkALSModel(als_model, rating_store):
+    if als_model.users_names != list(rating_store.users_names) or als_model.items_names != list(rating_store.items_names):
+        raise ValueError("the ALS model was trained on other users or programs than the model's rating store, train it again")
+
+
+# Output the list of programs recommended to the user
+# max_num: The maximum number of recommended programs output
+def printRecommendItems(recommend_items_sorted, max_num):
+    count = 0
+    for item, degree in recommend_items_sorted:
+        print("Program name: %s, recommendation index: %f" % (item, degree))
+        count += 1
+        if count == max_num:
+            break
+
+
+# Main program
+# python ALS.py <compiled model directory> [factors] [iterations] [threads]
+# Trains the model, saves it next to the compiled model and prints a few recommendations of every user
+if __name__ == '__main__':
+
+    from model_artifacts import loadModel
+
+    model = loadModel(sys.argv[1])
+    factors = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    als_model = createALSModelFromStore(model.rating_store, factors, iterations=iterations, threads=threads)
+    saveALSModel(als_model, alsModelPath(sys.argv[1]))
+    users_dict = model.rating_store.usersDict()
+
+    for user in model.users_names:
+        print("对于用户 %s 的推荐节目如下：" % user)
+        printRecommendItems(alsCF(user, users_dict, als_model, model.candidates_names), 3)
+        print()
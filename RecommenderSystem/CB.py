@@ -2,8 +2,13 @@
 # Specific implementation of content-based recommendation algorithm
 
 import math
+import os
+import sys
 import numpy as np
-import pandas as pd
+from scipy import sparse
+
+import instrumentation
+from item_filters import createSeenMask
 
 #Create program portrait
 # Parameter Description:
@@ -24,7 +29,9 @@ def createItemsProfiles(data_array, labels_names, items_names):
 #Create user portrait
 # Parameter Description:
 # data_array: Rating matrix of all users for the programs they have watched data_array = [[2, 0, 0, 1.1, ...], [0, 0, 1.1, ...], ...]
+#             or the same matrix as a scipy sparse matrix, e.g. RatingStore.users_to_items
 # users_profiles = {user1:{'label1':1.1, 'label2': 0.5, 'label3': 0.0, ...}, user2:{...}...}
+@instrumentation.timed('cb.createUsersProfiles')
 def createUsersProfiles(data_array, users_names, items_names, labels_names, items_profiles):
 
     users_profiles = {}
@@ -41,6 +48,10 @@ def createUsersProfiles(data_array, users_names, items_names, labels_names, item
     # items_users_saw_scores = {user1:[[item1, 1.1], [item2, 4.1]], user2:...}
     items_users_saw_scores = {}
 
+    # data_array may also be a scipy sparse matrix (e.g. RatingStore.users_to_items), then only the stored entries are visited
+    if sparse.issparse(data_array):
+        data_array = sparse.csr_matrix(data_array)
+
     for i in range(len(users_names)):
 
         items_users_saw_scores[users_names[i]] = []
@@ -48,14 +59,21 @@ def createUsersProfiles(data_array, users_names, items_names, labels_names, item
         count = 0
         sum = 0.0
 
-        for j in range(len(items_names)):
+        if sparse.issparse(data_array):
+            start = data_array.indptr[i]
+            end = data_array.indptr[i + 1]
+            user_items = zip(data_array.indices[start:end], data_array.data[start:end])
+        else:
+            user_items = enumerate(data_array[i])
+
+        for (j, score) in user_items:
 
             # The user's implicit rating for the program is positive, which means that the user has actually watched the program
-            if data_array[i][j] > 0:
+            if score > 0:
                 items_users_saw[users_names[i]].append(items_names[j])
-                items_users_saw_scores[users_names[i]].append([items_names[j], data_array[i][j]])
+                items_users_saw_scores[users_names[i]].append([items_names[j], score])
                 count += 1
-                sum += data_array[i][j]
+                sum += score
 
         if count == 0:
             users_average_scores_list.append(0)
@@ -133,21 +151,246 @@ def calCosDistance(user, item, labels_names):
 # labels_names: all type names
 # items_user_saw: programs watched by user user
 
+@instrumentation.timed('cb.contentBased')
 def contentBased(user_profile, items_profiles, items_names, labels_names, items_user_saw):
 
     # The recommended program set for user user is recommendation_items = [[program name, similarity between the program portrait and the user portrait], ...]
     recommend_items = []
 
+    # Hashed membership instead of scanning the list for every candidate
+    items_user_saw = set(items_user_saw)
+
     for i in range(len(items_names)):
         # Select programs that user user has not watched from the set of alternative recommended programs.
         if items_names[i] not in items_user_saw:
             recommend_items.append([items_names[i], calCosDistance(user_profile, items_profiles[items_names[i]], labels_names)])
 
+    if instrumentation.enabled:
+        instrumentation.count('cb.candidates_scored', len(recommend_items))
+        instrumentation.count('cb.candidates_filtered', len(items_names) - len(recommend_items))
+
     # Sort the recommended program collections in descending order of similarity
-    recommend_items.sort(key=lambda item: item[1], reverse=True)
+    with instrumentation.stage('cb.sort'):
+        recommend_items.sort(key=lambda item: item[1], reverse=True)
+
+    return recommend_items
+
+# Matrix-backed version of the content-based engine
+# The functions above work on one (user, item) pair at a time through dicts keyed by names.
+# The functions below keep program portraits as one items x labels matrix, build all user portraits with one
+# mean-centered matrix product and score every user against every candidate with one normalized matrix product.
+# Labels are addressed by column position, so a label name that appears twice in labels_names (e.g. 'drama')
+# no longer shadows the other column as it does in the dict-based portraits.
+
+# Create program portraits as a matrix
+# Parameter Description:
+# data_array: 01 matrix of programs and their types, one row per program, one column per label
+# items_profiles_matrix = [[1, 0, 0, ...], [0, 1, 1, ...], ...] (float64, items x labels)
+def createItemsProfilesMatrix(data_array):
+    return np.array(data_array, dtype=np.float64)
+
+
+# Reorder the rows of a program portrait matrix so that row j describes items_names[j]
+# Parameter Description:
+# profiles_items_names: program names in the row order of items_profiles_matrix
+# items_names: program names in the wanted row order (e.g. the column order of the rating matrix)
+# Programs without a portrait get an all-zero row.
+def alignItemsProfilesMatrix(items_profiles_matrix, profiles_items_names, items_names):
+
+    rows = {}
+    for i in range(len(profiles_items_names)):
+        rows.setdefault(profiles_items_names[i], i)
+
+    aligned = np.zeros((len(items_names), items_profiles_matrix.shape[1]), dtype=np.float64)
+    for j in range(len(items_names)):
+        if items_names[j] in rows:
+            aligned[j] = items_profiles_matrix[rows[items_names[j]]]
+
+    return aligned
+
+
+# Create all user portraits at once
+# Parameter Description:
+# data_array: Rating matrix of all users for the programs they have watched (users x items), dense or scipy sparse
+# items_profiles_matrix: portraits of the same programs, rows in the column order of data_array (items x labels)
+# users_profiles_matrix = [[1.1, 0.5, 0.0, ...], ...] (float64, users x labels)
+# Same formula as createUsersProfiles: user1_score_to_label1 = Sigma(score_to_item i - user1_average_score)/items_count
+@instrumentation.timed('cb.createUsersProfilesMatrix')
+def createUsersProfilesMatrix(data_array, items_profiles_matrix):
+
+    has_label = (np.asarray(items_profiles_matrix) > 0).astype(np.float64)
+
+    if sparse.issparse(data_array):
+        ratings = sparse.csr_matrix(data_array, dtype=np.float64)
+        saw = ratings.copy()
+        saw.data = (ratings.data > 0).astype(np.float64)
+
+        # Average implicit rating of each user over the programs they have watched
+        counts = np.asarray(saw.sum(axis=1)).ravel()
+        sums = np.asarray(ratings.multiply(saw).sum(axis=1)).ravel()
+        users_average_scores = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+        # Centering only touches the stored entries, the matrix stays sparse
+        centered = saw.copy()
+        rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))
+        centered.data = (ratings.data - users_average_scores[rows]) * saw.data
+
+        score = np.asarray(centered @ has_label)
+        count = np.asarray(saw @ has_label)
+    else:
+        ratings = np.asarray(data_array, dtype=np.float64)
+        saw = (ratings > 0).astype(np.float64)
+
+        # Average implicit rating of each user over the programs they have watched
+        counts = saw.sum(axis=1)
+        sums = (ratings * saw).sum(axis=1)
+        users_average_scores = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+        centered = (ratings - users_average_scores[:, np.newaxis]) * saw
+
+        score = centered @ has_label
+        count = saw @ has_label
+
+    # If the calculated value is too small, set it to 0 directly
+    score[np.abs(score) < 1e-6] = 0.0
+
+    return np.divide(score, count, out=np.zeros_like(score), where=count > 0)
+
+
+# Collect, for every user, the positions (in candidate_names) of the candidate programs they have already watched
+# Parameter Description:
+# data_array: Rating matrix of all users for the programs they have watched (users x items), dense or scipy sparse
+# items_names: program names in the column order of data_array
+# candidate_names: program names of the alternative recommended program set
+# seen_items = [array([3, 17, ...]), array([...]), ...], one int array per user
+@instrumentation.timed('cb.createSeenItems')
+def createSeenItems(data_array, items_names, candidate_names):
+
+    candidates_index = {}
+    for i in range(len(candidate_names)):
+        candidates_index.setdefault(candidate_names[i], i)
+
+    # Column j of the rating matrix is candidate columns_to_candidates[j], or -1 if it is not a candidate
+    columns_to_candidates = np.array([candidates_index.get(name, -1) for name in items_names], dtype=np.int64)
+
+    seen_items = []
+    if sparse.issparse(data_array):
+        ratings = sparse.csr_matrix(data_array)
+        for i in range(ratings.shape[0]):
+            start = ratings.indptr[i]
+            end = ratings.indptr[i + 1]
+            candidates = columns_to_candidates[ratings.indices[start:end][ratings.data[start:end] > 0]]
+            seen_items.append(np.unique(candidates[candidates >= 0]))
+    else:
+        ratings = np.asarray(data_array, dtype=np.float64)
+        for i in range(ratings.shape[0]):
+            candidates = columns_to_candidates[ratings[i] > 0]
+            seen_items.append(np.unique(candidates[candidates >= 0]))
+
+    return seen_items
+
+
+# Select the N best columns of every row of a score matrix
+# Parameter Description:
+# scores: rows x columns float matrix, -inf marks columns that must not be selected
+# top_indices / top_scores: rows x N, sorted in descending order of score; unused slots hold -1 / -inf
+@instrumentation.timed('selectTopN')
+def selectTopN(scores, N):
+
+    (rows, columns) = scores.shape
+    top_indices = np.full((rows, N), -1, dtype=np.int64)
+    top_scores = np.full((rows, N), -np.inf, dtype=np.float64)
+
+    n = min(N, columns)
+    if n == 0:
+        return (top_indices, top_scores)
+
+    if n < columns:
+        # The n-th largest score of every row; ties at that threshold are resolved in favour of the
+        # earlier column, which gives the same result as the stable sort used by contentBased
+        threshold = -np.partition(-scores, n - 1, axis=1)[:, n - 1:n]
+        above = scores > threshold
+        tied = scores == threshold
+        needed = n - above.sum(axis=1, keepdims=True)
+        selected = above | (tied & (np.cumsum(tied, axis=1) <= needed))
+        part = np.nonzero(selected)[1].reshape(rows, n)
+    else:
+        part = np.tile(np.arange(columns), (rows, 1))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+
+    # Sort the selected columns by descending score, ties by column position
+    order = np.lexsort((part, -part_scores), axis=1)
+    part = np.take_along_axis(part, order, axis=1)
+    part_scores = np.take_along_axis(part_scores, order, axis=1)
+
+    valid = np.isfinite(part_scores)
+    top_indices[:, :n] = np.where(valid, part, -1)
+    top_scores[:, :n] = part_scores
+
+    return (top_indices, top_scores)
+
+
+# Content-based recommendation for many users at once
+# Parameter Description:
+# users_profiles_matrix: users x labels
+# items_profiles_matrix: portraits of the alternative recommended program set, candidates x labels
+# N: number of programs recommended to each user
+# seen_items: optional, for every user the candidate positions they have already watched (see createSeenItems)
+# block_size: number of users scored per matrix product, bounds the users x candidates score block held in memory
+# item_filters: optional item_filters.ItemFilters over the candidate positions (seen bitmaps, whitelist, business filters)
+# users_rows: rows of the users of users_profiles_matrix in item_filters' seen index, default 0 .. users-1
+# Returns (top_indices, top_scores), both users x N, see selectTopN
+@instrumentation.timed('cb.contentBasedBatch')
+def contentBasedBatch(users_profiles_matrix, items_profiles_matrix, N, seen_items=None, block_size=4096, item_filters=None, users_rows=None):
+
+    users_profiles_matrix = np.asarray(users_profiles_matrix, dtype=np.float64)
+    items_profiles_matrix = np.asarray(items_profiles_matrix, dtype=np.float64)
+    users_num = users_profiles_matrix.shape[0]
+
+    # sigma_u and sigma_i of calCosDistance for every user and every candidate
+    sigma_users = np.einsum('ij,ij->i', users_profiles_matrix, users_profiles_matrix)
+    sigma_items = np.einsum('ij,ij->i', items_profiles_matrix, items_profiles_matrix)
+
+    top_indices = np.full((users_num, N), -1, dtype=np.int64)
+    top_scores = np.full((users_num, N), -np.inf, dtype=np.float64)
+
+    for start in range(0, users_num, block_size):
+        end = min(start + block_size, users_num)
+
+        sigma_ui = users_profiles_matrix[start:end] @ items_profiles_matrix.T
+        denominator = np.sqrt(np.outer(sigma_users[start:end], sigma_items))
+        # If the denominator is 0, the similarity is 0
+        scores = np.divide(sigma_ui, denominator, out=np.zeros_like(sigma_ui), where=denominator > 0)
+
+        # Programs the user has already watched are never recommended
+        if seen_items is not None:
+            scores[createSeenMask(seen_items, range(start, end), scores.shape[1])] = -np.inf
+        if item_filters is not None:
+            item_filters.apply(scores, np.arange(start, end) if users_rows is None else users_rows[start:end])
+        # Work counters: candidates filtered as seen (or by a business filter) and candidates left to rank
+        if instrumentation.enabled:
+            filtered = np.count_nonzero(np.isneginf(scores))
+            instrumentation.count('cb.candidates_scored', scores.size - filtered)
+            instrumentation.count('cb.candidates_filtered', filtered)
+
+        (top_indices[start:end], top_scores[start:end]) = selectTopN(scores, N)
+
+    return (top_indices, top_scores)
+
+
+# Convert the result of contentBasedBatch for one user into the list format of contentBased
+# recommend_items = [[program name, similarity between the program portrait and the user portrait], ...]
+def topNToRecommendItems(top_indices_row, top_scores_row, items_names):
+
+    recommend_items = []
+    for j in range(len(top_indices_row)):
+        if top_indices_row[j] < 0:
+            break
+        recommend_items.append([items_names[top_indices_row[j]], float(top_scores_row[j])])
 
     return recommend_items
 
+
 # Output the list of programs recommended to the user
 # max_num: The maximum number of recommended programs output
 def printRecommendedItems(recommend_items_sorted, max_num):
@@ -162,13 +405,31 @@ def printRecommendedItems(recommend_items_sorted, max_num):
 # Main program
 if __name__ == '__main__':
 
+    # python CB.py <compiled model directory> opens the binary model written by model_artifacts.py instead of the Excel files
+    if len(sys.argv) > 1:
+        from model_artifacts import loadModel
+
+        model = loadModel(sys.argv[1])
+        (top_indices, top_scores) = contentBasedBatch(model.users_profiles, model.candidates_profiles, 3, model.seenItemsList())
+
+        for i in range(len(model.users_names)):
+            print("The recommended programs for user %s are as follows:" % model.users_names[i])
+            printRecommendedItems(topNToRecommendItems(top_indices[i], top_scores[i], model.candidates_names), 3)
+            print()
+        if instrumentation.enabled:
+            print(instrumentation.dumpPrometheus())
+        sys.exit(0)
+
+    # Otherwise the Excel files of the data directory are read (pandas is only imported for them)
+    import pandas as pd
+    from model_artifacts import RATINGS_FILE, WATCHED_ITEMS_LABELS_FILE, CANDIDATES_LABELS_FILE
+
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
     all_users_names = ['A', 'B', 'C']
-    #all_labels = ['教育', '戏曲', '悬疑', '科幻', '惊悚', '动作', '资讯', '武侠', '剧情', '警匪', '生活', '军事', '言情', '体育', '冒险', '纪实',
-    #              '少儿教育', '少儿', '综艺', '古装', '搞笑', '广告']
-    all_labels = ['education', 'drama', 'suspense', 'sci-fi', 'thriller', 'action', 'information', 'martialarts', 'drama', 'police', 'life', 'military', 'romance', 'sports', 'adventure', 'documentary', 'children education', 'kids', 'varietyshow', 'costume', 'plot', 'funny', 'advertisement', 'comedy', 'physical', 'lanka', 'india']
-    labels_num = len(all_labels)
 
-    df1 = pd.read_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Rating matrix of all users for the programs they have watched.xlsx")
+    with instrumentation.stage('load.excel'):
+        df1 = pd.read_excel(os.path.join(data_dir, RATINGS_FILE))
     (m1, n1) = df1.shape
     # Rating matrix of all users’ programs they have watched
     # data_array1 = [[0.1804 0.042 0.11  0.07  0.19  0.56  0.14  0.3  0.32 0, ...], [...]]
@@ -177,32 +438,40 @@ if __name__ == '__main__':
     items_users_saw_names1 = df1.columns[1:].tolist()
 
 
-    df2 = pd.read_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\01 matrix of all programs watched by users and their categories.xlsx")
+    with instrumentation.stage('load.excel'):
+        df2 = pd.read_excel(os.path.join(data_dir, WATCHED_ITEMS_LABELS_FILE))
     (m2, n2) = df2.shape
     data_array2 = np.array(df2.iloc[:m2 + 1, 1:])
     # Names of programs watched by all users arranged in the order of "01 matrix of programs watched by all users and their types"
     items_users_saw_names2 = np.array(df2.iloc[:m2 + 1, 0]).tolist()
 
-    # Create program portraits for the programs the user has watched
-    items_users_saw_profiles = createItemsProfiles(data_array2, all_labels, items_users_saw_names2)
+    # Create program portraits for the programs the user has watched, in the column order of the rating matrix
+    items_users_saw_profiles = alignItemsProfilesMatrix(createItemsProfilesMatrix(data_array2), items_users_saw_names2, items_users_saw_names1)
 
-    # Create user portraits users_profiles and the program collection items_users_saw that the user has watched
-    (users_profiles, items_users_saw) = createUsersProfiles(data_array1, all_users_names, items_users_saw_names1, all_labels, items_users_saw_profiles)
+    # Create user portraits for all users with one matrix product
+    users_profiles = createUsersProfilesMatrix(data_array1, items_users_saw_profiles)
 
-    df3 = pd.read_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Alternative recommended program collection and type 01 matrix.xlsx")
+    with instrumentation.stage('load.excel'):
+        df3 = pd.read_excel(os.path.join(data_dir, CANDIDATES_LABELS_FILE))
     (m3, n3) = df3.shape
     data_array3 = np.array(df3.iloc[:m3 + 1, 1:])
     # Names of programs watched by all users arranged in the order of "Alternative Recommended Program Sets and Type 01 Matrix"
     items_to_be_recommended_names = np.array(df3.iloc[:m3 + 1, 0]).tolist()
 
     # Create program portraits for alternative recommended program sets
-    items_to_be_recommended_profiles = createItemsProfiles(data_array3, all_labels, items_to_be_recommended_names)
+    items_to_be_recommended_profiles = createItemsProfilesMatrix(data_array3)
 
-    for user in all_users_names:
-         print("The recommended programs for user %s are as follows:" % user)
-         recommend_items = contentBased(users_profiles[user], items_to_be_recommended_profiles, items_to_be_recommended_names, all_labels, items_users_saw[user])
-         printRecommendedItems(recommend_items, 3)
-         print()
+    # Candidate programs each user has already watched
+    items_users_saw = createSeenItems(data_array1, items_users_saw_names1, items_to_be_recommended_names)
 
+    # Score all users against all candidates at once and keep the top 3 of each user
+    (top_indices, top_scores) = contentBasedBatch(users_profiles, items_to_be_recommended_profiles, 3, items_users_saw)
 
+    for i in range(len(all_users_names)):
+         print("The recommended programs for user %s are as follows:" % all_users_names[i])
+         recommend_items = topNToRecommendItems(top_indices[i], top_scores[i], items_to_be_recommended_names)
+         printRecommendedItems(recommend_items, 3)
+         print()
 
+    if instrumentation.enabled:
+        print(instrumentation.dumpPrometheus())
@@ -1,5 +1,12 @@
-from recommender_system.CB import *
-from recommender_system.UserCF import *
+import os
+import sys
+
+from CB import topNToRecommendItems
+from hybrid_fusion import createHybridRecommender
+from model_artifacts import buildModelFromExcel, loadModel
+
+# 数据文件所在目录（仓库中的data目录）
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
 
 
 # 输出推荐给该用户的节目列表
@@ -14,92 +21,31 @@ def printRecommendItems(recommend_items_sorted, max_num):
 
 if __name__ == '__main__':
 
-    all_users_names = ['A', 'B', 'C']
-    all_labels = ['教育', '戏曲', '悬疑', '科幻', '惊悚', '动作', '资讯', '武侠', '剧情', '警匪', '生活', '军事', '言情', '体育', '冒险', '纪实',
-                  '少儿教育', '少儿', '综艺', '古装', '搞笑', '广告']
-    labels_num = len(all_labels)
-
-    df1 = pd.read_excel("C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Rating matrix of all users for the programs they have watched.xlsx")
-    (m1, n1) = df1.shape
-    # 所有用户对其看过的节目的评分矩阵
-    # data_array1 = [[0.1804 0.042 0.11  0.07  0.19  0.56  0.14  0.3  0.32 0, ...], [...]]
-    data_array1 = np.array(df1.iloc[:m1 + 1, 1:])
-    # 按照"所有用户对其看过的节目的评分矩阵"的列序排列的所有用户观看过的节目名称
-    items_users_saw_names1 = df1.columns[1:].tolist()
-
-    # users_dict = {用户一:[['节目一', 3.2], ['节目四', 0.2], ['节目八', 6.5]], 用户二: ... }
-    users_dict = createUsersDict(df1)
-    # items_dict = {节目一: [用户一, 用户三], 节目二: [...], ... }
-    items_dict = createItemsDict(df1)
-
-    df2 = pd.read_excel("C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\01 matrix of all programs watched by users and their categories.xlsx")
-    (m2, n2) = df2.shape
-    data_array2 = np.array(df2.iloc[:m2 + 1, 1:])
-    # 按照"所有用户看过的节目及所属类型的01矩阵"的列序排列的所有用户观看过的节目名称
-    items_users_saw_names2 = np.array(df2.iloc[:m2 + 1, 0]).tolist()
-
-    # 为用户看过的节目建立节目画像
-    items_users_saw_profiles = createItemsProfiles(data_array2, all_labels, items_users_saw_names2)
-
-    # 建立用户画像users_profiles和用户看过的节目集items_users_saw
-    (users_profiles, items_users_saw) = createUsersProfiles(data_array1, all_users_names, items_users_saw_names1,
-                                                            all_labels, items_users_saw_profiles)
-
-    df3 = pd.read_excel("C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Alternative recommended program collection and type 01 matrix.xlsx")
-    (m3, n3) = df3.shape
-    data_array3 = np.array(df3.iloc[:m3 + 1, 1:])
-    # 按照"备选推荐节目集及所属类型01矩阵"的列序排列的所有用户观看过的节目名称
-    items_to_be_recommended_names = np.array(df3.iloc[:m3 + 1, 0]).tolist()
-
-    # 为备选推荐节目集建立节目画像
-    items_to_be_recommended_profiles = createItemsProfiles(data_array3, all_labels, items_to_be_recommended_names)
+    # python CB_Mixture_userCF.py <编译后的模型目录> 直接打开model_artifacts.py写出的模型，否则读取data目录下的Excel文件
+    # 两种算法共用同一个只加载一次的模型（评分矩阵、节目画像、用户画像、用户看过的备选节目）
+    model = loadModel(sys.argv[1]) if len(sys.argv) > 1 else buildModelFromExcel(DATA_DIR)
+    recommender = createHybridRecommender(model, K=2)
 
 
     # 两种推荐算法后融合，也就是将两种推荐算法对某个用户分别产生的两个推荐节目集按不同比例混合，得出最后的对该用户的推荐结果
 
-    # 对于每个用户推荐topN个节目,在两种推荐算法产生的推荐集中分别选取比例为w1和w2的推荐结果,CB占w1, userCF占w2
-    # w1 + w2 = 1 且 w1 * topN + w2 * topN = topN
+    # 对于每个用户推荐topN个节目,CB占权重w1, userCF占权重w2, w1 + w2 = 1
+    # 每种算法只需产生前topN项（有界的top-k，不再对全部备选节目排序），
+    # 两个推荐集的推荐指数先归一化到[0, 1]，再按权重相加，同时被两种算法推荐的节目只出现一次
+    # strategy='interleave' 则按 w1 : w2 的比例轮流从两个推荐集中取节目，相当于原来的前topW1项 + 前topW2项
 
     topN = 5
 
     w1 = 0.7
     w2 = 0.3
 
-    # 从CB的推荐集中选出前topW1项
-    topW1 = int(w1 * topN)
-
-    # 从userCF的推荐集中选出前topW2项
-    topW2 = topN-topW1
-
-    for user in all_users_names:
-
-        # 对于用户user的最终混合推荐节目集
-        recommend_items = []
-
-        # CB
-        # recommend_items1 =  [[节目名, 该节目与该用户user画像的相似度], ...]
-        recommend_items1 = contentBased(users_profiles[user], items_to_be_recommended_profiles, items_to_be_recommended_names, all_labels, items_users_saw[user])
-        len1 = len(recommend_items1)
-
-        if len1 <= topW1:
-            recommend_items = recommend_items + recommend_items1
-        else:
-            recommend_items = recommend_items + recommend_items1[:topW1]
-
-
-        # userCF
-        # recommend_item2 = [[节目名, 该用户user对该节目的感兴趣程度],...]
-        recommend_items2 = userCF(user, users_dict, items_dict, 2, items_to_be_recommended_names)
-        len2 = len(recommend_items2)
+    (top_indices, top_scores) = recommender.recommend(range(len(model.users_names)), topN, {'cb': w1, 'usercf': w2})
 
-        if len2 <= topW2:
-            recommend_items = recommend_items + recommend_items2
-        else:
-            recommend_items = recommend_items + recommend_items2[:topW2]
+    for i in range(len(model.users_names)):
 
-        # 将推荐结果按推荐指数降序排序
-        recommend_items.sort(key=lambda item: item[1], reverse=True)
+        # 对于用户的最终混合推荐节目集，已按推荐指数降序排序
+        recommend_items = topNToRecommendItems(top_indices[i], top_scores[i], model.candidates_names)
 
-        print("对于用户 %s 的推荐节目如下" % user)
-        printRecommendItems(recommend_items, 5)
-        print()
\ No newline at end of file
+        print("对于用户 %s 的推荐节目如下" % model.users_names[i])
+        printRecommendItems(recommend_items, topN)
+        print()
@@ -0,0 +1,313 @@
+# Code description:
+# Specific implementation of item-based collaborative filtering algorithm
+# The program catalog is smaller and changes less than the user base, so the similarities are computed between programs,
+# offline: for every program only its M most similar programs are kept (item similarity table). At serving time a user's
+# score for a candidate is the sum, over the programs he has watched, of his implicit score times the similarity of the
+# candidate to that program, which costs O(programs watched x M) instead of a search over all users as in UserCF.
+# sim(item1, item2) = sigma_xy / sqrt(sigma_x * sigma_y), the cosine similarity of the two programs' implicit score columns,
+# where sigma_xy only runs over users that have watched both.
+
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+from CB import selectTopN
+from item_filters import createSeenMask
+from rating_store import createRatingStore
+
+# Default bound of the dense similarity blocks of all workers together
+MEMORY_BUDGET = 256 * 2 ** 20
+# Bytes per pair of programs of a block: the two sparse products and their dense copies, the pruning mask and the
+# temporaries of selectTopN
+ITEM_PAIR_BYTES = 64
+# A worker is not started with fewer programs per block than this
+MIN_BLOCK_ITEMS = 64
+
+
+# Item similarity table
+# Parameter Description:
+# items_names: program names in row order (the column order of the rating matrix it was built from)
+# neighbors: items x M int array of the most similar programs, in descending order of similarity, -1 for unused slots
+# similarities: items x M float array, -inf for unused slots
+class ItemSimilarityTable:
+
+    def __init__(self, items_names, neighbors, similarities):
+        self.items_names = list(items_names)
+        self.items_index = {name: j for j, name in enumerate(self.items_names)}
+        self.neighbors = neighbors
+        self.similarities = similarities
+
+    @property
+    def M(self):
+        return self.neighbors.shape[1]
+
+    def __contains__(self, item_name):
+        return item_name in self.items_index
+
+    # The most similar programs of item_name: [[program name, similarity], ...]
+    def similarItems(self, item_name, M=None):
+        j = self.items_index[item_name]
+        similar_items = []
+        for k in range(self.M if M is None else min(M, self.M)):
+            if self.neighbors[j][k] < 0:
+                break
+            similar_items.append([self.items_names[self.neighbors[j][k]], float(self.similarities[j][k])])
+        return similar_items
+
+    # Sparse items x items matrix holding the table, row j = similarities of the neighbors of program j
+    def toMatrix(self):
+        valid = self.neighbors >= 0
+        rows = np.repeat(np.arange(len(self.items_names)), valid.sum(axis=1))
+        return sparse.csr_matrix((self.similarities[valid], (rows, self.neighbors[valid])), shape=(len(self.items_names), len(self.items_names)))
+
+
+# State of a worker process, filled by initItemWorker
+item_worker_state = {}
+
+
+def initItemWorker(normalized, watched, M, min_common_users):
+    item_worker_state['normalized'] = normalized
+    item_worker_state['watched'] = watched
+    item_worker_state['M'] = M
+    item_worker_state['min_common_users'] = min_common_users
+
+
+# Top-M similar programs of the programs start..end-1, against the whole catalog
+def computeItemNeighborsBlock(block):
+
+    (start, end) = block
+    normalized = item_worker_state['normalized']
+    watched = item_worker_state['watched']
+
+    similarities = (normalized[:, start:end].T @ normalized).toarray()
+    common_users = (watched[:, start:end].T @ watched).toarray()
+    similarities[common_users < max(item_worker_state['min_common_users'], 1)] = -np.inf
+    # A program is never its own neighbor
+    similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+    return (start, end) + selectTopN(similarities, item_worker_state['M'])
+
+
+# Create the item similarity table from a users x items rating matrix
+# Parameter Description:
+# users_to_items: CSR rating matrix (e.g. RatingStore.users_to_items), only positive implicit scores count as watched
+# M: number of similar programs kept per program
+# min_common_users: programs watched together by fewer users are not similar
+# block_size: programs whose similarities to the whole catalog are held in memory at once by one worker, derived from
+#             memory_budget unless given
+# processes: size of the process pool the blocks are spread over (default: number of cores), 1 computes them in this
+#            process; fewer processes are used when memory_budget does not allow MIN_BLOCK_ITEMS programs per block for each
+# memory_budget: bytes the dense blocks of all workers may take together
+# Returns (neighbors, similarities), see ItemSimilarityTable
+@instrumentation.timed('itemcf.computeItemNeighbors')
+def computeItemNeighbors(users_to_items, M, min_common_users=1, block_size=None, processes=None, memory_budget=MEMORY_BUDGET):
+
+    ratings = sparse.csc_matrix(users_to_items, dtype=np.float64, copy=True)
+    ratings.data[ratings.data < 0] = 0.0
+    ratings.eliminate_zeros()
+    items_num = ratings.shape[1]
+
+    # Columns scaled to unit length, the product of two columns is then their cosine similarity
+    norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=0)).ravel())
+    normalized = ratings @ sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0))
+    normalized = sparse.csc_matrix(normalized)
+    watched = ratings.copy()
+    watched.data[:] = 1.0
+
+    neighbors = np.full((items_num, M), -1, dtype=np.int64)
+    similarities = np.full((items_num, M), -np.inf, dtype=np.float64)
+    # Concurrent workers share the budget
+    budget_items = int(memory_budget // max(1, ITEM_PAIR_BYTES * items_num))
+    processes = max(1, min(processes or os.cpu_count() or 1, budget_items // MIN_BLOCK_ITEMS))
+    if block_size is None:
+        block_size = max(1, budget_items // processes)
+    blocks = [(start, min(start + block_size, items_num)) for start in range(0, items_num, block_size)]
+
+    if processes == 1 or len(blocks) <= 1:
+        initItemWorker(normalized, watched, M, min_common_users)
+        results = map(computeItemNeighborsBlock, blocks)
+        for (start, end, block_neighbors, block_similarities) in results:
+            (neighbors[start:end], similarities[start:end]) = (block_neighbors, block_similarities)
+        item_worker_state.clear()
+        return (neighbors, similarities)
+
+    # fork (where available) hands the matrices to the workers without pickling them
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    with context.Pool(min(processes, len(blocks)), initializer=initItemWorker, initargs=(normalized, watched, M, min_common_users)) as pool:
+        for (start, end, block_neighbors, block_similarities) in pool.imap_unordered(computeItemNeighborsBlock, blocks):
+            (neighbors[start:end], similarities[start:end]) = (block_neighbors, block_similarities)
+
+    return (neighbors, similarities)
+
+
+# Create the item similarity table from the dictionaries of UserCF.createUsersDict / createItemsDict
+# (or RatingStore.usersDict() / itemsDict())
+def createItemSimilarityTable(users_dict, items_dict, M, min_common_users=1, block_size=None, processes=None, memory_budget=MEMORY_BUDGET):
+
+    triples = ((user_name, item[0], item[1]) for user_name in users_dict for item in users_dict[user_name])
+    rating_store = createRatingStore(triples, list(users_dict), list(items_dict))
+
+    return createItemSimilarityTableFromStore(rating_store, M, min_common_users, block_size, processes, memory_budget)
+
+
+def createItemSimilarityTableFromStore(rating_store, M, min_common_users=1, block_size=None, processes=None, memory_budget=MEMORY_BUDGET):
+    (neighbors, similarities) = computeItemNeighbors(rating_store.users_to_items, M, min_common_users, block_size, processes,
+                                                     memory_budget)
+    return ItemSimilarityTable(rating_store.items_names, neighbors, similarities)
+
+
+# Item-based collaborative filtering algorithm for one user
+# Parameter Description:
+# users_dict: {user name: [[program name, implicit score], ...]}, see UserCF.createUsersDict
+# item_table: ItemSimilarityTable
+# all_items_names_to_be_recommend: the alternative recommended program set
+# M: optional, only the M most similar programs of every watched program are used
+# Returns recommend_items_sorted = [[program name, the user's level of interest in the program], ...], in descending order
+@instrumentation.timed('itemcf.itemCF')
+def itemCF(user_name, users_dict, item_table, all_items_names_to_be_recommend, M=None):
+
+    recommend_items = {}
+
+    items_user_saw = set()
+    for item in users_dict[user_name]:
+        items_user_saw.add(item[0])
+    all_items_names_to_be_recommend = set(all_items_names_to_be_recommend)
+
+    for item in users_dict[user_name]:
+        # Programs added to the catalog after the table was built have no similar programs yet
+        if item[0] not in item_table:
+            continue
+        for (similar_item, similarity) in item_table.similarItems(item[0], M):
+            # Only programs the user has not watched and that are in the alternative recommended program set
+            if similar_item not in items_user_saw and similar_item in all_items_names_to_be_recommend:
+                recommend_items[similar_item] = recommend_items.get(similar_item, 0.0) + item[1] * similarity
+
+    recommend_items_sorted = [[key, recommend_items[key]] for key in recommend_items]
+    recommend_items_sorted.sort(key=lambda item: item[1], reverse=True)
+
+    return recommend_items_sorted
+
+
+# Columns of the candidates cut out of the item similarity matrix, computed once per candidate set
+# Parameter Description:
+# item_matrix: ItemSimilarityTable.toMatrix()
+# candidates_columns: as in UserCF.userCFBatch (-1 for candidates that are not in the table)
+# Returns (similarities, pattern, selector), CSR: similarities / pattern (0/1) are items x candidates, selector maps a
+# program column to the candidates it is (items x candidates, one 1 per known candidate)
+def createCandidatesSlices(item_matrix, candidates_columns):
+
+    candidates_columns = np.asarray(candidates_columns, dtype=np.int64)
+    known = np.nonzero(candidates_columns >= 0)[0]
+    selector = sparse.csr_matrix((np.ones(len(known)), (candidates_columns[known], known)),
+                                 shape=(item_matrix.shape[1], len(candidates_columns)))
+
+    item_matrix = sparse.csr_matrix(item_matrix)
+    similarities = (item_matrix @ selector).tocsr()
+    pattern = item_matrix.copy()
+    pattern.data[:] = 1.0
+    pattern = (pattern @ selector).tocsr()
+
+    return (similarities, pattern, selector)
+
+
+# Item-based collaborative filtering for a block of users at once
+# Parameter Description:
+# item_matrix: ItemSimilarityTable.toMatrix() of a table built from the same rating matrix
+# users_to_items: CSR rating matrix, rows = users, columns in the row order of the table
+# rows, candidates_columns, N, seen_items, item_filters: as in UserCF.userCFBatch
+# candidates_slices: createCandidatesSlices(item_matrix, candidates_columns), computed here when not given; with it the
+#                    work per user is O(watched programs x M), independent of the size of the catalog
+# Returns (top_indices, top_scores), both len(rows) x N, candidate positions as in CB.selectTopN
+@instrumentation.timed('itemcf.itemCFBatch')
+def itemCFBatch(item_matrix, users_to_items, rows, candidates_columns, N, seen_items=None, item_filters=None, candidates_slices=None):
+
+    rows = np.asarray(rows, dtype=np.int64)
+    if candidates_slices is None:
+        candidates_slices = createCandidatesSlices(item_matrix, candidates_columns)
+    (similarities, pattern, selector) = candidates_slices
+
+    history = users_to_items[rows]
+    reached = history.copy()
+    reached.data[:] = 1.0
+
+    # Sum of score x similarity over the watched programs, and whether any watched program lists the candidate at all
+    scores = (history @ similarities).toarray()
+    sources = (reached @ pattern).toarray()
+
+    # Only programs similar to at least one watched program and not watched by the user himself are recommended
+    scores[sources == 0] = -np.inf
+    watched = (history @ selector).tocoo()
+    scores[watched.row[watched.data > 0], watched.col[watched.data > 0]] = -np.inf
+    if seen_items is not None:
+        scores[createSeenMask(seen_items, rows, scores.shape[1])] = -np.inf
+    if item_filters is not None:
+        item_filters.apply(scores, rows)
+
+    if instrumentation.enabled:
+        instrumentation.count('itemcf.candidates_scored', np.count_nonzero(np.isfinite(scores)))
+
+    return selectTopN(scores, N)
+
+
+# ItemCF as an engine of hybrid_fusion.HybridRecommender: engine(rows, k) -> (top_indices, top_scores)
+# Parameter Description:
+# item_table: ItemSimilarityTable built from rating_store
+# candidates_columns, item_filters: as in HybridRecommender
+class ItemCFEngine:
+
+    def __init__(self, item_table, rating_store, candidates_columns, item_filters=None):
+        self.item_matrix = item_table.toMatrix()
+        self.users_to_items = rating_store.users_to_items
+        self.candidates_columns = candidates_columns
+        self.item_filters = item_filters
+        self.candidates_slices = createCandidatesSlices(self.item_matrix, candidates_columns)
+
+    def __call__(self, rows, k):
+        return itemCFBatch(self.item_matrix, self.users_to_items, rows, self.candidates_columns, k, item_filters=self.item_filters,
+                           candidates_slices=self.candidates_slices)
+
+
+# Save the table as an uncompressed .npz file
+def saveItemSimilarityTable(table, path):
+    np.savez(path, items_names=np.array(table.items_names, dtype=str), neighbors=table.neighbors, similarities=table.similarities)
+
+
+# Load a table saved by saveItemSimilarityTable
+def loadItemSimilarityTable(path):
+    with np.load(path, allow_pickle=False) as data:
+        return ItemSimilarityTable(data['items_names'].tolist(), data['neighbors'], data['similarities'])
+
+
+# Output the list of programs recommended to the user
+# max_num: The maximum number of recommended programs output
+def printRecommendItems(recommend_items_sorted, max_num):
+    count = 0
+    for item, degree in recommend_items_sorted:
+        print("Program name: %s, recommendation index: %f" % (item, degree))
+        count += 1
+        if count == max_num:
+            break
+
+
+# Main program
+# python ItemCF.py <compiled model directory> [M] [processes] [memory budget in MB]
+if __name__ == '__main__':
+
+    from model_artifacts import loadModel
+
+    model = loadModel(sys.argv[1])
+    M = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    memory_budget = float(sys.argv[4]) * 2 ** 20 if len(sys.argv) > 4 else MEMORY_BUDGET
+
+    item_table = createItemSimilarityTableFromStore(model.rating_store, M, processes=processes, memory_budget=memory_budget)
+    users_dict = model.rating_store.usersDict()
+
+    for user in model.users_names:
+        print("对于用户 %s 的推荐节目如下：" % user)
+        printRecommendItems(itemCF(user, users_dict, item_table, model.candidates_names), 3)
+        print()
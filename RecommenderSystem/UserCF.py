@@ -1,9 +1,18 @@
 # Code description:
 # Specific implementation of user-based collaborative filtering algorithm
 
+import heapq
 import math
+import os
+import sys
 import numpy as np
-import pandas as pd
+from scipy import sparse
+
+import instrumentation
+from CB import selectTopN
+from item_filters import createSeenMask
+from rating_store import createRatingStoreFromDataFrame
+from similarity import calPearsonSimilarityBlock
 
 # Use the modified cosine similarity calculation formula with the Pearson correlation coefficient to calculate the similarity between two users
 # Remember sim(user1, user2) = sigma_xy /sqrt(sigma_x * sigma_y)
@@ -29,12 +38,17 @@ def calCosDistByPearson(user1, user2):
     # user2’s average rating of all the shows he has watched
     average_y = y / len(user2)
 
+    # Index user2's programs by name once instead of scanning user2's list for every program of user1
+    # (for a whole block of users at once, see similarity.calPearsonSimilarityBlock)
+    user2_scores = {}
+    for item2 in user2:
+        user2_scores.setdefault(item2[0], []).append(item2[1])
+
     for item1 in user1:
-        for item2 in user2:
-            if item1[0] == item2[0]: # Only programs that user1 and user2 have watched together will be considered.
-                sigma_xy += (item1[1] - average_x) * (item2[1] - average_y)
-                sigma_x += (item1[1] - average_x) * (item1[1] - average_x)
-                sigma_y += (item2[1] - average_y) * (item2[1] - average_y)
+        for score2 in user2_scores.get(item1[0], ()): # Only programs that user1 and user2 have watched together will be considered.
+            sigma_xy += (item1[1] - average_x) * (score2 - average_y)
+            sigma_x += (item1[1] - average_x) * (item1[1] - average_x)
+            sigma_y += (score2 - average_y) * (score2 - average_y)
 
     if sigma_x == 0.0 or sigma_y == 0.0: # If the denominator is 0, the similarity is 0
         return 0
@@ -84,46 +98,73 @@ def createItemsDict(df):
 
 # Find all users (i.e. neighbors) related to user user_name and sort them according to similarity
 # neighbors_distance = [[user name, similarity size], [...], ...] = [['user four', 0.78],[...], ...]
-def findSimilarUsers(users_dict, items_dict, user_name):
-
-    neighbors = [] # neighbors represents all users who have watched the same program as this user
-
-    for items in users_dict[user_name]:
-        for neighbor in items_dict[items[0]]:
-            if neighbor != user_name and neighbor not in neighbors:
-                neighbors.append(neighbor)
+# Optional parameters:
+# K: only the K most similar neighbors are kept (bounded heap instead of sorting all neighbors), None keeps all
+# min_overlap: neighbors that have watched fewer programs together with the user are dropped before their similarity is computed
+# min_similarity: neighbors whose similarity is below this value are dropped
+@instrumentation.timed('usercf.findSimilarUsers')
+def findSimilarUsers(users_dict, items_dict, user_name, K=None, min_overlap=1, min_similarity=None):
+
+    # neighbors represents all users who have watched the same program as this user
+    # neighbors = {neighbor: number of programs watched together}, the dict gives hashed membership tests and keeps the order of discovery
+    neighbors = {}
+
+    with instrumentation.stage('usercf.neighbor_discovery'):
+        for items in users_dict[user_name]:
+            for neighbor in items_dict[items[0]]:
+                if neighbor != user_name:
+                    neighbors[neighbor] = neighbors.get(neighbor, 0) + 1
 
     # Calculate the similarity between the user and all its neighbors and sort them in descending order
+    user_items = users_dict[user_name]
     neighbors_distance = []
-    for neighbor in neighbors:
-        distance = calCosDistByPearson(users_dict[user_name], users_dict[neighbor])
-        neighbors_distance.append([neighbor, distance])
+    with instrumentation.stage('usercf.similarity'):
+        for neighbor in neighbors:
+            if neighbors[neighbor] < min_overlap:
+                continue
+            distance = calCosDistByPearson(user_items, users_dict[neighbor])
+            if min_similarity is not None and distance < min_similarity:
+                continue
+            neighbors_distance.append([neighbor, distance])
+
+    # Work counters: user pairs whose similarity was computed and the co-rated programs those computations visited
+    if instrumentation.enabled:
+        compared = [neighbors[neighbor] for neighbor in neighbors if neighbors[neighbor] >= min_overlap]
+        instrumentation.count('usercf.user_pairs_compared', len(compared))
+        instrumentation.count('usercf.co_rated_items_visited', sum(compared))
 
-    neighbors_distance.sort(key=lambda item: item[1], reverse=True)
+    if K is None:
+        neighbors_distance.sort(key=lambda item: item[1], reverse=True)
+        return neighbors_distance
 
-    return neighbors_distance
+    # Same result as sorting and keeping the first K, but only K neighbors are kept in the heap
+    return heapq.nlargest(K, neighbors_distance, key=lambda item: item[1])
 
 
 # User-based collaborative filtering algorithm
 # K is the number of neighbors, which is an important parameter and is used when tuning parameters.
-def userCF(user_name, users_dict, items_dict, K, all_items_names_to_be_recommend):
+# min_overlap / min_similarity: optional neighbor pruning, see findSimilarUsers
+# neighbor_table: optional precomputed neighbor_table.NeighborTable, used instead of findSimilarUsers when it holds the user and
+#                 was built with at least K neighbors and the same min_overlap / min_similarity (see NeighborTable.compatible)
+@instrumentation.timed('usercf.userCF')
+def userCF(user_name, users_dict, items_dict, K, all_items_names_to_be_recommend, min_overlap=1, min_similarity=None, neighbor_table=None):
 
     # recommend_items = {Program name: the similarity between a neighbor of the user user_name who has watched the program and the user, ...}
     recommend_items = {}
     # Convert the above recommended_items into a list and sort them as recommended_items_sorted = [[Program One, the user's level of interest in Program One],[...], ...]
     recommend_items_sorted = []
 
-    # Programs watched by user user_name
-    items_user_saw = []
+    # Programs watched by user user_name, as sets so that the membership tests below are hashed instead of list scans
+    items_user_saw = set()
     for item in users_dict[user_name]:
-        items_user_saw.append(item[0])
+        items_user_saw.add(item[0])
+    all_items_names_to_be_recommend = set(all_items_names_to_be_recommend)
 
     # Find the K users (neighbors) with the greatest similarity to the user
-    similar_users = findSimilarUsers(users_dict, items_dict, user_name)
-    if len(similar_users) < K:
-        k_similar_user = similar_users
+    if neighbor_table is not None and user_name in neighbor_table and neighbor_table.compatible(K, min_overlap, min_similarity):
+        k_similar_user = neighbor_table.similarUsers(user_name, K)
     else:
-        k_similar_user = similar_users[:K]
+        k_similar_user = findSimilarUsers(users_dict, items_dict, user_name, K, min_overlap, min_similarity)
 
     # Get the recommended program collection for the user
     for user in k_similar_user:
@@ -144,11 +185,115 @@ def userCF(user_name, users_dict, items_dict, K, all_items_names_to_be_recommend
     for key in recommend_items:
         recommend_items_sorted.append([key, recommend_items[key]])
 
+    # Work counters: candidates scored, and neighbor programs dropped because the user has already watched them
+    if instrumentation.enabled:
+        instrumentation.count('usercf.candidates_scored', len(recommend_items))
+        instrumentation.count('usercf.candidates_filtered', sum(1 for user in k_similar_user for item in users_dict[user[0]] if item[0] in items_user_saw))
+
     # Sort recommended program collections in descending order by user interest
-    recommend_items_sorted.sort(key=lambda item: item[1], reverse=True)
+    with instrumentation.stage('usercf.sort'):
+        recommend_items_sorted.sort(key=lambda item: item[1], reverse=True)
 
     return recommend_items_sorted
 
+# User-based collaborative filtering for a block of users at once
+# Parameter Description:
+# pearson_matrices: similarity.createPearsonMatrices(users_to_items) of the rating store
+# rows: row positions of the users to recommend for
+# K: number of neighbors
+# candidates_columns: for every candidate program, its column in the rating store, -1 if nobody has watched it
+# N: number of programs recommended to each user
+# seen_items: optional, for every user (all rows of the store) the candidate positions they have already watched
+# item_filters: optional item_filters.ItemFilters over the candidate positions, applied as one mask per block
+# block_size: number of users whose similarities to all users are held in memory at once
+# Like userCF, a user's neighbors are the K most similar users that have watched at least one program in common with him,
+# and a candidate's score is the sum of the similarities of the neighbors that have watched it.
+# Returns (top_indices, top_scores), both len(rows) x N, candidate positions as in CB.selectTopN
+@instrumentation.timed('usercf.userCFBatch')
+def userCFBatch(pearson_matrices, rows, K, candidates_columns, N, seen_items=None, item_filters=None, block_size=1024):
+
+    rows = np.asarray(rows, dtype=np.int64)
+    watched = pearson_matrices[2]
+
+    top_indices = np.full((len(rows), N), -1, dtype=np.int64)
+    top_scores = np.full((len(rows), N), -np.inf, dtype=np.float64)
+
+    for start in range(0, len(rows), block_size):
+        end = min(start + block_size, len(rows))
+        block_rows = rows[start:end]
+
+        # Similarities of the block to all users, neighbors must have watched something in common
+        (similarities, overlaps) = calPearsonSimilarityBlock(pearson_matrices, block_rows)
+        similarities[overlaps == 0] = -np.inf
+        similarities[np.arange(len(block_rows)), block_rows] = -np.inf
+        (neighbors, neighbors_similarities) = selectTopN(similarities, K)
+
+        # Work counters: every user of the block is compared with every user of the store
+        if instrumentation.enabled:
+            instrumentation.count('usercf.user_pairs_compared', len(block_rows) * watched.shape[0])
+
+        (top_indices[start:end], top_scores[start:end]) = userCFBatchFromNeighbors(watched, block_rows, neighbors, neighbors_similarities,
+                                                                                   candidates_columns, N, seen_items, item_filters)
+
+    return (top_indices, top_scores)
+
+
+# Second half of userCFBatch, for neighbors that are already known (e.g. the first K columns of a neighbor_table.NeighborTable)
+# Parameter Description:
+# watched: pearson_matrices[2], the users x items 01 matrix of the watched programs
+# neighbors / neighbors_similarities: len(rows) x K neighbor rows and similarities, -1 / -inf for unused slots
+# rows, candidates_columns, N, seen_items, item_filters: as in userCFBatch
+# block_size: number of users whose dense rows x candidates scores are held in memory at once
+@instrumentation.timed('usercf.userCFBatchFromNeighbors')
+def userCFBatchFromNeighbors(watched, rows, neighbors, neighbors_similarities, candidates_columns, N, seen_items=None, item_filters=None,
+                             block_size=4096):
+
+    rows = np.asarray(rows, dtype=np.int64)
+    neighbors = np.asarray(neighbors)
+    neighbors_similarities = np.asarray(neighbors_similarities)
+    candidates_columns = np.asarray(candidates_columns, dtype=np.int64)
+    known = candidates_columns >= 0
+    # Columns of the candidates, cut out of the 01 matrix once for all blocks
+    candidates_watched = watched[:, candidates_columns[known]]
+
+    top_indices = np.full((len(rows), N), -1, dtype=np.int64)
+    top_scores = np.full((len(rows), N), -np.inf, dtype=np.float64)
+
+    for start in range(0, len(rows), block_size):
+        end = min(start + block_size, len(rows))
+        block_rows = rows[start:end]
+
+        # Sparse block x users matrices holding the K neighbors of every user of the block
+        valid = neighbors[start:end] >= 0
+        block_users = np.repeat(np.arange(len(block_rows)), valid.sum(axis=1))
+        block_neighbors = neighbors[start:end][valid]
+        weights = sparse.csr_matrix((neighbors_similarities[start:end][valid], (block_users, block_neighbors)),
+                                    shape=(len(block_rows), watched.shape[0]))
+        presence = sparse.csr_matrix((np.ones(len(block_neighbors)), (block_users, block_neighbors)), shape=(len(block_rows), watched.shape[0]))
+
+        # Sum of similarities and number of neighbors that have watched each program, restricted to the candidates
+        scores = np.full((len(block_rows), len(candidates_columns)), -np.inf)
+        scores[:, known] = (weights @ candidates_watched).toarray()
+        watchers = np.zeros((len(block_rows), len(candidates_columns)))
+        watchers[:, known] = (presence @ candidates_watched).toarray()
+
+        # Only programs watched by at least one neighbor and not by the user himself are recommended
+        scores[watchers == 0] = -np.inf
+        if seen_items is not None:
+            scores[createSeenMask(seen_items, block_rows, len(candidates_columns))] = -np.inf
+        if item_filters is not None:
+            item_filters.apply(scores, block_rows)
+
+        if instrumentation.enabled:
+            filtered = np.count_nonzero(np.isneginf(scores[watchers > 0]))
+            instrumentation.count('usercf.candidates_scored', np.count_nonzero(np.isfinite(scores)))
+            instrumentation.count('usercf.candidates_filtered', filtered)
+
+        (top_indices[start:end], top_scores[start:end]) = selectTopN(scores, N)
+
+    return (top_indices, top_scores)
+
+
 # Output the list of programs recommended to the user
 # max_num: The maximum number of recommended programs output
 def printRecommendItems(recommend_items_sorted, max_num):
@@ -162,19 +307,46 @@ def printRecommendItems(recommend_items_sorted, max_num):
 # Main program
 if __name__ == '__main__':
 
+    # python UserCF.py <compiled model directory> opens the binary model written by model_artifacts.py instead of the Excel files
+    if len(sys.argv) > 1:
+        from model_artifacts import loadModel
+
+        model = loadModel(sys.argv[1])
+        users_dict = model.rating_store.usersDict()
+        items_dict = model.rating_store.itemsDict()
+
+        for user in model.users_names:
+            print("对于用户 %s 的推荐节目如下：" % user)
+            printRecommendItems(userCF(user, users_dict, items_dict, 2, set(model.candidates_names)), 3)
+            print()
+        if instrumentation.enabled:
+            print(instrumentation.dumpPrometheus())
+        sys.exit(0)
+
+    # Otherwise the Excel files of the data directory are read (pandas is only imported for them)
+    import pandas as pd
+    from model_artifacts import RATINGS_FILE, CANDIDATES_LABELS_FILE
+
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
     all_users_names = ['A', 'B', 'C']
 
-    df1 = pd.read_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Alternative recommended program collection and type 01 matrix.xlsx")
+    with instrumentation.stage('load.excel'):
+        df1 = pd.read_excel(os.path.join(data_dir, CANDIDATES_LABELS_FILE))
     (m1, n1) = df1.shape
     # Names of programs watched by all users arranged in the order of "Alternative Recommended Program Sets and Type 01 Matrix"
     items_to_be_recommended_names = np.array(df1.iloc[:m1 + 1, 0]).tolist()
 
-    df2 = pd.read_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Rating matrix of all users for the programs they have watched.xlsx")
+    with instrumentation.stage('load.excel'):
+        df2 = pd.read_excel(os.path.join(data_dir, RATINGS_FILE))
+
+    # Sparse rating store: CSR for "from users to programs", CSC for the inverted table "from programs to users"
+    rating_store = createRatingStoreFromDataFrame(df2)
 
     # users_dict = {User one: [['Program one', 3.2], ['Program four', 0.2], ['Program eight', 6.5]], User two: ... }
-    users_dict = createUsersDict(df2)
+    users_dict = rating_store.usersDict()
     # items_dict = {Program 1: [User 1, User 3], Program 2: [...], ... }
-    items_dict = createItemsDict(df2)
+    items_dict = rating_store.itemsDict()
 
     for user in all_users_names:
         print("对于用户 %s 的推荐节目如下：" % user)
@@ -182,11 +354,5 @@ if __name__ == '__main__':
         printRecommendItems(recommend_items, 3)
         print()
 
-
-
-
-
-
-
-
-
+    if instrumentation.enabled:
+        print(instrumentation.dumpPrometheus())
@@ -0,0 +1,199 @@
+# Code description:
+# Batch recommendation run over all users
+# Generates the top-N CB, UserCF, ALS and hybrid recommendations of every user of a compiled model (see model_artifacts.py).
+# Users are split into shards that a process pool works on; the workers attach to the portrait, similarity and seen-item
+# matrices through shared memory instead of receiving pickled copies, and every finished shard is appended
+# to the output file (one JSON object per user and line) as soon as it arrives.
+# Usage: python batch_recommend.py <compiled model directory> <output .jsonl file> [number of processes]
+
+import json
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from CB import topNToRecommendItems
+from ALS import ALSEngine, ALSModel, checkALSModel
+from hybrid_fusion import HybridRecommender, hybridWeights
+from item_filters import ItemFilters, SeenItems
+from label_index import LabelIndex
+from neighbor_table import NeighborTable, checkNeighborTable
+from similarity import createPearsonMatrices
+
+METHODS = ('cb', 'usercf', 'als', 'hybrid')
+
+
+# Copy arrays into shared memory blocks
+# Returns (shared_blocks, descriptor): the blocks must stay open in the parent until the workers are done,
+# descriptor = {array name: (shared memory name, shape, dtype)} is all a worker needs to attach
+def shareArrays(arrays):
+
+    shared_blocks = []
+    descriptor = {}
+    for name in arrays:
+        array = np.ascontiguousarray(arrays[name])
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        shared_blocks.append(block)
+        descriptor[name] = (block.name, array.shape, array.dtype.str)
+
+    return (shared_blocks, descriptor)
+
+
+# Attach to arrays shared by shareArrays, returns (shared_blocks, arrays) without copying any data
+def attachArrays(descriptor):
+
+    shared_blocks = []
+    arrays = {}
+    for name in descriptor:
+        (block_name, shape, dtype) = descriptor[name]
+        block = shared_memory.SharedMemory(name=block_name)
+        shared_blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    return (shared_blocks, arrays)
+
+
+# Arrays shared with the workers: portraits, seen candidates and the Pearson matrices of the ratings, and the first K
+# columns of the neighbor table and the ALS factors when they are given
+def createSharedArrays(model, K=2, neighbor_table=None, als_model=None):
+
+    store = model.rating_store
+    (centered, centered_square, watched) = createPearsonMatrices(store.users_to_items)
+    candidates_columns = np.array([store.items_index.get(name, -1) for name in model.candidates_names], dtype=np.int64)
+
+    arrays = {
+        'users_profiles': np.asarray(model.users_profiles, dtype=np.float64),
+        'candidates_profiles': np.asarray(model.candidates_profiles, dtype=np.float64),
+        'seen_indptr': np.asarray(model.seen_candidates.indptr),
+        'seen_indices': np.asarray(model.seen_candidates.indices),
+        'centered_data': centered.data,
+        'centered_square_data': centered_square.data,
+        'watched_data': watched.data,
+        'ratings_indices': watched.indices,
+        'ratings_indptr': watched.indptr,
+        'candidates_columns': candidates_columns,
+    }
+    if neighbor_table is not None:
+        arrays['neighbors'] = np.asarray(neighbor_table.neighbors[:, :K])
+        arrays['neighbors_similarities'] = np.asarray(neighbor_table.similarities[:, :K])
+    if als_model is not None:
+        arrays['als_user_factors'] = np.asarray(als_model.user_factors)
+        arrays['als_item_factors'] = np.asarray(als_model.item_factors)
+
+    return arrays
+
+
+# State of a worker process, filled by initWorker
+worker_state = {}
+
+
+def initWorker(descriptor, options):
+
+    (shared_blocks, arrays) = attachArrays(descriptor)
+
+    shape = (len(arrays['ratings_indptr']) - 1, int(options['items_num']))
+    pearson_matrices = tuple(sparse.csr_matrix((arrays[name], arrays['ratings_indices'], arrays['ratings_indptr']), shape=shape, copy=False)
+                             for name in ('centered_data', 'centered_square_data', 'watched_data'))
+
+    worker_state['shared_blocks'] = shared_blocks
+    worker_state['arrays'] = arrays
+    item_filters = ItemFilters(arrays['candidates_profiles'].shape[0], SeenItems(arrays['seen_indptr'], arrays['seen_indices']))
+    # Rows only, the names were checked against the model in the parent
+    neighbor_table = NeighborTable([], arrays['neighbors'], arrays['neighbors_similarities']) if 'neighbors' in arrays else None
+    label_index = LabelIndex(arrays['candidates_profiles']) if options['label_index'] else None
+    worker_state['recommender'] = HybridRecommender(arrays['users_profiles'], arrays['candidates_profiles'], pearson_matrices,
+                                                    arrays['candidates_columns'], item_filters, options['K'], neighbor_table,
+                                                    label_index=label_index)
+    if 'als_user_factors' in arrays:
+        als_model = ALSModel([], [], arrays['als_user_factors'], arrays['als_item_factors'])
+        worker_state['recommender'].addEngine('als', ALSEngine(als_model, pearson_matrices[2], arrays['candidates_columns'], item_filters))
+    worker_state['options'] = options
+
+
+# Recommend for the users start..end-1, runs in a worker process
+# Returns (start, end, {method: (top_indices, top_scores)})
+def recommendShard(shard):
+
+    (start, end) = shard
+    options = worker_state['options']
+    methods = options['methods']
+    N = options['N']
+    results = {}
+
+    recommender = worker_state['recommender']
+    rows = np.arange(start, end)
+    for method in methods:
+        if method != 'hybrid':
+            results[method] = recommender.recommendBy(method, rows, N)
+    if 'hybrid' in methods:
+        # The engine lists computed above are reused by the fusion
+        results['hybrid'] = recommender.recommend(rows, N, options['weights'], engine_results=results)
+
+    return (start, end, {method: results[method] for method in methods})
+
+
+# Recommend for every user of a model and write the results to output_path
+# Parameter Description:
+# model: model_artifacts.RecommenderModel (loaded with loadModel or built in memory)
+# methods: any of METHODS ('als' needs als_model)
+# N: number of programs per user and method, K: number of UserCF neighbors
+# w1, als_weight: CB and ALS weights of the hybrid fusion (UserCF gets the rest), see hybrid_fusion.hybridWeights
+# processes: size of the process pool (default: number of cores), shard_size: users per task
+# neighbor_table: optional neighbor_table.NeighborTable of the model's users, see hybrid_fusion.createHybridRecommender
+# als_model: optional ALS.ALSModel trained on the model's rating store
+# label_index: whether CB searches a label_index.LabelIndex of the candidates (every worker builds its own)
+# Each output line is {"user": user name, "cb": [[program name, recommendation index], ...], "usercf": [...], "hybrid": [...]}
+# Returns the number of users written
+def runBatch(model, output_path, methods=('cb', 'usercf', 'hybrid'), N=5, K=2, w1=0.7, processes=None, shard_size=1024, neighbor_table=None,
+             als_model=None, als_weight=0.0, label_index=False):
+
+    weights = hybridWeights(w1, als_weight)
+    if neighbor_table is not None:
+        checkNeighborTable(neighbor_table, model.rating_store.users_names, K)
+    if als_model is not None:
+        checkALSModel(als_model, model.rating_store)
+    elif 'als' in methods or ('hybrid' in methods and weights['als'] > 0):
+        raise ValueError("ALS is asked for but no ALS model is given")
+    users_num = len(model.users_names)
+    options = {'methods': tuple(methods), 'N': N, 'K': K, 'weights': weights, 'items_num': len(model.rating_store.items_names),
+               'label_index': label_index}
+    shards = [(start, min(start + shard_size, users_num)) for start in range(0, users_num, shard_size)]
+
+    (shared_blocks, descriptor) = shareArrays(createSharedArrays(model, K, neighbor_table, als_model))
+    # fork (where available) lets the workers inherit the imported modules instead of re-importing them
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+
+    written = 0
+    try:
+        with context.Pool(processes, initializer=initWorker, initargs=(descriptor, options)) as pool, \
+                open(output_path, 'w', encoding='utf-8') as output:
+            for (start, end, results) in pool.imap_unordered(recommendShard, shards):
+                for i in range(start, end):
+                    line = {'user': str(model.users_names[i])}
+                    for method in methods:
+                        (top_indices, top_scores) = results[method]
+                        line[method] = topNToRecommendItems(top_indices[i - start], top_scores[i - start], model.candidates_names)
+                    output.write(json.dumps(line, ensure_ascii=False) + '\n')
+                output.flush()
+                written += end - start
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+    return written
+
+
+if __name__ == '__main__':
+
+    from model_artifacts import loadModel
+
+    (model_dir, output_path) = sys.argv[1:3]
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+
+    written = runBatch(loadModel(model_dir), output_path, processes=processes)
+    print("Recommendations for %d users written to %s" % (written, output_path))
@@ -0,0 +1,197 @@
+# Code description:
+# Benchmark of every recommender stage on seeded synthetic data (see synthetic_data.py)
+# For each scale the data is generated once, then every stage is run and measured twice: once for the wall time and once
+# under tracemalloc for the peak memory it allocates (Python objects and numpy buffers), so the tracing does not slow down
+# the timed run. The dictionary-based functions (createUsersProfiles, contentBased, calCosDistByPearson, findSimilarUsers,
+# userCF) are measured on a sample of users, and only on scales small enough for their Python loops.
+# Results are written as JSON; "compare" prints the ratio of two result files stage by stage to spot regressions.
+# Usage: python benchmark.py run <output .json> [scale,scale,...]
+#        python benchmark.py compare <old .json> <new .json>
+
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# name -> generateSyntheticData parameters
+SCALES = {
+    'small': {'users_num': 300, 'items_num': 1000, 'labels_num': 30, 'density': 0.02, 'popularity_skew': 0.8},
+    'medium': {'users_num': 3000, 'items_num': 5000, 'labels_num': 50, 'density': 0.005, 'popularity_skew': 1.0},
+    'large': {'users_num': 30000, 'items_num': 20000, 'labels_num': 100, 'density': 0.001, 'popularity_skew': 1.1},
+}
+
+# The dictionary-based functions are only run while users x programs stays below this (their loops visit every cell)
+LEGACY_CELLS_LIMIT = 20000000
+
+
+# Run function(*args) for the time, then again under tracemalloc for the peak memory, and store both in stages[name]
+# calls: how many users or pairs one run covers, to report the time per call
+# Returns the value of the timed run
+def measureStage(stages, name, function, args=(), calls=1, memory=True):
+
+    started = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - started
+
+    stages[name] = {'seconds': seconds, 'calls': calls, 'seconds_per_call': seconds / max(calls, 1)}
+    if memory:
+        del value
+        tracemalloc.start()
+        value = function(*args)
+        stages[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    print("  %-32s %10.4fs %12s" % (name, seconds, '%.1f MB' % (stages[name]['peak_bytes'] / 1e6) if memory else ''))
+    return value
+
+
+# The stages of the dictionary-based scripts, on sample_rows users
+def benchmarkLegacyStages(stages, data, sample_rows, K, N):
+
+    from CB import createItemsProfiles, createUsersProfiles, contentBased
+    from UserCF import calCosDistByPearson, createUsersDict, createItemsDict, findSimilarUsers, userCF
+    from synthetic_data import toDataFrames
+
+    store = data['rating_store']
+    labels_names = data['labels_names']
+    candidates_names = data['candidates_names']
+    users_sample = [store.users_names[i] for i in sample_rows]
+
+    (ratings_df, items_labels_df, candidates_labels_df) = measureStage(stages, 'legacy.toDataFrames', toDataFrames, (data,))
+    data_array = np.array(ratings_df.iloc[:, 1:])
+
+    users_dict = measureStage(stages, 'legacy.createUsersDict', createUsersDict, (ratings_df,), len(store.users_names))
+    items_dict = measureStage(stages, 'legacy.createItemsDict', createItemsDict, (ratings_df,), len(store.items_names))
+
+    items_profiles = measureStage(stages, 'legacy.createItemsProfiles', createItemsProfiles,
+                                  (np.array(items_labels_df.iloc[:, 1:]), labels_names, store.items_names), len(store.items_names))
+    candidates_profiles = createItemsProfiles(np.array(candidates_labels_df.iloc[:, 1:]), labels_names, candidates_names)
+
+    (users_profiles, items_users_saw) = measureStage(stages, 'legacy.createUsersProfiles', createUsersProfiles,
+                                                     (data_array[sample_rows], users_sample, store.items_names, labels_names, items_profiles),
+                                                     len(sample_rows))
+
+    def runContentBased():
+        return [contentBased(users_profiles[user], candidates_profiles, candidates_names, labels_names, items_users_saw[user])[:N]
+                for user in users_sample]
+    measureStage(stages, 'legacy.contentBased', runContentBased, (), len(users_sample))
+
+    # Pearson similarity of every sampled user with the next 50 users
+    pairs = [(users_dict[users_sample[k]], users_dict[store.users_names[(sample_rows[k] + d) % len(store.users_names)]])
+             for k in range(len(users_sample)) for d in range(1, 51)]
+    measureStage(stages, 'legacy.calCosDistByPearson', lambda: [calCosDistByPearson(x, y) for (x, y) in pairs], (), len(pairs))
+
+    measureStage(stages, 'legacy.findSimilarUsers', lambda: [findSimilarUsers(users_dict, items_dict, user, K) for user in users_sample],
+                 (), len(users_sample))
+    measureStage(stages, 'legacy.userCF', lambda: [userCF(user, users_dict, items_dict, K, candidates_names)[:N] for user in users_sample],
+                 (), len(users_sample))
+
+
+# The stages of the matrix engines, on all users
+def benchmarkMatrixStages(stages, data, sample_rows, K, N, M):
+
+    from CB import contentBasedBatch
+    from UserCF import userCFBatch
+    from hybrid_fusion import createHybridRecommender
+    from label_index import LabelIndex
+    from model_artifacts import buildModel
+    from neighbor_table import createNeighborTable
+    from similarity import createPearsonMatrices
+
+    store = data['rating_store']
+    users_num = len(store.users_names)
+
+    model = measureStage(stages, 'model.buildModel', buildModel,
+                         (data['labels_names'], store, data['items_labels'].toarray(), data['candidates_names'], data['candidates_labels'].toarray()),
+                         users_num)
+    seen_items = model.seenItemsList()
+
+    measureStage(stages, 'cb.contentBasedBatch', contentBasedBatch, (model.users_profiles, model.candidates_profiles, N, seen_items), users_num)
+
+    label_index = measureStage(stages, 'cb.LabelIndex', LabelIndex, (model.candidates_profiles,))
+    measureStage(stages, 'cb.LabelIndex.searchBatch', label_index.searchBatch,
+                 (model.users_profiles[sample_rows], N, [seen_items[i] for i in sample_rows]), len(sample_rows))
+
+    pearson_matrices = measureStage(stages, 'usercf.createPearsonMatrices', createPearsonMatrices, (store.users_to_items,))
+    candidates_columns = np.array([store.items_index.get(name, -1) for name in model.candidates_names], dtype=np.int64)
+    measureStage(stages, 'usercf.userCFBatch', userCFBatch, (pearson_matrices, np.arange(users_num), K, candidates_columns, N, seen_items),
+                 users_num)
+    measureStage(stages, 'usercf.createNeighborTable', createNeighborTable, (store, M), users_num)
+
+    recommender = measureStage(stages, 'hybrid.createHybridRecommender', createHybridRecommender, (model, K))
+    measureStage(stages, 'hybrid.recommend', recommender.recommend, (np.arange(users_num), N), users_num)
+
+
+# Benchmark one scale, returns {'parameters': ..., 'stages': {stage name: measurements}}
+def benchmarkScale(parameters, seed=0, sample_users=50, K=2, N=5, M=20):
+
+    from synthetic_data import generateSyntheticData
+
+    stages = {}
+    data = measureStage(stages, 'data.generateSyntheticData', lambda: generateSyntheticData(seed=seed, **parameters))
+
+    users_num = len(data['rating_store'].users_names)
+    sample_rows = np.random.default_rng(seed).choice(users_num, size=min(sample_users, users_num), replace=False).tolist()
+
+    if parameters['users_num'] * parameters['items_num'] <= LEGACY_CELLS_LIMIT:
+        benchmarkLegacyStages(stages, data, sample_rows, K, N)
+    benchmarkMatrixStages(stages, data, sample_rows, K, N, M)
+
+    store = data['rating_store']
+    parameters = dict(parameters, seed=seed, sample_users=len(sample_rows), K=K, N=N, M=M, ratings=int(store.users_to_items.nnz))
+
+    return {'parameters': parameters, 'stages': stages}
+
+
+# Benchmark the given scales and write the results to output_path
+def runBenchmark(output_path, scales_names=('small', 'medium'), **options):
+
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'numpy': np.__version__, 'machine': platform.platform(), 'scales': {}}
+
+    for name in scales_names:
+        print("scale %s: %s" % (name, SCALES[name]))
+        results['scales'][name] = benchmarkScale(SCALES[name], **options)
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    return results
+
+
+# Print new / old time and memory ratios of every stage both result files have
+def compareBenchmarks(old_path, new_path):
+
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+
+    for scale in new['scales']:
+        if scale not in old['scales']:
+            continue
+        print("scale %s" % scale)
+        old_stages = old['scales'][scale]['stages']
+        new_stages = new['scales'][scale]['stages']
+        for name in new_stages:
+            if name not in old_stages:
+                continue
+            time_ratio = new_stages[name]['seconds'] / max(old_stages[name]['seconds'], 1e-9)
+            line = "  %-32s time x%.2f" % (name, time_ratio)
+            if 'peak_bytes' in new_stages[name] and 'peak_bytes' in old_stages[name]:
+                line += "  memory x%.2f" % (new_stages[name]['peak_bytes'] / max(old_stages[name]['peak_bytes'], 1))
+            print(line)
+
+
+if __name__ == '__main__':
+
+    if sys.argv[1] == 'compare':
+        compareBenchmarks(sys.argv[2], sys.argv[3])
+    else:
+        scales_names = sys.argv[3].split(',') if len(sys.argv) > 3 else ['small', 'medium']
+        runBenchmark(sys.argv[2], scales_names)
+        print("Results written to %s" % sys.argv[2])
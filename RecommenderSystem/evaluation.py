@@ -0,0 +1,249 @@
+# Code description:
+# Offline evaluation of the recommenders and sweep of their parameters
+# Part of every user's watched programs is held out, the engines recommend from the rest, and the recommended lists are
+# scored against the held-out programs with precision@N, recall@N and NDCG@N.
+# A sweep over the number of neighbors K of UserCF, the weight w1 of CB in the mix (UserCF gets w2 = 1 - w1) and N
+# computes everything that does not depend on the swept values only once:
+# - the split, the user portraits, the Pearson matrices and the CB top list (independent of K, w1 and N)
+# - the user neighbors, for the largest K (the K nearest neighbors are the first K columns of the table)
+# - the UserCF top list once per K, for the largest N
+# and only fuses and scores the lists per configuration. The K values, then the (K, w1) configurations, are spread over a
+# process pool.
+# Memory: every dense users x users or users x candidates block is sized from memory_budget, and the number of K jobs
+# running at once is bounded so that their blocks together stay within it (the prepared state is shared, not copied, by
+# forked workers). A worker killed by the system fails the sweep instead of leaving it waiting.
+# Usage: python evaluation.py <compiled model directory> [output .json]
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from CB import contentBasedBatch, createUsersProfilesMatrix
+from UserCF import userCFBatchFromNeighbors
+from hybrid_fusion import HybridRecommender
+from item_filters import ItemFilters, SeenItems
+from neighbor_table import computeNeighborRows
+from out_of_core_similarity import PAIR_BYTES
+from similarity import createPearsonMatrices
+
+DEFAULT_KS = (1, 2, 3, 5, 10, 20)
+DEFAULT_WEIGHTS = (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+DEFAULT_NS = (5, 10, 20)
+METRICS = ('precision', 'recall', 'ndcg')
+# Default bound of the dense blocks of the sweep
+MEMORY_BUDGET = 1 << 30
+# Bytes per user and candidate of the dense score blocks of CB and UserCF (scores, counts and the top-N selection temporaries)
+SCORE_BYTES = 64
+# A K job is not started with fewer rows per block than this
+MIN_BLOCK_ROWS = 256
+
+
+# Rows of a block whose dense rows x columns arrays take row_bytes per column, within memory_budget
+def blockRows(memory_budget, columns_num, row_bytes):
+    return max(1, int(memory_budget // max(1, row_bytes * columns_num)))
+
+
+# Split a rating matrix into a training and a test matrix with the same shape
+# Parameter Description:
+# users_to_items: users x items rating matrix, only positive implicit scores count as watched
+# holdout_fraction: fraction of every user's watched programs moved to the test matrix, at least one
+# min_ratings: users with fewer watched programs stay entirely in the training matrix
+# seed: seed of the random choice
+# Returns (train, test), CSR; every user keeps at least one watched program in train
+def holdoutSplit(users_to_items, holdout_fraction=0.2, min_ratings=2, seed=0):
+
+    ratings = sparse.csr_matrix(users_to_items, dtype=np.float64, copy=True)
+    ratings.data[ratings.data < 0] = 0.0
+    ratings.eliminate_zeros()
+    ratings.sort_indices()
+
+    counts = np.diff(ratings.indptr)
+    rows = np.repeat(np.arange(ratings.shape[0]), counts)
+
+    # Random rank of every rating within its row
+    keys = np.random.default_rng(seed).random(ratings.nnz)
+    order = np.lexsort((keys, rows))
+    ranks = np.empty(ratings.nnz, dtype=np.int64)
+    ranks[order] = np.arange(ratings.nnz) - ratings.indptr[rows[order]]
+
+    held_out_counts = np.clip(np.floor(counts * holdout_fraction).astype(np.int64), 1, np.maximum(counts - 1, 0))
+    held_out_counts[counts < max(min_ratings, 2)] = 0
+    held_out = ranks < held_out_counts[rows]
+
+    def part(keep):
+        return sparse.csr_matrix((ratings.data[keep], (rows[keep], ratings.indices[keep])), shape=ratings.shape)
+
+    return (part(~held_out), part(held_out))
+
+
+# Metrics of top lists against the relevant programs
+# Parameter Description:
+# top_indices: users x (at least N) recommended positions, -1 for unused slots
+# relevant: CSR users x positions, nonzero where the program is relevant (held out) for the user
+# N: length of the lists scored
+# Returns {'precision', 'recall', 'ndcg'}, one value per user (users without relevant programs get 0)
+def rankingMetrics(top_indices, relevant, N):
+
+    top_indices = np.asarray(top_indices)[:, :N]
+    relevant = sparse.csr_matrix(relevant)
+    relevant_counts = np.diff(relevant.indptr)
+
+    # hits[u][k]: the k-th recommendation of user u is relevant, looked up in the sorted CSR rows
+    hits = np.zeros(top_indices.shape, dtype=bool)
+    users = np.repeat(np.arange(top_indices.shape[0]), top_indices.shape[1])
+    positions = top_indices.ravel()
+    valid = positions >= 0
+    keys = users[valid] * relevant.shape[1] + positions[valid]
+    relevant_keys = np.repeat(np.arange(relevant.shape[0]), relevant_counts) * relevant.shape[1] + relevant.indices
+    hits.ravel()[valid] = np.isin(keys, relevant_keys)
+
+    hits_num = hits.sum(axis=1)
+    discounts = 1.0 / np.log2(np.arange(2, N + 2))
+    dcg = hits @ discounts
+    ideal = np.concatenate([[0.0], np.cumsum(discounts)])[np.minimum(relevant_counts, N)]
+
+    return {'precision': hits_num / N,
+            'recall': np.divide(hits_num, relevant_counts, out=np.zeros(len(hits_num)), where=relevant_counts > 0),
+            'ndcg': np.divide(dcg, ideal, out=np.zeros(len(dcg)), where=ideal > 0)}
+
+
+# Averages of rankingMetrics over the users
+def meanMetrics(top_indices, relevant, N):
+    metrics = rankingMetrics(top_indices, relevant, N)
+    return {name: float(metrics[name].mean()) for name in METRICS}
+
+
+# State shared with the worker processes, filled by prepareSweep and handed to the pool by initSweepWorker
+sweep_state = {}
+
+
+# Pool initializer: under fork the prepared state is inherited as is, under spawn it is pickled once per worker
+def initSweepWorker(state):
+    sweep_state.clear()
+    sweep_state.update(state)
+
+
+# Compute the parts of the sweep that do not depend on K, w1 or N
+# Parameter Description:
+# rating_store: RatingStore, items_profiles: portraits of its programs (rows in its column order)
+# The candidates are all programs of the store: a user's held-out programs must be recommendable, his training programs are not
+# memory_budget: bound of the dense blocks; usercf_block_size: rows per block of the UserCF jobs
+def prepareSweep(rating_store, items_profiles, Ks, Ns, holdout_fraction, seed, memory_budget=MEMORY_BUDGET, usercf_block_size=4096):
+
+    (train, test) = holdoutSplit(rating_store.users_to_items, holdout_fraction, seed=seed)
+    rows = np.nonzero(np.diff(test.indptr) > 0)[0]
+    items_num = train.shape[1]
+
+    pearson_matrices = createPearsonMatrices(train)
+    users_profiles = createUsersProfilesMatrix(train, items_profiles)
+    item_filters = ItemFilters(items_num, SeenItems(train.indptr, train.indices))
+    recommender = HybridRecommender(users_profiles, np.asarray(items_profiles, dtype=np.float64), pearson_matrices,
+                                    np.arange(items_num), item_filters, max(Ks))
+
+    (neighbors, similarities) = computeNeighborRows(pearson_matrices, rows, max(Ks), 1, None,
+                                                    blockRows(memory_budget, train.shape[0], PAIR_BYTES))
+
+    sweep_state.clear()
+    sweep_state.update({'rows': rows, 'relevant': test[rows], 'recommender': recommender, 'neighbors': neighbors,
+                        'similarities': similarities, 'max_N': max(Ns), 'usercf_block_size': usercf_block_size})
+    sweep_state['cb'] = contentBasedBatch(users_profiles[rows], recommender.candidates_profiles, max(Ns), item_filters=item_filters,
+                                          users_rows=rows, block_size=blockRows(memory_budget, items_num, SCORE_BYTES))
+
+
+# UserCF top list of the evaluated users with K neighbors
+def userCFForK(K):
+    recommender = sweep_state['recommender']
+    return (K, userCFBatchFromNeighbors(recommender.pearson_matrices[2], sweep_state['rows'], sweep_state['neighbors'][:, :K],
+                                        sweep_state['similarities'][:, :K], recommender.candidates_columns, sweep_state['max_N'],
+                                        item_filters=recommender.item_filters, block_size=sweep_state['usercf_block_size']))
+
+
+# Metrics of one (K, w1) configuration for every N
+def evaluateConfiguration(task):
+
+    (K, w1, usercf, Ns, strategy, normalization) = task
+    recommender = sweep_state['recommender']
+    engine_results = {'cb': sweep_state['cb'], 'usercf': usercf}
+    weights = {'cb': w1, 'usercf': 1.0 - w1}
+
+    results = []
+    for N in Ns:
+        (top_indices, top_scores) = recommender.recommend(sweep_state['rows'], N, weights, strategy, normalization, engine_results)
+        result = {'K': K, 'w1': w1, 'w2': 1.0 - w1, 'N': N}
+        result.update(meanMetrics(top_indices, sweep_state['relevant'], N))
+        results.append(result)
+
+    return results
+
+
+# Sweep K, w1 and N on a holdout split
+# Parameter Description:
+# Ks / weights / Ns: values swept for the number of UserCF neighbors, the CB weight w1 and the list length
+# strategy / normalization: fusion options, see hybrid_fusion.HybridRecommender.recommend
+# processes: size of the process pool (default: number of cores), 1 runs everything in this process; fewer processes are
+#            used when memory_budget does not allow MIN_BLOCK_ROWS rows per block for each of them
+# memory_budget: bytes the dense blocks of the sweep may take together
+# Returns the list of {'K', 'w1', 'w2', 'N', 'precision', 'recall', 'ndcg'}, one per configuration
+def runSweep(rating_store, items_profiles, Ks=DEFAULT_KS, weights=DEFAULT_WEIGHTS, Ns=DEFAULT_NS, strategy='weighted',
+             normalization='rank', holdout_fraction=0.2, seed=0, processes=None, memory_budget=MEMORY_BUDGET):
+
+    Ks = sorted(set(Ks))
+    Ns = sorted(set(Ns))
+
+    # Concurrent K jobs share the budget
+    items_num = rating_store.shape[1]
+    processes = min(processes or os.cpu_count() or 1, len(Ks))
+    processes = max(1, min(processes, blockRows(memory_budget, items_num, SCORE_BYTES) // MIN_BLOCK_ROWS))
+    prepareSweep(rating_store, items_profiles, Ks, Ns, holdout_fraction, seed, memory_budget,
+                 blockRows(memory_budget / processes, items_num, SCORE_BYTES))
+
+    # w1 = 1 is CB alone and does not depend on K, it is evaluated once (with the smallest K)
+    def tasks(usercf_lists):
+        return [(K, w1, usercf_lists[K], Ns, strategy, normalization) for K in Ks for w1 in weights if w1 < 1.0 or K == Ks[0]]
+
+    if processes == 1:
+        usercf_lists = dict(map(userCFForK, Ks))
+        results = map(evaluateConfiguration, tasks(usercf_lists))
+    else:
+        # fork (where available) hands the shared state to the workers without pickling it; unlike multiprocessing.Pool,
+        # the executor raises BrokenProcessPool when a worker dies (e.g. killed for lack of memory) instead of waiting forever
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        with ProcessPoolExecutor(processes, mp_context=context, initializer=initSweepWorker, initargs=(dict(sweep_state),)) as pool:
+            usercf_lists = dict(pool.map(userCFForK, Ks))
+            results = list(pool.map(evaluateConfiguration, tasks(usercf_lists)))
+
+    results = [result for configuration in results for result in configuration]
+    sweep_state.clear()
+    return results
+
+
+# Best configuration for one metric, optionally for one N
+def bestConfiguration(results, metric='ndcg', N=None):
+    return max((result for result in results if N is None or result['N'] == N), key=lambda result: result[metric])
+
+
+# Main program
+if __name__ == '__main__':
+
+    from model_artifacts import loadModel
+
+    model = loadModel(sys.argv[1])
+
+    started = time.perf_counter()
+    results = runSweep(model.rating_store, model.items_profiles, processes=os.cpu_count())
+    print("%d configurations evaluated in %.1f s" % (len(results), time.perf_counter() - started))
+
+    for N in DEFAULT_NS:
+        best = bestConfiguration(results, 'ndcg', N)
+        print("N = %d: best K = %d, w1 = %.1f, w2 = %.1f (precision %.4f, recall %.4f, NDCG %.4f)"
+              % (N, best['K'], best['w1'], best['w2'], best['precision'], best['recall'], best['ndcg']))
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
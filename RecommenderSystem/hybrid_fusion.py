@@ -0,0 +1,310 @@
+# Code description:
+# Post-fusion of several recommendation engines (CB, UserCF, ItemCF, ALS, ...) over one shared, once-loaded model
+# Every engine is asked only for the top-k it needs through a bounded top-k call (argpartition inside, no full ranked list).
+# The lists are then merged per user, either
+# - 'weighted': scores are normalized per list (CB similarities and UserCF similarity sums live on different scales),
+#   multiplied by the engine weight and summed for programs recommended by several engines, or
+# - 'interleave': engines take turns in proportion to their weights, as CB_Mixture_userCF.py did with topW1 / topW2.
+# A program recommended by several engines appears only once in the result.
+# Scores are normalized by rank by default, so that every list keeps its best programs in the mix whatever the scale or sign
+# of its scores; minmax sends each list's worst program to 0 and can leave the lower-weighted engine out altogether (e.g. a
+# UserCF list of equal negative similarity sums).
+
+import numpy as np
+
+from CB import contentBasedBatch
+from UserCF import userCFBatch, userCFBatchFromNeighbors
+from item_filters import ItemFilters, SeenItems
+from neighbor_table import checkNeighborTable
+from similarity import createPearsonMatrices
+
+STRATEGIES = ('weighted', 'interleave')
+NORMALIZATIONS = ('rank', 'minmax', 'none')
+
+
+# Engine weights of the CB + collaborative filtering hybrid used by recommender.py, batch_recommend.py and recommend_service.py
+# w1: CB weight; the collaborative part 1 - w1 goes to ALS for als_weight and to UserCF for the rest, so
+# als_weight = 1 - w1 replaces UserCF by ALS
+def hybridWeights(w1, als_weight=0.0):
+
+    if not 0.0 <= w1 <= 1.0:
+        raise ValueError("the CB weight must be between 0 and 1, got %s" % w1)
+    if not 0.0 <= als_weight <= 1.0 - w1 + 1e-9:
+        raise ValueError("the ALS weight must be between 0 and 1 - w1 = %g, got %s" % (1.0 - w1, als_weight))
+    # Rounded so that 1 - 0.7 - 0.3 leaves UserCF out instead of giving it a weight of 5e-17
+    return {'cb': w1, 'usercf': max(round(1.0 - w1 - als_weight, 12), 0.0), 'als': als_weight}
+
+
+# Normalize the valid scores (index >= 0) of one top-k list
+# minmax: best -> 1, worst -> 0 (all equal -> 1 if they are positive, else 0: a list of zero or negative similarities says
+# nothing in favour of its programs); rank: 1 / (1 + position); none: unchanged
+def normalizeScores(indices, scores, normalization):
+
+    valid = indices >= 0
+    normalized = np.zeros(len(scores))
+    if not valid.any():
+        return normalized
+
+    if normalization == 'rank':
+        normalized[valid] = 1.0 / (1.0 + np.arange(valid.sum()))
+    elif normalization == 'minmax':
+        low = scores[valid].min()
+        high = scores[valid].max()
+        if high == low:
+            normalized[valid] = 1.0 if high > 0 else 0.0
+        else:
+            normalized[valid] = (scores[valid] - low) / (high - low)
+    else:
+        normalized[valid] = scores[valid]
+
+    return normalized
+
+
+# Weighted-score fusion of the lists of one user
+# lists = [(indices, scores), ...], one per engine, weights in the same order
+def fuseWeighted(lists, weights, N, normalization='rank'):
+
+    fused = {}
+    for e in range(len(lists)):
+        (indices, scores) = lists[e]
+        normalized = normalizeScores(indices, scores, normalization)
+        for j in range(len(indices)):
+            if indices[j] >= 0:
+                fused[indices[j]] = fused.get(indices[j], 0.0) + weights[e] * normalized[j]
+
+    # Descending score, ties by the order in which the programs were first met (engine order, then rank)
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:N]
+
+    top_indices = np.full(N, -1, dtype=np.int64)
+    top_scores = np.full(N, -np.inf)
+    for j in range(len(ranked)):
+        (top_indices[j], top_scores[j]) = ranked[j]
+
+    return (top_indices, top_scores)
+
+
+# fuseWeighted for a block of users at once, same result as calling it row by row
+# results = [(top_indices, top_scores), ...], one per engine, each rows_num x k
+def fuseWeightedBlock(rows_num, results, weights, N, normalization='rank'):
+
+    top_indices = np.full((rows_num, N), -1, dtype=np.int64)
+    top_scores = np.full((rows_num, N), -np.inf)
+    if len(results) == 0:
+        return (top_indices, top_scores)
+
+    indices = np.hstack([np.asarray(indices) for (indices, scores) in results])
+    contributions = np.hstack([weights[e] * normalizeScoresBlock(results[e][0], results[e][1], normalization) for e in range(len(results))])
+
+    # One entry per (user, program): the contributions summed in engine order, and the column where it was first met
+    (users, columns) = np.nonzero(indices >= 0)
+    if len(users) == 0:
+        return (top_indices, top_scores)
+    programs = indices[users, columns]
+    order = np.lexsort((columns, programs, users))
+    (users, columns, programs) = (users[order], columns[order], programs[order])
+    starts = np.nonzero(np.concatenate([[True], (users[1:] != users[:-1]) | (programs[1:] != programs[:-1])]))[0]
+    sizes = np.diff(np.append(starts, len(users)))
+    values = contributions[users, columns]
+    # Added left to right in engine order (a program is at most once in each list), as fuseWeighted does
+    fused = values[starts]
+    for k in range(1, len(results)):
+        more = sizes > k
+        fused[more] += values[starts[more] + k]
+    (users, columns, programs) = (users[starts], columns[starts], programs[starts])
+
+    # Descending score, ties by the order in which the programs were first met, the first N of every user
+    order = np.lexsort((columns, -fused, users))
+    (users, programs, fused) = (users[order], programs[order], fused[order])
+    ranks = np.arange(len(users)) - np.searchsorted(users, users)
+    kept = ranks < N
+
+    top_indices[users[kept], ranks[kept]] = programs[kept]
+    top_scores[users[kept], ranks[kept]] = fused[kept]
+
+    return (top_indices, top_scores)
+
+
+# normalizeScores for every row of a top-k block (the valid entries of a row come first)
+def normalizeScoresBlock(indices, scores, normalization):
+
+    indices = np.asarray(indices)
+    valid = indices >= 0
+    normalized = np.zeros(indices.shape)
+
+    if normalization == 'rank':
+        normalized = np.broadcast_to(1.0 / (1.0 + np.arange(indices.shape[1])), indices.shape).copy()
+    elif normalization == 'minmax':
+        # Rows without any valid entry get low = high = 0, they are zeroed below anyway
+        any_valid = valid.any(axis=1, keepdims=True)
+        low = np.where(any_valid, np.where(valid, scores, np.inf).min(axis=1, keepdims=True), 0.0)
+        high = np.where(any_valid, np.where(valid, scores, -np.inf).max(axis=1, keepdims=True), 0.0)
+        span = np.where(high > low, high - low, 1.0)
+        normalized = np.where(high > low, (np.where(valid, scores, low) - low) / span, np.where(high > 0, 1.0, 0.0))
+    else:
+        normalized = np.where(valid, scores, 0.0)
+
+    return np.where(valid, normalized, 0.0)
+
+
+# Interleaving fusion of the lists of one user: engine e gets round(weights[e] * N) slots (largest remainder),
+# slots left over because an engine ran out of programs are filled from the other engines; the score kept for a program
+# is its normalized score in the list it was taken from
+def fuseInterleaved(lists, weights, N, normalization='rank'):
+
+    weights = np.asarray(weights, dtype=np.float64)
+    shares = weights / weights.sum() * N if weights.sum() > 0 else np.zeros(len(lists))
+    quotas = np.floor(shares).astype(np.int64)
+    for e in np.argsort(-(shares - quotas), kind='stable')[:N - quotas.sum()]:
+        quotas[e] += 1
+
+    normalized = [normalizeScores(indices, scores, normalization) for (indices, scores) in lists]
+    positions = [0] * len(lists)
+    taken = set()
+    result = []
+
+    # Take the next program of engine e that is not in the result yet
+    def takeNext(e):
+        (indices, scores) = lists[e]
+        while positions[e] < len(indices) and indices[positions[e]] >= 0:
+            j = positions[e]
+            positions[e] += 1
+            if indices[j] not in taken:
+                taken.add(indices[j])
+                result.append((indices[j], normalized[e][j]))
+                return True
+        return False
+
+    # Round robin over the engines until every quota is used
+    remaining = quotas.copy()
+    while len(result) < N and remaining.sum() > 0:
+        for e in range(len(lists)):
+            if remaining[e] > 0 and len(result) < N:
+                remaining[e] = remaining[e] - 1 if takeNext(e) else 0
+
+    # Fill what is left from the engines in order of weight
+    for e in np.argsort(-weights, kind='stable'):
+        while len(result) < N and takeNext(e):
+            pass
+
+    top_indices = np.full(N, -1, dtype=np.int64)
+    top_scores = np.full(N, -np.inf)
+    for j in range(len(result)):
+        (top_indices[j], top_scores[j]) = result[j]
+
+    return (top_indices, top_scores)
+
+
+# Engines and fusion over one shared model
+# Parameter Description:
+# users_profiles, candidates_profiles: CB portraits (users x labels, candidates x labels)
+# pearson_matrices: similarity.createPearsonMatrices of the rating store
+# candidates_columns: rating store column of every candidate, -1 if nobody has watched it
+# item_filters: item_filters.ItemFilters over the candidates (seen bitmaps, whitelist, business filters)
+# K: number of UserCF neighbors
+# neighbor_table: optional neighbor_table.NeighborTable of the same users, its first K columns replace the similarity blocks of UserCF
+# profile_store: optional profile_store.ProfileStore kept up to date with the ratings (e.g. by a RatingWindow); CB then reads the
+#                portraits from it instead of users_profiles, looked up by the names of the rows in users_names
+# label_index: optional label_index.LabelIndex over candidates_profiles, CB then searches it instead of scoring every candidate
+class HybridRecommender:
+
+    def __init__(self, users_profiles, candidates_profiles, pearson_matrices, candidates_columns, item_filters, K=2, neighbor_table=None,
+                 profile_store=None, users_names=None, label_index=None):
+        self.users_profiles = users_profiles
+        self.candidates_profiles = candidates_profiles
+        self.pearson_matrices = pearson_matrices
+        self.candidates_columns = candidates_columns
+        self.item_filters = item_filters
+        self.K = K
+        self.neighbor_table = neighbor_table
+        self.profile_store = profile_store
+        self.users_names = users_names
+        self.label_index = label_index
+        # name -> function(rows, k) returning (top_indices, top_scores) with one row per user; more engines can be registered
+        self.engines = {'cb': self.contentBasedTopK, 'usercf': self.userCFTopK}
+
+    def addEngine(self, name, top_k):
+        self.engines[name] = top_k
+
+    def contentBasedTopK(self, rows, k):
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.profile_store is not None:
+            users_profiles = self.profile_store.profilesOfUsers([self.users_names[i] for i in rows])
+        else:
+            users_profiles = self.users_profiles[rows]
+        if self.label_index is not None:
+            return self.label_index.searchBatch(users_profiles, k, allowed_mask=self.item_filters.allowedMask(rows))
+        return contentBasedBatch(users_profiles, self.candidates_profiles, k, item_filters=self.item_filters, users_rows=rows)
+
+    def userCFTopK(self, rows, k):
+        if self.neighbor_table is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            return userCFBatchFromNeighbors(self.pearson_matrices[2], rows, self.neighbor_table.neighbors[rows, :self.K],
+                                            self.neighbor_table.similarities[rows, :self.K], self.candidates_columns, k,
+                                            item_filters=self.item_filters)
+        return userCFBatch(self.pearson_matrices, rows, self.K, self.candidates_columns, k, item_filters=self.item_filters)
+
+    # Fused top-N for the users in rows
+    # Parameter Description:
+    # weights = {engine name: weight}, engines with weight 0 are not asked at all
+    # strategy: one of STRATEGIES, normalization: one of NORMALIZATIONS (default rank)
+    # engine_results: optional {engine name: (top_indices, top_scores)} already computed for these rows with at least N columns
+    # Returns (top_indices, top_scores), len(rows) x N
+    def recommend(self, rows, N, weights=None, strategy='weighted', normalization='rank', engine_results=None):
+
+        weights = {'cb': 0.7, 'usercf': 0.3} if weights is None else weights
+        names = [name for name in weights if weights[name] > 0]
+        if strategy not in STRATEGIES:
+            raise ValueError("strategy must be one of %s" % ', '.join(STRATEGIES))
+
+        # Each engine only has to deliver N programs: with deduplication no engine can contribute more than N
+        engine_results = {} if engine_results is None else engine_results
+        results = [engine_results[name] if name in engine_results else self.engines[name](rows, N) for name in names]
+        if strategy == 'weighted':
+            return fuseWeightedBlock(len(rows), [(top_indices[:, :N], top_scores[:, :N]) for (top_indices, top_scores) in results],
+                                     [weights[name] for name in names], N, normalization)
+
+        top_indices = np.full((len(rows), N), -1, dtype=np.int64)
+        top_scores = np.full((len(rows), N), -np.inf)
+        for k in range(len(rows)):
+            lists = [(results[e][0][k][:N], results[e][1][k][:N]) for e in range(len(names))]
+            (top_indices[k], top_scores[k]) = fuseInterleaved(lists, [weights[name] for name in names], N, normalization)
+
+        return (top_indices, top_scores)
+
+    # Top-N of one engine, or of the fusion for method 'hybrid'
+    def recommendBy(self, method, rows, N, **fusion_options):
+        if method == 'hybrid':
+            return self.recommend(rows, N, **fusion_options)
+        return self.engines[method](rows, N)
+
+
+# Build the recommender on a model_artifacts.RecommenderModel
+# item_table: optional ItemCF.ItemSimilarityTable of the model's rating store, registers the engine 'itemcf'
+# (e.g. weights={'cb': 0.7, 'itemcf': 0.3} uses ItemCF instead of UserCF)
+# als_model: optional ALS.ALSModel trained on the model's rating store, registers the engine 'als'
+# neighbor_table: optional neighbor_table.NeighborTable of the model's users, built with at least K neighbors and the pruning
+#                 of userCFBatch (min_overlap 1, no min_similarity); UserCF then reads the neighbors from it
+# profile_store: optional profile_store.ProfileStore of the model's users with the labels of model.candidates_profiles
+#                (e.g. createProfileStore, then kept in step by a RatingWindow); CB then serves its current portraits
+# label_index: optional label_index.LabelIndex over model.candidates_profiles, used by CB
+def createHybridRecommender(model, K=2, item_table=None, als_model=None, neighbor_table=None, profile_store=None, label_index=None):
+
+    store = model.rating_store
+    if neighbor_table is not None:
+        checkNeighborTable(neighbor_table, store.users_names, K)
+    candidates_columns = np.array([store.items_index.get(name, -1) for name in model.candidates_names], dtype=np.int64)
+    item_filters = ItemFilters(len(model.candidates_names), SeenItems(model.seen_candidates.indptr, model.seen_candidates.indices))
+
+    recommender = HybridRecommender(model.users_profiles, model.candidates_profiles, createPearsonMatrices(store.users_to_items),
+                                    candidates_columns, item_filters, K, neighbor_table, profile_store, store.users_names, label_index)
+    if item_table is not None:
+        from ItemCF import ItemCFEngine
+
+        recommender.addEngine('itemcf', ItemCFEngine(item_table, store, candidates_columns, item_filters))
+    if als_model is not None:
+        from ALS import ALSEngine, checkALSModel
+
+        checkALSModel(als_model, store)
+        recommender.addEngine('als', ALSEngine(als_model, store.users_to_items, candidates_columns, item_filters))
+
+    return recommender
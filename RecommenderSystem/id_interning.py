@@ -0,0 +1,211 @@
+# Code description:
+# Integer ID interning and a compact, array-backed catalog
+# The dict-based code keys everything by name: program portraits {item: {label: value}}, histories [[name, score], ...],
+# and similarity matches compare strings, which costs tens of bytes of Python objects per value. Here users, programs and
+# labels are mapped to dense integers once (IdMap); ratings are a typed CSR matrix, portraits typed arrays (float32 by
+# default), and names are only looked up again at the output boundary (recommendItems).
+# The existing functions keep working: the catalog hands out read-only views that behave like the dicts they take
+# (users_dict / items_dict of UserCF, items_profiles / users_profiles of CB) and read the arrays on access.
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from CB import createUsersProfilesMatrix, topNToRecommendItems
+from rating_store import RatingStore, internName
+
+
+# Dense integer IDs for names, in order of first appearance; a name listed twice gets one ID
+class IdMap:
+
+    def __init__(self, names=()):
+        self.names = []
+        self.index = {}
+        for name in names:
+            internName(name, self.index, self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    # ID of a known name (KeyError otherwise)
+    def id(self, name):
+        return self.index[name]
+
+    # ID of a name, adding it if it is new
+    def intern(self, name):
+        return internName(name, self.index, self.names)
+
+    # IDs of many names at once, adding the new ones; only the distinct names go through Python
+    def internMany(self, names):
+        values = pd.Series(np.asarray(names, dtype=object))
+        for name in pd.unique(values):
+            internName(name, self.index, self.names)
+        return values.map(self.index).to_numpy(dtype=np.int64)
+
+    def name(self, i):
+        return self.names[i]
+
+    def namesOf(self, ids):
+        return [self.names[i] for i in ids]
+
+
+# Read-only {name: {label: value}} view of the rows of a matrix, for the dict-based CB functions
+# (createUsersProfiles reads items_profiles[item][label], calCosDistance reads user[label] / item[label])
+# Parameter Description:
+# names, index: row names and {name: row}
+class ProfilesView:
+
+    def __init__(self, names, index, labels_map, matrix):
+        self.names = names
+        self.index = index
+        self.labels_map = labels_map
+        self.matrix = matrix
+
+    def __getitem__(self, name):
+        return ProfileRowView(self.labels_map, self.matrix[self.index[name]])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+
+class ProfileRowView:
+
+    def __init__(self, labels_map, row):
+        self.labels_map = labels_map
+        self.row = row
+
+    def __getitem__(self, label):
+        return float(self.row[self.labels_map.index[label]])
+
+    def __contains__(self, label):
+        return label in self.labels_map
+
+    def __iter__(self):
+        return iter(self.labels_map.names)
+
+    def __len__(self):
+        return len(self.labels_map)
+
+    def keys(self):
+        return list(self.labels_map.names)
+
+    def items(self):
+        return [(self.labels_map.names[l], float(self.row[l])) for l in range(len(self.labels_map))]
+
+
+# Array-backed catalog
+# Parameter Description:
+# users, items, labels: IdMaps
+# ratings: users x items scores (scipy sparse), items_profiles: items x labels portraits
+# candidates: optional item IDs of the alternative recommended program set (default all programs)
+# candidates_profiles: optional portraits of the candidates, one row per candidate (default their rows of items_profiles);
+#                      the candidate table may describe a program differently from the watched-programs table
+# dtype: type of the stored scores and portraits, float32 halves their memory (computations that need float64 convert)
+class InternedCatalog:
+
+    def __init__(self, users, items, labels, ratings, items_profiles, candidates=None, candidates_profiles=None, dtype=np.float32):
+
+        self.users = users
+        self.items = items
+        self.labels = labels
+        self.dtype = np.dtype(dtype)
+        self.rating_store = RatingStore(users.names, items.names, ratings, dtype=self.dtype)
+        # The IdMaps share the name lists and indexes of the store instead of holding a second copy
+        (users.names, users.index) = (self.rating_store.users_names, self.rating_store.users_index)
+        (items.names, items.index) = (self.rating_store.items_names, self.rating_store.items_index)
+
+        self.items_profiles = np.ascontiguousarray(items_profiles, dtype=self.dtype)
+        self.users_profiles = createUsersProfilesMatrix(self.rating_store.users_to_items, self.items_profiles).astype(self.dtype)
+        self.candidates = np.arange(len(items)) if candidates is None else np.asarray(candidates, dtype=np.int64)
+        if candidates_profiles is None:
+            self.candidates_profiles = self.items_profiles[self.candidates]
+        else:
+            self.candidates_profiles = np.ascontiguousarray(candidates_profiles, dtype=self.dtype)
+        self.candidates_index = {self.items.names[j]: c for (c, j) in enumerate(self.candidates)}
+
+    @property
+    def ratings(self):
+        return self.rating_store.users_to_items
+
+    # Item IDs and scores of the programs user_id has watched
+    def history(self, user_id):
+        return self.rating_store.userItems(user_id)
+
+    # Label IDs of a program
+    def itemLabels(self, item_id):
+        return np.nonzero(self.items_profiles[item_id] > 0)[0]
+
+    # Output boundary: one row of a (top_indices, top_scores) result over the candidates -> [[program name, score], ...]
+    def recommendItems(self, top_indices_row, top_scores_row):
+        return topNToRecommendItems(top_indices_row, top_scores_row, self.items.namesOf(self.candidates))
+
+    # Adapters for the dict-based functions
+    # users_dict / items_dict of UserCF.createUsersDict / createItemsDict (findSimilarUsers, userCF, ItemCF)
+    def usersDict(self):
+        return self.rating_store.usersDict()
+
+    def itemsDict(self):
+        return self.rating_store.itemsDict()
+
+    # items_profiles of CB.createItemsProfiles: of the watched programs (createUsersProfiles), of the candidates (contentBased)
+    def itemsProfilesDict(self):
+        return ProfilesView(self.items.names, self.items.index, self.labels, self.items_profiles)
+
+    def candidatesProfilesDict(self):
+        return ProfilesView(self.candidatesNames(), self.candidates_index, self.labels, self.candidates_profiles)
+
+    # users_profiles of CB.createUsersProfiles (contentBased)
+    def usersProfilesDict(self):
+        return ProfilesView(self.users.names, self.users.index, self.labels, self.users_profiles)
+
+    # items_user_saw of CB.contentBased
+    def itemsUserSaw(self, user_name):
+        (item_ids, scores) = self.history(self.users.index[user_name])
+        return self.items.namesOf(item_ids)
+
+    def candidatesNames(self):
+        return self.items.namesOf(self.candidates)
+
+    # Bytes held by the arrays of the catalog (not counting the name lists)
+    def nbytes(self):
+        arrays = [self.items_profiles, self.users_profiles, self.candidates, self.candidates_profiles]
+        for matrix in (self.rating_store.users_to_items, self.rating_store.items_to_users):
+            arrays += [matrix.data, matrix.indices, matrix.indptr]
+        return sum(array.nbytes for array in arrays)
+
+
+# Create a catalog from a model_artifacts.RecommenderModel
+# The programs are the watched programs of the rating store followed by the candidates nobody has watched yet;
+# a candidate that has been watched keeps the ID it has in the rating store.
+def createInternedCatalog(model, dtype=np.float32):
+
+    store = model.rating_store
+    users = IdMap(store.users_names)
+    items = IdMap(store.items_names)
+    labels = IdMap(model.labels_names)
+    candidates = items.internMany(model.candidates_names)
+
+    # Portraits: one column per distinct label name (a label listed twice keeps its first column)
+    columns = np.array([model.labels_names.index(name) for name in labels.names], dtype=np.int64)
+    items_profiles = np.zeros((len(items), len(labels)), dtype=dtype)
+    items_profiles[:len(store.items_names)] = np.asarray(model.items_profiles)[:, columns]
+    new = candidates >= len(store.items_names)
+    candidates_profiles = np.asarray(model.candidates_profiles)[:, columns]
+    items_profiles[candidates[new]] = candidates_profiles[new]
+
+    ratings = sparse.csr_matrix(store.users_to_items)
+    ratings = sparse.csr_matrix((ratings.data, ratings.indices, ratings.indptr), shape=(len(users), len(items)))
+
+    return InternedCatalog(users, items, labels, ratings, items_profiles, candidates, candidates_profiles, dtype)
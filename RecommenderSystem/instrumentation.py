@@ -0,0 +1,139 @@
+# Code description:
+# Optional instrumentation of the recommender hot paths: per-stage timers and work counters
+# Off by default. enable() (or the environment variable RECOMMENDER_INSTRUMENTATION=1) turns it on; while it is off a timed
+# function costs one flag test per call and a counter update is skipped behind "if instrumentation.enabled:" at the call site,
+# so the hot loops do not pay for it.
+# Stages: timers[name] = [calls, total seconds, longest call in seconds]
+# Counters: counters[name] = amount of work done (user pairs compared, co-rated programs visited, candidates scored, ...)
+# The figures are available through snapshot(), as JSON (dumpJSON) or in the Prometheus text format (dumpPrometheus).
+
+import functools
+import json
+import os
+import re
+import time
+
+enabled = os.environ.get('RECOMMENDER_INSTRUMENTATION', '') not in ('', '0')
+
+timers = {}
+counters = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    timers.clear()
+    counters.clear()
+
+
+def count(name, amount=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def addTime(name, seconds):
+    timer = timers.get(name)
+    if timer is None:
+        timers[name] = [1, seconds, seconds]
+    else:
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+# Context manager timing one stage: with instrumentation.stage('usercf.neighbor_discovery'): ...
+class StageTimer:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        addTime(self.name, time.perf_counter() - self.started)
+        return False
+
+
+# Shared do-nothing context manager returned while instrumentation is off
+class NoTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_TIMER = NoTimer()
+
+
+def stage(name):
+    return StageTimer(name) if enabled else NO_TIMER
+
+
+# Decorator timing every call of a function as the stage name
+def timed(name):
+
+    def decorate(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                addTime(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorate
+
+
+# Copy of the current figures: {'stages': {name: {'calls', 'seconds', 'max_seconds'}}, 'counters': {name: value}}
+def snapshot():
+    return {'stages': {name: {'calls': timers[name][0], 'seconds': timers[name][1], 'max_seconds': timers[name][2]} for name in timers},
+            'counters': dict(counters)}
+
+
+def dumpJSON(path=None):
+
+    text = json.dumps(snapshot(), indent=2)
+    if path is not None:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    return text
+
+
+def metricName(prefix, name):
+    return prefix + '_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+# Prometheus text exposition format: one counter per work counter, and calls / seconds / longest call per stage
+def dumpPrometheus(prefix='recommender'):
+
+    lines = []
+    for name in sorted(counters):
+        metric = metricName(prefix, name) + '_total'
+        lines += ['# TYPE %s counter' % metric, '%s %s' % (metric, counters[name])]
+
+    # Every metric family is written as one contiguous block
+    families = (('stage_calls_total', 'counter', 0, '%d'), ('stage_seconds_total', 'counter', 1, '%.9f'), ('stage_max_seconds', 'gauge', 2, '%.9f'))
+    for (family, metric_type, position, value_format) in families:
+        if timers:
+            lines.append('# TYPE %s_%s %s' % (prefix, family, metric_type))
+        for name in sorted(timers):
+            lines.append(('%s_%s{stage="%s"} ' + value_format) % (prefix, family, name, timers[name][position]))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,172 @@
+# Code description:
+# Filtering layer for recommendation candidates, keyed by integer program positions (0 .. items_num-1)
+# Replaces the membership tests against Python lists in contentBased / userCF ("not in items_user_saw",
+# "in all_items_names_to_be_recommend") with boolean masks that are applied to a whole block of scores at once:
+# - per-user seen bitmaps, built from a CSR-style index of the programs every user has watched
+# - a global candidate bitmap (whitelist)
+# - composable business filters: blocked programs, expiry times, or any named mask / function of the current time
+# Listeners added with addListener are called after every change (e.g. to invalidate cached results), including when the
+# clock passes an expiry time (checkExpiry, called on every mask and by the service before it reads its cache).
+
+import time
+
+import numpy as np
+
+
+# Row access to a CSR index structure in the format of CB.createSeenItems (seen_items[i] = program positions of user i)
+class SeenItems:
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+
+# Seen bitmaps of a block of users
+# Parameter Description:
+# seen_items: seen_items[i] = positions user i has watched (list of arrays, SeenItems, ...)
+# rows: users of the block
+# Returns a len(rows) x items_num boolean matrix, True where the user has watched the program
+def createSeenMask(seen_items, rows, items_num):
+
+    mask = np.zeros((len(rows), items_num), dtype=bool)
+    if len(rows) == 0:
+        return mask
+
+    seen = [np.asarray(seen_items[i], dtype=np.int64) for i in rows]
+    lengths = [len(positions) for positions in seen]
+    mask[np.repeat(np.arange(len(rows)), lengths), np.concatenate(seen)] = True
+
+    return mask
+
+
+# Composable candidate filters
+# Parameter Description:
+# items_num: size of the program position space the scores are computed over
+# seen_items: optional per-user seen index, see createSeenMask
+# candidates: optional positions (or boolean mask) of the programs that may be recommended at all
+class ItemFilters:
+
+    def __init__(self, items_num, seen_items=None, candidates=None):
+        self.items_num = items_num
+        self.seen_items = seen_items
+        self.candidates = None
+        self.blocked = np.zeros(items_num, dtype=bool)
+        self.expiry_times = None
+        # Earliest expiry time still in the future when it was last checked, None if there is none
+        self.next_expiry = None
+        self.filters = {}
+        self.global_mask = None
+        self.listeners = []
+        if candidates is not None:
+            self.setCandidates(candidates)
+
+    # function() is called after every change of the filters or of the seen index
+    def addListener(self, function):
+        self.listeners.append(function)
+
+    # A filter has changed: drop the cached global mask and tell the listeners
+    def changed(self):
+        self.global_mask = None
+        for function in self.listeners:
+            function()
+
+    def toMask(self, positions):
+        positions = np.asarray(positions)
+        if positions.dtype == bool:
+            return positions.copy()
+        mask = np.zeros(self.items_num, dtype=bool)
+        mask[positions.astype(np.int64)] = True
+        return mask
+
+    def setSeenItems(self, seen_items):
+        self.seen_items = seen_items
+        self.changed()
+
+    # Only these programs may be recommended; None removes the whitelist
+    def setCandidates(self, candidates):
+        self.candidates = None if candidates is None else self.toMask(candidates)
+        self.changed()
+
+    def block(self, positions):
+        self.blocked |= self.toMask(positions)
+        self.changed()
+
+    def unblock(self, positions):
+        self.blocked &= ~self.toMask(positions)
+        self.changed()
+
+    # expiry_times[j]: time (seconds since the epoch) after which program j may no longer be recommended, inf for never
+    def setExpiryTimes(self, expiry_times):
+        self.expiry_times = None if expiry_times is None else np.asarray(expiry_times, dtype=np.float64)
+        # Whatever clock the callers use, the first check moves next_expiry past the times already gone
+        self.next_expiry = self.nextExpiry(-np.inf)
+        self.changed()
+
+    # Earliest expiry time after now, None if no program expires after now
+    def nextExpiry(self, now):
+        if self.expiry_times is None:
+            return None
+        future = self.expiry_times[(self.expiry_times > now) & np.isfinite(self.expiry_times)]
+        return float(future.min()) if len(future) > 0 else None
+
+    # Tell the listeners when programs have expired since the last check: results computed before still recommend them
+    # Costs one comparison unless an expiry time has been passed. Returns True if programs have expired.
+    def checkExpiry(self, now=None):
+        now = time.time() if now is None else now
+        if self.next_expiry is None or now < self.next_expiry:
+            return False
+        self.next_expiry = self.nextExpiry(now)
+        self.changed()
+        return True
+
+    # Add a named business filter: a boolean mask of allowed programs, or a function now -> boolean mask
+    def addFilter(self, name, allowed):
+        self.filters[name] = allowed
+        self.changed()
+
+    def removeFilter(self, name):
+        self.filters.pop(name, None)
+        self.changed()
+
+    # Programs allowed for every user at time now; cached until a filter changes (filters that depend on the time are re-evaluated)
+    def globalMask(self, now=None):
+
+        now = time.time() if now is None else now
+        self.checkExpiry(now)
+        if self.global_mask is None:
+            mask = ~self.blocked
+            if self.candidates is not None:
+                mask &= self.candidates
+            for name in self.filters:
+                if not callable(self.filters[name]):
+                    mask &= np.asarray(self.filters[name], dtype=bool)
+            self.global_mask = mask
+
+        mask = self.global_mask
+        if self.expiry_times is not None:
+            mask = mask & (self.expiry_times > now)
+        for name in self.filters:
+            if callable(self.filters[name]):
+                mask = mask & np.asarray(self.filters[name](now), dtype=bool)
+
+        return mask
+
+    # Programs allowed for each user of a block: global filters and not seen by that user
+    def allowedMask(self, rows, now=None):
+
+        allowed = np.broadcast_to(self.globalMask(now), (len(rows), self.items_num))
+        if self.seen_items is None:
+            return allowed.copy()
+
+        return allowed & ~createSeenMask(self.seen_items, rows, self.items_num)
+
+    # Set the scores of programs that are not allowed to -inf (in place) and return them
+    def apply(self, scores, rows, now=None):
+        scores[~self.allowedMask(rows, now)] = -np.inf
+        return scores
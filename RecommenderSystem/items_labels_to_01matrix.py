@@ -1,69 +1,41 @@
 # Code description:
-# Generate "D:\Recommender Systems\Alternate recommended program collections and their types.xlsx" based on "D:\Recommender Systems\Alternate recommended program collections and their types.xlsx"
+# Generate "Alternative recommended program collection and type 01 matrix.xlsx" based on "Alternative recommended program collections and their categories.xlsx"
+# The labels are encoded with label_vocabulary.py: labels missing from the vocabulary are reported and added as new columns.
+# The vocabulary is shared with items_saw_labels_to_01matrix.py through "labels vocabulary.json" so that both 01 matrices
+# have the same columns.
+# Usage: python items_labels_to_01matrix.py [output .xlsx/.csv/.npz] [data directory]
 
-import pandas as pd
-import numpy as np
+import os
+import sys
 
-if __name__ == '__main__':
+import pandas as pd
 
-    df = pd.read_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Alternative recommended program collections and their categories.xlsx")
-    (m, n) = df.shape
+from label_vocabulary import LabelVocabulary, loadLabelVocabulary, saveLabelsMatrix
 
-    data_array = np.array(df.iloc[0:m+1,:])
-    print(data_array)
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+VOCABULARY_FILE = 'labels vocabulary.json'
 
-    # All tags in the specified order
-    all_labels = ['education', 'drama', 'suspense', 'sci-fi', 'thriller', 'action', 'information', 'martialarts', 'drama', 'police', 'life', 'military', 'romance', 'sports', 'adventure', 'documentary', 'children education', 'kids', 'varietyshow', 'costume', 'plot', 'funny', 'advertisement', 'comedy', 'physical', 'lanka', 'india']
-    labels_num = len(all_labels)
+if __name__ == '__main__':
 
-    # Extract the names of all programs in order
-    all_items_names = np.array(df.iloc[:m+1, 0])
-    print(all_items_names)
+    data_dir = sys.argv[2] if len(sys.argv) > 2 else DATA_DIR
+    output_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(data_dir, "Alternative recommended program collection and type 01 matrix.xlsx")
+    vocabulary_path = os.path.join(data_dir, VOCABULARY_FILE)
 
-    #Create a 01 matrix, 0 means that the program does not belong to this type, 1 means that the program belongs to this type
-    data_to_be_written = []
+    df = pd.read_excel(os.path.join(data_dir, "Alternative recommended program collections and their categories.xlsx"))
 
-    for i in range(len(all_items_names)):
+    # All tags in the specified order, grown by the labels met so far
+    vocabulary = loadLabelVocabulary(vocabulary_path) if os.path.exists(vocabulary_path) else LabelVocabulary()
 
-        #01 row vector for each program
-        vector = [0] * labels_num
-        labels_names = str(data_array[i][1]).split(" ")
+    # Extract the names of all programs in order
+    all_items_names = df.iloc[:, 0].astype(str).tolist()
 
-        for j in range(len(labels_names)):
-            location = all_labels.index(labels_names[j].lower())
-            vector[location] = 1
+    # Create a 01 matrix, 0 means that the program does not belong to this type, 1 means that the program belongs to this type
+    matrix = vocabulary.encode(df.iloc[:, 1])
 
-        data_to_be_written.append(vector)
+    for name in vocabulary.unknown_labels:
+        print("New label %s (%d programs)" % (name, vocabulary.unknown_labels[name]))
+    vocabulary.save(vocabulary_path)
 
     # Write the 01 matrix into the "alternative recommended program collection and type 01 matrix"
-    df = pd.DataFrame(data_to_be_written, index=all_items_names, columns=all_labels)
-    df.to_excel(r"C:\Users\CodeMad\Documents\GitHub\RecommenderSystem\data\Alternative recommended program collection and type 01 matrix.xlsx")
-
-    # PS: Remember to type "Program Name" in the first blank cell of the program name column in the generated "Alternate Recommended Program Sets and Type 01 Matrix Table"
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    saveLabelsMatrix(output_path, matrix, all_items_names, vocabulary.labels_names)
+    print("%d programs x %d labels written to %s" % (matrix.shape[0], matrix.shape[1], output_path))
@@ -0,0 +1,133 @@
+# Code description:
+# Label-inverted index over the alternative recommended program set for content-based retrieval
+# Program portraits are sparse multi-hot label vectors, and a program that shares none of the labels a user likes
+# (positive weight in the user portrait) cannot have a positive similarity to him. The index keeps a posting list
+# label -> programs together with the largest normalized weight in every list (the label's score upper bound, as in WAND).
+# A query walks the posting lists of the user's positive labels from the most to the least promising, scores only the
+# programs it meets, and stops as soon as the upper bound of every program not met yet is below the current N-th best
+# score. The result is the top-N of CB.contentBasedBatch up to floating point rounding: the scores are computed in another
+# order, so programs whose scores are equal up to rounding may come in another order (or swap across the N-th place).
+# max_labels turns it into an approximate search that only looks at the user's strongest labels.
+# hybrid_fusion.HybridRecommender uses the index for CB when it is given one (recommender.py --label-index).
+
+import numpy as np
+from scipy import sparse
+
+from CB import selectTopN
+
+
+# Parameter Description:
+# items_profiles_matrix: portraits of the candidate programs, candidates x labels (e.g. RecommenderModel.candidates_profiles)
+class LabelIndex:
+
+    def __init__(self, items_profiles_matrix):
+
+        self.items_profiles = np.asarray(items_profiles_matrix, dtype=np.float64)
+        (self.items_num, self.labels_num) = self.items_profiles.shape
+
+        # sigma_i of calCosDistance for every program
+        self.sigma_items = np.einsum('ij,ij->i', self.items_profiles, self.items_profiles)
+        norms = np.sqrt(self.sigma_items)
+        normalized = np.divide(self.items_profiles, norms[:, np.newaxis], out=np.zeros_like(self.items_profiles), where=norms[:, np.newaxis] > 0)
+
+        # Posting lists: column l of the CSC matrix lists the programs with label l and their normalized weights
+        self.postings = sparse.csc_matrix(np.where(normalized > 0, normalized, 0.0))
+        self.postings.sort_indices()
+        self.upper_bounds = np.zeros(self.labels_num)
+        for l in range(self.labels_num):
+            weights = self.postings.data[self.postings.indptr[l]:self.postings.indptr[l + 1]]
+            if len(weights) > 0:
+                self.upper_bounds[l] = weights.max()
+
+    # Programs with label l
+    def postingList(self, l):
+        return self.postings.indices[self.postings.indptr[l]:self.postings.indptr[l + 1]]
+
+    # Exact similarity between one user portrait and some programs, same formula as CB.calCosDistance
+    def scoreItems(self, user_profile, sigma_u, items):
+        sigma_ui = self.items_profiles[items] @ user_profile
+        denominator = np.sqrt(sigma_u * self.sigma_items[items])
+        return np.divide(sigma_ui, denominator, out=np.zeros_like(sigma_ui), where=denominator > 0)
+
+    # Score the whole catalog, used when the user has too few programs with a positive similarity
+    def scoreAll(self, user_profile, sigma_u, N, excluded):
+        scores = self.scoreItems(user_profile, sigma_u, np.arange(self.items_num))
+        scores[excluded] = -np.inf
+        return selectTopN(scores[np.newaxis, :], N)
+
+    # Top-N programs for one user
+    # Parameter Description:
+    # user_profile: the user portrait, one weight per label
+    # seen: optional positions of programs the user has already watched
+    # allowed: optional boolean mask of the programs that may be recommended (e.g. a row of ItemFilters.allowedMask)
+    # max_labels: None for the exact top-N, otherwise only the posting lists of the max_labels most promising labels are read
+    #             and only the programs met there are returned (possibly fewer than N)
+    # Returns (top_indices, top_scores), arrays of length N as one row of CB.selectTopN
+    def search(self, user_profile, N, seen=None, max_labels=None, allowed=None):
+
+        user_profile = np.asarray(user_profile, dtype=np.float64)
+        sigma_u = float(user_profile @ user_profile)
+
+        excluded = np.zeros(self.items_num, dtype=bool)
+        if seen is not None:
+            excluded[seen] = True
+        if allowed is not None:
+            excluded |= ~np.asarray(allowed, dtype=bool)
+
+        # Positive labels ordered by how much they can add to a similarity
+        contributions = np.where(user_profile > 0, user_profile * self.upper_bounds, 0.0)
+        labels = np.nonzero(contributions > 0)[0]
+        labels = labels[np.argsort(-contributions[labels], kind='stable')]
+        if max_labels is not None:
+            labels = labels[:max_labels]
+        # remaining[t] = what the labels after position t can add at most, divided by |user|
+        remaining = np.append(np.cumsum(contributions[labels][::-1])[::-1][1:], 0.0) / np.sqrt(sigma_u) if len(labels) > 0 else np.zeros(0)
+
+        met = np.zeros(self.items_num, dtype=bool)
+        items = np.zeros(0, dtype=np.int64)
+        scores = np.zeros(0)
+        complete = False
+
+        for t in range(len(labels)):
+            new_items = self.postingList(labels[t])
+            new_items = new_items[~met[new_items] & ~excluded[new_items]]
+            met[new_items] = True
+            if len(new_items) > 0:
+                items = np.concatenate([items, new_items])
+                scores = np.concatenate([scores, self.scoreItems(user_profile, sigma_u, new_items)])
+
+            # A program not met yet scores at most remaining[t]; stop once N met programs score strictly more
+            if len(items) >= N and N > 0:
+                threshold = np.partition(scores, len(scores) - N)[len(scores) - N]
+                if threshold > remaining[t]:
+                    complete = True
+                    break
+
+        if not complete and max_labels is None:
+            # All positive labels were read: every program not met scores <= 0, so the met ones are exact as long as
+            # N of them are positive; otherwise the top-N includes zero or negative scores and the whole catalog is scored
+            if np.count_nonzero(scores > 0) < N:
+                (top_indices, top_scores) = self.scoreAll(user_profile, sigma_u, N, excluded)
+                return (top_indices[0], top_scores[0])
+
+        # Put the met programs back at their catalog positions so that exact ties go to the earlier program, as in selectTopN
+        order = np.argsort(items)
+        (top, top_scores) = selectTopN(scores[order][np.newaxis, :], N)
+        top_indices = np.full(N, -1, dtype=np.int64)
+        top_indices[top[0] >= 0] = items[order][top[0][top[0] >= 0]]
+
+        return (top_indices, top_scores[0])
+
+    # Top-N for many users, result in the format of CB.contentBasedBatch
+    # allowed_mask: optional users x programs boolean mask of the programs that may be recommended to each user
+    def searchBatch(self, users_profiles_matrix, N, seen_items=None, max_labels=None, allowed_mask=None):
+
+        users_num = len(users_profiles_matrix)
+        top_indices = np.full((users_num, N), -1, dtype=np.int64)
+        top_scores = np.full((users_num, N), -np.inf)
+        for i in range(users_num):
+            seen = None if seen_items is None else seen_items[i]
+            allowed = None if allowed_mask is None else allowed_mask[i]
+            (top_indices[i], top_scores[i]) = self.search(users_profiles_matrix[i], N, seen, max_labels, allowed)
+
+        return (top_indices, top_scores)
@@ -0,0 +1,119 @@
+# Code description:
+# Label vocabulary and vectorized multi-hot (01) encoding of program labels
+# A program's labels are one space-separated string ("sci-fi adventure action"). The vocabulary maps every label to its
+# column through a dict, and encode() turns a whole column of label strings into a sparse 01 matrix with pandas string
+# operations instead of looking every label up with all_labels.index(...) row by row:
+# - a label listed twice in the vocabulary (the old list had 'drama' twice) gets one column
+# - a label that is not in the vocabulary is counted in unknown_labels and, if the vocabulary may grow, gets a new column
+#   appended at the end instead of stopping the whole run
+
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# All tags in the order the 01 matrices were generated with so far
+ALL_LABELS = ['education', 'drama', 'suspense', 'sci-fi', 'thriller', 'action', 'information', 'martialarts', 'drama', 'police', 'life', 'military',
+              'romance', 'sports', 'adventure', 'documentary', 'children education', 'kids', 'varietyshow', 'costume', 'plot', 'funny',
+              'advertisement', 'comedy', 'physical', 'lanka', 'india']
+
+
+def normalizeLabel(name):
+    return str(name).strip().lower()
+
+
+# Parameter Description:
+# labels_names: initial labels in column order, duplicates are kept once
+# grow: True to append unknown labels to the vocabulary, False to only report them
+class LabelVocabulary:
+
+    def __init__(self, labels_names=ALL_LABELS, grow=True):
+        self.labels_names = []
+        self.labels_index = {}
+        self.grow = grow
+        # Labels that were not in the vocabulary when they were first encoded: {label: number of occurrences}
+        self.unknown_labels = {}
+        for name in labels_names:
+            self.addLabel(name)
+
+    def __len__(self):
+        return len(self.labels_names)
+
+    def __contains__(self, name):
+        return normalizeLabel(name) in self.labels_index
+
+    # Column of a label, adding it at the end if it is new
+    def addLabel(self, name):
+        name = normalizeLabel(name)
+        if name not in self.labels_index:
+            self.labels_index[name] = len(self.labels_names)
+            self.labels_names.append(name)
+        return self.labels_index[name]
+
+    # Encode a column of label strings
+    # Parameter Description:
+    # labels_column: one label string per program (list, array or Series); missing values mean no labels
+    # separator: None splits on any whitespace
+    # Returns a CSR 01 matrix (int8), one row per program and one column per label of the vocabulary after encoding
+    def encode(self, labels_column, separator=None):
+
+        labels = pd.Series(np.asarray(labels_column, dtype=object)).fillna('').astype(str).str.lower().str.split(separator).explode()
+        labels = labels[labels.notna() & (labels != '')]
+        rows = labels.index.to_numpy(dtype=np.int64)
+
+        # Only the distinct labels go through the dict, every occurrence is then mapped with an array lookup
+        (codes, uniques) = pd.factorize(labels.to_numpy())
+        uniques_columns = np.array([self.labels_index.get(name, -1) for name in uniques], dtype=np.int64)
+
+        unknown = np.nonzero(uniques_columns < 0)[0]
+        if len(unknown) > 0:
+            counts = np.bincount(codes, minlength=len(uniques))
+            for u in unknown:
+                self.unknown_labels[uniques[u]] = self.unknown_labels.get(uniques[u], 0) + int(counts[u])
+                if self.grow:
+                    uniques_columns[u] = self.addLabel(uniques[u])
+
+        columns = uniques_columns[codes] if len(codes) > 0 else np.zeros(0, dtype=np.int64)
+        known = columns >= 0
+        matrix = sparse.coo_matrix((np.ones(np.count_nonzero(known), dtype=np.int8), (rows[known], columns[known])),
+                                   shape=(len(labels_column), len(self.labels_names))).tocsr()
+        # A label listed twice for one program is still a 0/1 entry
+        matrix.data[:] = 1
+
+        return matrix
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'labels': self.labels_names}, f, ensure_ascii=False)
+
+
+def loadLabelVocabulary(path, grow=True):
+    with open(path, encoding='utf-8') as f:
+        return LabelVocabulary(json.load(f)['labels'], grow)
+
+
+# Write a 01 matrix with its program and label names
+# .npz keeps it sparse (see loadLabelsMatrix), .csv and .xlsx write the table the Excel-based scripts read,
+# with "Program name" in the header of the program name column
+def saveLabelsMatrix(path, matrix, items_names, labels_names):
+
+    matrix = sparse.csr_matrix(matrix)
+    if path.endswith('.npz'):
+        np.savez(path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.array(matrix.shape),
+                 items_names=np.array([str(name) for name in items_names], dtype=str), labels_names=np.array(labels_names, dtype=str))
+        return
+
+    df = pd.DataFrame(matrix.toarray(), index=pd.Index(items_names, name='Program name'), columns=labels_names)
+    if path.endswith('.csv'):
+        df.to_csv(path)
+    else:
+        df.to_excel(path)
+
+
+# Returns (matrix, items_names, labels_names) of a matrix written by saveLabelsMatrix as .npz
+def loadLabelsMatrix(path):
+
+    with np.load(path) as f:
+        matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return (matrix, f['items_names'].tolist(), f['labels_names'].tolist())
@@ -0,0 +1,86 @@
+# Code description:
+# Local load generator for recommend_service.py
+# Opens a number of concurrent keep-alive connections, sends /recommend requests for random users for a fixed duration
+# and reports throughput and p50/p90/p99 latency per response status.
+# Usage: python load_generator.py [port] [concurrency] [duration in seconds] [method] [n]
+
+import asyncio
+import json
+import random
+import sys
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+
+# Send one GET request on an open connection, returns (status, body)
+async def httpGet(reader, writer, path):
+
+    writer.write(('GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n' % path).encode('latin-1'))
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        (name, separator, value) = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+
+    return (status, await reader.readexactly(length))
+
+
+# One client: sends requests back to back until the deadline and records (status, latency in seconds) pairs
+async def runClient(host, port, users_names, method, N, deadline, samples):
+
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            path = '/recommend?user=%s&method=%s&n=%d' % (quote(random.choice(users_names)), method, N)
+            started = time.perf_counter()
+            (status, body) = await httpGet(reader, writer, path)
+            samples.append((status, time.perf_counter() - started))
+    finally:
+        writer.close()
+
+
+# Run the load and return the summary, e.g. {'requests': 10000, 'throughput': 2500.0, 'status': {200: {'count': ..., 'p50_ms': ...}}}
+async def runLoad(host='127.0.0.1', port=8080, concurrency=64, duration=10.0, method='hybrid', N=5):
+
+    (reader, writer) = await asyncio.open_connection(host, port)
+    (status, body) = await httpGet(reader, writer, '/users?limit=100000')
+    writer.close()
+    users_names = json.loads(body)['users']
+
+    samples = []
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*[runClient(host, port, users_names, method, N, deadline, samples) for k in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    summary = {'requests': len(samples), 'seconds': elapsed, 'throughput': len(samples) / elapsed, 'status': {}}
+    for code in sorted(set(status for (status, latency) in samples)):
+        latencies = np.array([latency for (status, latency) in samples if status == code]) * 1000.0
+        summary['status'][code] = {'count': len(latencies), 'p50_ms': float(np.percentile(latencies, 50)),
+                                   'p90_ms': float(np.percentile(latencies, 90)), 'p99_ms': float(np.percentile(latencies, 99))}
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10.0
+    method = sys.argv[4] if len(sys.argv) > 4 else 'hybrid'
+    N = int(sys.argv[5]) if len(sys.argv) > 5 else 5
+
+    summary = asyncio.run(runLoad('127.0.0.1', port, concurrency, duration, method, N))
+
+    print("%d requests in %.1fs, %.1f requests/s" % (summary['requests'], summary['seconds'], summary['throughput']))
+    for code in summary['status']:
+        result = summary['status'][code]
+        print("status %d: %d responses, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms" % (code, result['count'], result['p50_ms'], result['p90_ms'], result['p99_ms']))
@@ -0,0 +1,239 @@
+# Code description:
+# Compiled, memory-mappable model artifacts
+# All entry points used to start with several pd.read_excel calls and rebuild every portrait before recommending anything.
+# The compile step below does that work once and writes the result as plain .npy files plus a manifest.json;
+# loadModel opens them with np.load(mmap_mode='r'), so nothing is parsed or copied at startup and all worker
+# processes on one host share the same pages of the page cache.
+# Usage: python model_artifacts.py <data directory with the Excel files> <output directory>
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+from CB import createItemsProfilesMatrix, alignItemsProfilesMatrix, createUsersProfilesMatrix, createSeenItems
+from rating_store import RatingStore, createRatingStoreFromDataFrame
+
+MODEL_FORMAT = 'recommender-model'
+MODEL_FORMAT_VERSION = 1
+
+# File names of the Excel inputs inside the data directory
+RATINGS_FILE = "Rating matrix of all users for the programs they have watched.xlsx"
+WATCHED_ITEMS_LABELS_FILE = "01 matrix of all programs watched by users and their categories.xlsx"
+CANDIDATES_LABELS_FILE = "Alternative recommended program collection and type 01 matrix.xlsx"
+
+
+# Everything the recommenders need, built once
+# Parameter Description:
+# labels_names: label names in column order of all portrait matrices
+# rating_store: RatingStore of the implicit ratings (users x watched programs)
+# items_profiles: portraits of the watched programs, rows in the column order of rating_store (items x labels)
+# users_profiles: user portraits, rows in the row order of rating_store (users x labels)
+# candidates_names / candidates_profiles: the alternative recommended program set and its portraits (candidates x labels)
+# seen_candidates: CSR users x candidates, row i lists the candidates user i has already watched
+class RecommenderModel:
+
+    def __init__(self, labels_names, rating_store, items_profiles, users_profiles, candidates_names, candidates_profiles, seen_candidates):
+        self.labels_names = list(labels_names)
+        self.rating_store = rating_store
+        self.items_profiles = items_profiles
+        self.users_profiles = users_profiles
+        self.candidates_names = list(candidates_names)
+        self.candidates_index = {name: j for j, name in enumerate(self.candidates_names)}
+        self.candidates_profiles = candidates_profiles
+        self.seen_candidates = seen_candidates
+
+    @property
+    def users_names(self):
+        return self.rating_store.users_names
+
+    # Candidate positions user i has already watched
+    def seenItems(self, i):
+        return self.seen_candidates.indices[self.seen_candidates.indptr[i]:self.seen_candidates.indptr[i + 1]]
+
+    # seen_items in the format of CB.createSeenItems, one array (view, not copy) per user
+    def seenItemsList(self):
+        return [self.seenItems(i) for i in range(self.seen_candidates.shape[0])]
+
+
+# Build a model from a rating store and program portraits
+# Parameter Description:
+# items_profiles: portraits of the programs of rating_store, rows in its column order
+# candidates_profiles: portraits of the candidates, same label columns as items_profiles
+def buildModel(labels_names, rating_store, items_profiles, candidates_names, candidates_profiles):
+
+    items_profiles = np.ascontiguousarray(items_profiles, dtype=np.float64)
+    candidates_profiles = np.ascontiguousarray(candidates_profiles, dtype=np.float64)
+    users_profiles = createUsersProfilesMatrix(rating_store.users_to_items, items_profiles)
+
+    seen_items = createSeenItems(rating_store.users_to_items, rating_store.items_names, candidates_names)
+    indptr = np.zeros(len(seen_items) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(seen) for seen in seen_items])
+    indices = np.concatenate(seen_items) if seen_items else np.zeros(0, dtype=np.int64)
+    seen_candidates = sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                                        shape=(len(seen_items), len(candidates_names)))
+
+    return RecommenderModel(labels_names, rating_store, items_profiles, users_profiles, candidates_names, candidates_profiles, seen_candidates)
+
+
+# Build a model from the three Excel files used by CB.py and UserCF.py
+# Label names are taken from the header of the candidates' 01 matrix; labels only the watched programs' 01 matrix has
+# (a vocabulary that grew between the two runs of the 01-matrix scripts) are appended, and both matrices are aligned by label name.
+def buildModelFromExcel(data_dir):
+
+    # pandas is only needed (and only imported) when a model is built from the Excel files
+    import pandas as pd
+
+    with instrumentation.stage('load.excel'):
+        df1 = pd.read_excel(os.path.join(data_dir, RATINGS_FILE))
+    rating_store = createRatingStoreFromDataFrame(df1)
+
+    with instrumentation.stage('load.excel'):
+        df3 = pd.read_excel(os.path.join(data_dir, CANDIDATES_LABELS_FILE))
+    (m3, n3) = df3.shape
+    candidates_names = np.array(df3.iloc[:m3 + 1, 0]).tolist()
+    candidates_labels = df3.iloc[:m3 + 1, 1:].rename(columns=str)
+
+    with instrumentation.stage('load.excel'):
+        df2 = pd.read_excel(os.path.join(data_dir, WATCHED_ITEMS_LABELS_FILE))
+    (m2, n2) = df2.shape
+    items_users_saw_names = np.array(df2.iloc[:m2 + 1, 0]).tolist()
+    items_labels = df2.iloc[:m2 + 1, 1:].rename(columns=str)
+
+    labels_names = candidates_labels.columns.tolist()
+    labels_names += [name for name in items_labels.columns if name not in set(labels_names)]
+    candidates_profiles = createItemsProfilesMatrix(candidates_labels.reindex(columns=labels_names, fill_value=0))
+    items_profiles = alignItemsProfilesMatrix(createItemsProfilesMatrix(items_labels.reindex(columns=labels_names, fill_value=0)),
+                                              items_users_saw_names, rating_store.items_names)
+
+    return buildModel(labels_names, rating_store, items_profiles, candidates_names, candidates_profiles)
+
+
+# Build a model from the output directory of watch_logs_to_matrices.py
+# The logs have no separate alternative recommended program set: every program of the logs is a candidate.
+def buildModelFromIngested(ingested_dir):
+
+    with open(os.path.join(ingested_dir, 'ids.json'), encoding='utf-8') as f:
+        ids = json.load(f)
+    rating_store = RatingStore(ids['users'], ids['items'], sparse.load_npz(os.path.join(ingested_dir, 'ratings.npz')))
+    items_profiles = createItemsProfilesMatrix(sparse.load_npz(os.path.join(ingested_dir, 'items_labels.npz')).toarray())
+
+    return buildModel(ids['labels'], rating_store, items_profiles, ids['items'], items_profiles)
+
+
+# Index arrays of a sparse matrix are written as int32 when they fit, which is what scipy uses, so loading never has to convert them
+def indexArrays(matrix):
+    if matrix.nnz < np.iinfo(np.int32).max and max(matrix.shape) < np.iinfo(np.int32).max:
+        return (matrix.indices.astype(np.int32), matrix.indptr.astype(np.int32))
+    return (matrix.indices.astype(np.int64), matrix.indptr.astype(np.int64))
+
+
+def namesArray(names):
+    return np.array([str(name) for name in names], dtype=str)
+
+
+# Write a model to output_dir as .npy files plus manifest.json
+# The files are written to a temporary directory first and swapped in at the end, so readers never see a half-written model.
+def saveModel(model, output_dir):
+
+    store = model.rating_store
+    (ratings_indices, ratings_indptr) = indexArrays(store.users_to_items)
+    (ratings_csc_indices, ratings_csc_indptr) = indexArrays(store.items_to_users)
+    (seen_indices, seen_indptr) = indexArrays(model.seen_candidates)
+    arrays = {
+        'labels_names': namesArray(model.labels_names),
+        'users_names': namesArray(store.users_names),
+        'items_names': namesArray(store.items_names),
+        'candidates_names': namesArray(model.candidates_names),
+        'items_profiles': np.asarray(model.items_profiles, dtype=np.float64),
+        'users_profiles': np.asarray(model.users_profiles, dtype=np.float64),
+        'candidates_profiles': np.asarray(model.candidates_profiles, dtype=np.float64),
+        'ratings_data': store.users_to_items.data,
+        'ratings_indices': ratings_indices,
+        'ratings_indptr': ratings_indptr,
+        'ratings_csc_data': store.items_to_users.data,
+        'ratings_csc_indices': ratings_csc_indices,
+        'ratings_csc_indptr': ratings_csc_indptr,
+        'seen_data': np.asarray(model.seen_candidates.data, dtype=np.int8),
+        'seen_indices': seen_indices,
+        'seen_indptr': seen_indptr,
+    }
+
+    temporary_dir = output_dir.rstrip('/\\') + '.tmp'
+    if os.path.exists(temporary_dir):
+        shutil.rmtree(temporary_dir)
+    os.makedirs(temporary_dir)
+
+    manifest = {'format': MODEL_FORMAT, 'version': MODEL_FORMAT_VERSION,
+                'shape': {'users': len(store.users_names), 'items': len(store.items_names),
+                          'candidates': len(model.candidates_names), 'labels': len(model.labels_names)},
+                'arrays': {}}
+    for name in arrays:
+        np.save(os.path.join(temporary_dir, name + '.npy'), arrays[name], allow_pickle=False)
+        manifest['arrays'][name] = {'file': name + '.npy', 'dtype': arrays[name].dtype.str, 'shape': list(arrays[name].shape)}
+
+    with open(os.path.join(temporary_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(output_dir):
+        old_dir = output_dir.rstrip('/\\') + '.old'
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(output_dir, old_dir)
+        os.rename(temporary_dir, output_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(temporary_dir, output_dir)
+
+
+# Read and check the manifest of a compiled model
+def readManifest(model_dir):
+
+    with open(os.path.join(model_dir, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    if manifest.get('format') != MODEL_FORMAT:
+        raise ValueError("%s is not a compiled recommender model" % model_dir)
+    if manifest.get('version') != MODEL_FORMAT_VERSION:
+        raise ValueError("%s has model format version %s, expected %d" % (model_dir, manifest.get('version'), MODEL_FORMAT_VERSION))
+
+    return manifest
+
+
+# Open a model written by saveModel
+# Parameter Description:
+# mmap: True maps the arrays read-only into memory (zero-copy, shared between processes), False reads them into private memory
+@instrumentation.timed('load.model')
+def loadModel(model_dir, mmap=True):
+
+    manifest = readManifest(model_dir)
+    mmap_mode = 'r' if mmap else None
+
+    arrays = {}
+    for name in manifest['arrays']:
+        arrays[name] = np.load(os.path.join(model_dir, manifest['arrays'][name]['file']), mmap_mode=mmap_mode, allow_pickle=False)
+
+    shape = manifest['shape']
+    users_to_items = sparse.csr_matrix((arrays['ratings_data'], arrays['ratings_indices'], arrays['ratings_indptr']),
+                                       shape=(shape['users'], shape['items']), copy=False)
+    items_to_users = sparse.csc_matrix((arrays['ratings_csc_data'], arrays['ratings_csc_indices'], arrays['ratings_csc_indptr']),
+                                       shape=(shape['users'], shape['items']), copy=False)
+    seen_candidates = sparse.csr_matrix((arrays['seen_data'], arrays['seen_indices'], arrays['seen_indptr']),
+                                        shape=(shape['users'], shape['candidates']), copy=False)
+
+    rating_store = RatingStore(arrays['users_names'].tolist(), arrays['items_names'].tolist(), users_to_items, items_to_users)
+
+    return RecommenderModel(arrays['labels_names'].tolist(), rating_store, arrays['items_profiles'], arrays['users_profiles'],
+                            arrays['candidates_names'].tolist(), arrays['candidates_profiles'], seen_candidates)
+
+
+if __name__ == '__main__':
+
+    (data_dir, output_dir) = sys.argv[1:3]
+
+    saveModel(buildModelFromExcel(data_dir), output_dir)
+    print("Model written to %s" % output_dir)
@@ -0,0 +1,192 @@
+# Code description:
+# Precomputed user-user neighbor table for the user-based collaborative filtering algorithm
+# Stores the top-M neighbors of every user with their similarity, persists to disk and is used by UserCF.userCF
+# instead of findSimilarUsers, and by hybrid_fusion.HybridRecommender instead of the similarity blocks of userCFBatch,
+# when it is given. When watch histories change only the affected rows are recomputed.
+
+import os
+
+import numpy as np
+
+from CB import selectTopN
+from similarity import createPearsonMatrices, calPearsonSimilarityBlock
+
+
+# Neighbor table
+# Parameter Description:
+# users_names: user names in row order (the row order of the RatingStore the table was built from)
+# neighbors: users x M int array of neighbor rows, in descending order of similarity, -1 for unused slots
+# similarities: users x M float array, -inf for unused slots
+# min_overlap / min_similarity: pruning used when the table was built, see UserCF.findSimilarUsers
+class NeighborTable:
+
+    def __init__(self, users_names, neighbors, similarities, min_overlap=1, min_similarity=None):
+        self.users_names = list(users_names)
+        self.users_index = {name: i for i, name in enumerate(self.users_names)}
+        self.neighbors = neighbors
+        self.similarities = similarities
+        self.min_overlap = min_overlap
+        self.min_similarity = min_similarity
+
+    @property
+    def M(self):
+        return self.neighbors.shape[1]
+
+    def __contains__(self, user_name):
+        return user_name in self.users_index
+
+    # Whether the first K columns are the neighbors findSimilarUsers / userCFBatch would find with these pruning rules:
+    # the table must hold K neighbors and have been built with the same rules (a top M cut before pruning is not a top K after it)
+    def compatible(self, K, min_overlap=1, min_similarity=None):
+        return (K is not None and K <= self.M and max(self.min_overlap, 1) == max(min_overlap, 1)
+                and self.min_similarity == min_similarity)
+
+    # The K most similar users of user_name in the format of findSimilarUsers: [[user name, similarity], ...]
+    def similarUsers(self, user_name, K):
+        i = self.users_index[user_name]
+        neighbors_distance = []
+        for k in range(min(K, self.M)):
+            if self.neighbors[i][k] < 0:
+                break
+            neighbors_distance.append([self.users_names[self.neighbors[i][k]], float(self.similarities[i][k])])
+        return neighbors_distance
+
+
+# Raise ValueError unless table holds the users_names in the same row order and can serve the K neighbors of userCFBatch
+# (min_overlap 1, no min_similarity)
+def checkNeighborTable(table, users_names, K):
+
+    if table.users_names != list(users_names):
+        raise ValueError("the neighbor table was built for other users than the model's")
+    if not table.compatible(K):
+        raise ValueError("the neighbor table (M=%d, min_overlap=%s, min_similarity=%s) cannot give the %d neighbors of userCFBatch "
+                         "(min_overlap 1, no min_similarity)" % (table.M, table.min_overlap, table.min_similarity, K))
+
+
+# Keep the neighbors allowed by the pruning rules and select the top M of every row of a similarity block
+def selectNeighbors(similarities, overlaps, rows, M, min_overlap, min_similarity):
+
+    scores = np.where(overlaps >= max(min_overlap, 1), similarities, -np.inf)
+    if min_similarity is not None:
+        scores[scores < min_similarity] = -np.inf
+    # A user is never his own neighbor
+    scores[np.arange(len(rows)), rows] = -np.inf
+
+    return selectTopN(scores, M)
+
+
+# Compute the rows of the given users against all users
+def computeNeighborRows(pearson_matrices, rows, M, min_overlap, min_similarity, block_size):
+
+    neighbors = np.full((len(rows), M), -1, dtype=np.int64)
+    similarities = np.full((len(rows), M), -np.inf, dtype=np.float64)
+
+    for start in range(0, len(rows), block_size):
+        end = min(start + block_size, len(rows))
+        (block_similarities, block_overlaps) = calPearsonSimilarityBlock(pearson_matrices, rows[start:end])
+        (neighbors[start:end], similarities[start:end]) = selectNeighbors(block_similarities, block_overlaps, rows[start:end],
+                                                                          M, min_overlap, min_similarity)
+
+    return (neighbors, similarities)
+
+
+# Create the neighbor table of all users of a rating store
+# Parameter Description:
+# rating_store: RatingStore
+# M: number of neighbors kept per user, must be at least the K used by userCF
+# block_size: number of users whose similarities to all users are held in memory at once
+def createNeighborTable(rating_store, M, min_overlap=1, min_similarity=None, block_size=1024):
+
+    if M < 1:
+        raise ValueError("M must be at least 1, got %s" % M)
+    pearson_matrices = createPearsonMatrices(rating_store.users_to_items)
+    rows = np.arange(rating_store.shape[0])
+    (neighbors, similarities) = computeNeighborRows(pearson_matrices, rows, M, min_overlap, min_similarity, block_size)
+
+    return NeighborTable(rating_store.users_names, neighbors, similarities, min_overlap, min_similarity)
+
+
+# Bring the table up to date after the watch histories of changed_rows have changed in rating_store
+# Parameter Description:
+# table: NeighborTable built from the same rating_store (users may have been appended since)
+# changed_rows / changed_columns: as returned by RatingStore.replaceUsersRatings (the columns are not needed: the similarity
+#                                  of two users only depends on their own two rows)
+# A changed user's average score changes, so all of his pairs change, and only those:
+# - rows of the changed users and of users listing a changed user (who may have dropped out) are recomputed
+# - every other user only gets the changed users inserted into his row when they now rank within his top M
+# Returns the rows that were recomputed or modified
+def updateNeighborTable(table, rating_store, changed_rows, changed_columns=(), block_size=1024):
+
+    changed_rows = np.asarray(changed_rows, dtype=np.int64)
+    changed_columns = np.asarray(changed_columns, dtype=np.int64)
+    users_num = rating_store.shape[0]
+    M = table.M
+
+    # New users get empty rows
+    if users_num > len(table.users_names):
+        added = users_num - len(table.users_names)
+        table.neighbors = np.vstack([table.neighbors, np.full((added, M), -1, dtype=np.int64)])
+        table.similarities = np.vstack([table.similarities, np.full((added, M), -np.inf, dtype=np.float64)])
+    table.users_names = list(rating_store.users_names)
+    table.users_index = dict(rating_store.users_index)
+
+    if len(changed_rows) == 0:
+        return changed_rows
+
+    recompute = np.zeros(users_num, dtype=bool)
+    recompute[changed_rows] = True
+    recompute |= np.isin(table.neighbors, changed_rows).any(axis=1)
+
+    pearson_matrices = createPearsonMatrices(rating_store.users_to_items)
+
+    rows = np.nonzero(recompute)[0]
+    (table.neighbors[rows], table.similarities[rows]) = computeNeighborRows(pearson_matrices, rows, M, table.min_overlap,
+                                                                            table.min_similarity, block_size)
+
+    # The similarity is symmetric, so the changed users' similarities to everybody else are one block
+    (block_similarities, block_overlaps) = calPearsonSimilarityBlock(pearson_matrices, changed_rows)
+    candidates = np.where(block_overlaps >= max(table.min_overlap, 1), block_similarities, -np.inf)
+    if table.min_similarity is not None:
+        candidates[candidates < table.min_similarity] = -np.inf
+    candidates[:, recompute] = -np.inf
+
+    modified = set(rows.tolist())
+    for (k, user_row) in enumerate(changed_rows):
+        for v in np.nonzero(np.isfinite(candidates[k]))[0]:
+            # Slot of the weakest entry, an unused slot counts as -inf; ties go to the lower row as in selectTopN
+            weakest = table.similarities[v][M - 1]
+            if candidates[k][v] > weakest or (candidates[k][v] == weakest and user_row < table.neighbors[v][M - 1]):
+                row_neighbors = np.append(table.neighbors[v][:M - 1], user_row)
+                row_similarities = np.append(table.similarities[v][:M - 1], candidates[k][v])
+                order = np.lexsort((row_neighbors, -row_similarities))
+                table.neighbors[v] = row_neighbors[order]
+                table.similarities[v] = row_similarities[order]
+                modified.add(int(v))
+
+    return np.array(sorted(modified), dtype=np.int64)
+
+
+# Save the table as an uncompressed .npz file
+def saveNeighborTable(table, path):
+    np.savez(path, users_names=np.array(table.users_names, dtype=str), neighbors=table.neighbors,
+             similarities=table.similarities, min_overlap=table.min_overlap,
+             min_similarity=np.nan if table.min_similarity is None else table.min_similarity)
+
+
+# Load a table saved by saveNeighborTable
+def loadNeighborTable(path):
+
+    with np.load(path, allow_pickle=False) as data:
+        min_similarity = float(data['min_similarity'])
+        return NeighborTable(data['users_names'].tolist(), data['neighbors'], data['similarities'], int(data['min_overlap']),
+                             None if np.isnan(min_similarity) else min_similarity)
+
+
+# Load a table saved by saveNeighborTable (a .npz file) or written by out_of_core_similarity.createOutOfCoreNeighborTable (a directory)
+def openNeighborTable(path):
+
+    if os.path.isdir(path):
+        from out_of_core_similarity import loadOutOfCoreNeighborTable
+
+        return loadOutOfCoreNeighborTable(path)
+    return loadNeighborTable(path)
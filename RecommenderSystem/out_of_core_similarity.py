@@ -0,0 +1,227 @@
+# Code description:
+# Out-of-core user-user similarity for the user-based collaborative filtering algorithm
+# createNeighborTable holds block_size x users dense matrices and the whole table in memory. Here the users are cut into
+# blocks and the similarity is computed block against block, so memory is bounded by a budget whatever the number of users:
+# - the block size follows from the memory budget (a pair of blocks costs about PAIR_BYTES per user pair)
+# - the similarity is symmetric, so each pair of blocks is computed once and merged into the rows of both blocks
+# - only the running top-M neighbors of every user are kept, in .npy files on disk opened as memory maps
+# - after every pair of blocks the maps are flushed and progress.json records the pair; an interrupted run started again
+#   on the same directory continues after the last completed pair (merging a pair twice gives the same rows, so a crash
+#   between the flush and the progress record is harmless)
+# The finished table is a neighbor_table.NeighborTable over the memory-mapped files, which UserCF.userCF reads as it is.
+# The sparse Pearson matrices (about 3 floats per rating) still have to fit in memory.
+# Usage: python out_of_core_similarity.py <compiled model directory> <output directory> [M] [memory budget in MB]
+
+import json
+import os
+import sys
+
+import numpy as np
+
+import instrumentation
+from CB import selectTopN
+from neighbor_table import NeighborTable
+from similarity import createPearsonMatrices, calPearsonSimilarityBlock
+
+OUT_OF_CORE_FORMAT = 'recommender-neighbors'
+OUT_OF_CORE_FORMAT_VERSION = 1
+
+# Dense float64 / int64 arrays alive per user pair while a pair of blocks is processed
+# (the four sums and the similarities of calPearsonSimilarityBlock, the pruned scores and the temporaries of selectTopN)
+PAIR_BYTES = 96
+
+
+# Number of users per block so that one pair of blocks stays within memory_budget bytes
+def blockSizeForBudget(users_num, M, memory_budget):
+
+    # The top-M rows of two blocks (neighbors + similarities, before and after a merge) are also in memory
+    block_size = int(np.sqrt(memory_budget / PAIR_BYTES))
+    while block_size > 1 and PAIR_BYTES * block_size * block_size + 2 * 4 * 16 * block_size * M > memory_budget:
+        block_size -= 1
+    return max(1, min(block_size, users_num))
+
+
+# Cheap fingerprint of a rating matrix, so that a run is not resumed on different ratings
+def ratingsFingerprint(users_to_items):
+    return [int(users_to_items.shape[0]), int(users_to_items.shape[1]), int(users_to_items.nnz),
+            float(np.asarray(users_to_items.data, dtype=np.float64).sum()), int(np.asarray(users_to_items.indices, dtype=np.int64).sum())]
+
+
+# Merge the candidates of one column block into the running top-M rows
+# Parameter Description:
+# neighbors / similarities: running rows (len(rows) x M), updated in place
+# block_neighbors / block_similarities: top-M of the rows among the users columns_start..columns_end-1, as selectTopN returns them
+# Entries of the running rows that already point into the column block are dropped first, so merging the same block again
+# changes nothing. Ties are ordered by neighbor row, as in createNeighborTable.
+def mergeNeighbors(neighbors, similarities, block_neighbors, block_similarities, columns_start, columns_end):
+
+    M = neighbors.shape[1]
+    stale = (neighbors >= columns_start) & (neighbors < columns_end)
+    old_neighbors = np.where(stale, -1, neighbors)
+    old_similarities = np.where(stale, -np.inf, similarities)
+
+    block_neighbors = np.where(block_neighbors >= 0, block_neighbors + columns_start, -1)
+    all_neighbors = np.hstack([old_neighbors, block_neighbors])
+    all_similarities = np.hstack([old_similarities, block_similarities])
+
+    order = np.lexsort((all_neighbors, -all_similarities), axis=1)[:, :M]
+    merged_similarities = np.take_along_axis(all_similarities, order, axis=1)
+    neighbors[:] = np.where(np.isfinite(merged_similarities), np.take_along_axis(all_neighbors, order, axis=1), -1)
+    similarities[:] = merged_similarities
+
+
+# Similarities of a block with the pruning rules applied, -inf where a pair cannot be neighbors
+def pruneBlock(similarities, overlaps, min_overlap, min_similarity):
+
+    scores = np.where(overlaps >= max(min_overlap, 1), similarities, -np.inf)
+    if min_similarity is not None:
+        scores[scores < min_similarity] = -np.inf
+    return scores
+
+
+def readJSON(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Write a small JSON file so that it is either the old or the new version, even if the process dies meanwhile
+def writeJSON(path, value):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+# Pairs of blocks (a, b) with a <= b, in processing order
+def blockPairs(blocks_num):
+    return [(a, b) for a in range(blocks_num) for b in range(a, blocks_num)]
+
+
+# Compute the top-M neighbor table of all users of a rating store block by block, spilling it to output_dir
+# Parameter Description:
+# rating_store: RatingStore
+# output_dir: directory of the table files (created if needed)
+# M, min_overlap, min_similarity: as in neighbor_table.createNeighborTable
+# memory_budget: bytes the dense blocks may use, block_size is derived from it unless given
+# resume: continue an interrupted run found in output_dir; False starts over
+# Returns the NeighborTable over the memory-mapped files
+@instrumentation.timed('usercf.createOutOfCoreNeighborTable')
+def createOutOfCoreNeighborTable(rating_store, output_dir, M, min_overlap=1, min_similarity=None, memory_budget=256 * 2 ** 20,
+                                 block_size=None, resume=True):
+
+    if M < 1:
+        raise ValueError("M must be at least 1, got %s" % M)
+    users_num = rating_store.shape[0]
+    if block_size is None:
+        block_size = blockSizeForBudget(users_num, M, memory_budget)
+    blocks = [(start, min(start + block_size, users_num)) for start in range(0, users_num, block_size)]
+    pairs = blockPairs(len(blocks))
+
+    manifest = {'format': OUT_OF_CORE_FORMAT, 'version': OUT_OF_CORE_FORMAT_VERSION, 'users': users_num, 'M': M,
+                'min_overlap': min_overlap, 'min_similarity': min_similarity, 'block_size': block_size,
+                'ratings': ratingsFingerprint(rating_store.users_to_items)}
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    progress_path = os.path.join(output_dir, 'progress.json')
+    neighbors_path = os.path.join(output_dir, 'neighbors.npy')
+    similarities_path = os.path.join(output_dir, 'similarities.npy')
+
+    completed_pairs = 0
+    if resume and os.path.exists(manifest_path) and os.path.exists(progress_path):
+        if readJSON(manifest_path) != manifest:
+            raise ValueError("%s holds a run with other parameters or ratings, start over with resume=False" % output_dir)
+        completed_pairs = readJSON(progress_path)['completed_pairs']
+
+    if completed_pairs == 0:
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        np.save(os.path.join(output_dir, 'users_names.npy'), np.array(rating_store.users_names, dtype=str), allow_pickle=False)
+        neighbors = np.lib.format.open_memmap(neighbors_path, mode='w+', dtype=np.int64, shape=(users_num, M))
+        similarities = np.lib.format.open_memmap(similarities_path, mode='w+', dtype=np.float64, shape=(users_num, M))
+        neighbors[:] = -1
+        similarities[:] = -np.inf
+        neighbors.flush()
+        similarities.flush()
+        writeJSON(manifest_path, manifest)
+        writeJSON(progress_path, {'completed_pairs': 0, 'pairs': len(pairs)})
+    else:
+        neighbors = np.load(neighbors_path, mmap_mode='r+')
+        similarities = np.load(similarities_path, mmap_mode='r+')
+
+    pearson_matrices = createPearsonMatrices(rating_store.users_to_items)
+
+    for p in range(completed_pairs, len(pairs)):
+        (a, b) = pairs[p]
+        (rows_start, rows_end) = blocks[a]
+        (columns_start, columns_end) = blocks[b]
+        rows = np.arange(rows_start, rows_end)
+
+        (block_similarities, block_overlaps) = calPearsonSimilarityBlock(pearson_matrices, rows, np.arange(columns_start, columns_end))
+        scores = pruneBlock(block_similarities, block_overlaps, min_overlap, min_similarity)
+        # A user is never his own neighbor
+        if a == b:
+            np.fill_diagonal(scores, -np.inf)
+
+        # Top M of the row block among the column block
+        (block_neighbors, block_scores) = selectTopN(scores, M)
+        row_neighbors = np.array(neighbors[rows_start:rows_end])
+        row_similarities = np.array(similarities[rows_start:rows_end])
+        mergeNeighbors(row_neighbors, row_similarities, block_neighbors, block_scores, columns_start, columns_end)
+        neighbors[rows_start:rows_end] = row_neighbors
+        similarities[rows_start:rows_end] = row_similarities
+
+        # The same block seen from the column side
+        if a != b:
+            (block_neighbors, block_scores) = selectTopN(scores.T, M)
+            column_neighbors = np.array(neighbors[columns_start:columns_end])
+            column_similarities = np.array(similarities[columns_start:columns_end])
+            mergeNeighbors(column_neighbors, column_similarities, block_neighbors, block_scores, rows_start, rows_end)
+            neighbors[columns_start:columns_end] = column_neighbors
+            similarities[columns_start:columns_end] = column_similarities
+
+        neighbors.flush()
+        similarities.flush()
+        writeJSON(progress_path, {'completed_pairs': p + 1, 'pairs': len(pairs)})
+
+        if instrumentation.enabled:
+            instrumentation.count('usercf.similarity_blocks')
+            instrumentation.count('usercf.user_pairs_compared', len(rows) * (columns_end - columns_start))
+
+    del neighbors, similarities
+    return loadOutOfCoreNeighborTable(output_dir)
+
+
+# Open a finished table written by createOutOfCoreNeighborTable, memory-mapped read-only
+def loadOutOfCoreNeighborTable(output_dir, mmap=True):
+
+    manifest = readJSON(os.path.join(output_dir, 'manifest.json'))
+    if manifest.get('format') != OUT_OF_CORE_FORMAT:
+        raise ValueError("%s is not an out-of-core neighbor table" % output_dir)
+    if manifest.get('version') != OUT_OF_CORE_FORMAT_VERSION:
+        raise ValueError("%s has neighbor table format version %s, expected %d" % (output_dir, manifest.get('version'), OUT_OF_CORE_FORMAT_VERSION))
+    progress = readJSON(os.path.join(output_dir, 'progress.json'))
+    if progress['completed_pairs'] < progress['pairs']:
+        raise ValueError("%s is incomplete (%d of %d block pairs), resume it with createOutOfCoreNeighborTable"
+                         % (output_dir, progress['completed_pairs'], progress['pairs']))
+
+    mmap_mode = 'r' if mmap else None
+    users_names = np.load(os.path.join(output_dir, 'users_names.npy'), allow_pickle=False).tolist()
+    neighbors = np.load(os.path.join(output_dir, 'neighbors.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+    similarities = np.load(os.path.join(output_dir, 'similarities.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+
+    return NeighborTable(users_names, neighbors, similarities, manifest['min_overlap'], manifest['min_similarity'])
+
+
+# Main program
+if __name__ == '__main__':
+
+    from model_artifacts import loadModel
+
+    model = loadModel(sys.argv[1])
+    M = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    memory_budget = float(sys.argv[4]) * 2 ** 20 if len(sys.argv) > 4 else 256 * 2 ** 20
+
+    table = createOutOfCoreNeighborTable(model.rating_store, sys.argv[2], M, memory_budget=memory_budget)
+    print("Neighbor table of %d users written to %s" % (len(table.users_names), sys.argv[2]))
@@ -0,0 +1,202 @@
+# Code description:
+# Incremental user portraits for the content-based recommendation algorithm
+# createUsersProfiles / createUsersProfilesMatrix rebuild every portrait from the whole rating matrix. The formula
+#   user1_score_to_label1 = Sigma(score_to_item i - user1_average_score) / items_count
+# (sum and count over the watched programs with label1) can be rewritten with running sums that one rating event only
+# changes in a few places:
+#   Sigma(score_to_item i - average) = label_sum - label_count * average,  average = total / watched_count
+# where label_sum / label_count are the sum of the scores / the number of the watched programs with the label, and
+# total / watched_count the same over all watched programs. The store keeps these sums per user, so adding, updating or
+# removing a rating costs O(labels of the program), and a portrait is computed in O(labels) when it is read.
+# The portraits agree with a batch rebuild up to floating point rounding (the sums are accumulated in another order);
+# rebuildUser recomputes one user's sums from his ratings when many events have been applied to him.
+
+import numpy as np
+
+import instrumentation
+
+
+# Parameter Description:
+# labels_names: label names in column order
+# items_names: program names in the row order of items_profiles_matrix
+# items_profiles_matrix: program portraits, items x labels (a label counts when its weight is > 0)
+class ProfileStore:
+
+    def __init__(self, labels_names, items_names, items_profiles_matrix):
+
+        self.labels_names = list(labels_names)
+        self.items_labels = {}
+        items_profiles_matrix = np.asarray(items_profiles_matrix)
+        for j in range(len(items_names)):
+            self.setItemLabels(items_names[j], np.nonzero(items_profiles_matrix[j] > 0)[0])
+
+        self.users_names = []
+        self.users_index = {}
+        # users_ratings[i] = {program name: implicit score} of the programs user i has watched
+        self.users_ratings = []
+        labels_num = len(self.labels_names)
+        self.label_sums = np.zeros((0, labels_num))
+        self.label_counts = np.zeros((0, labels_num), dtype=np.int64)
+        self.totals = np.zeros(0)
+        self.watched_counts = np.zeros(0, dtype=np.int64)
+
+    # Label columns of a program; programs added to the catalog later are registered here
+    def setItemLabels(self, item_name, label_columns):
+        self.items_labels[item_name] = np.asarray(label_columns, dtype=np.int64)
+
+    def __contains__(self, user_name):
+        return user_name in self.users_index
+
+    # Row of a user, adding an empty one for a new user
+    def userRow(self, user_name):
+
+        if user_name not in self.users_index:
+            self.users_index[user_name] = len(self.users_names)
+            self.users_names.append(user_name)
+            self.users_ratings.append({})
+            if len(self.users_names) > len(self.totals):
+                # Grow the arrays geometrically so that adding users one by one stays cheap
+                capacity = max(2 * len(self.totals), 16)
+                self.label_sums = np.resize(self.label_sums, (capacity, len(self.labels_names)))
+                self.label_counts = np.resize(self.label_counts, (capacity, len(self.labels_names)))
+                self.totals = np.resize(self.totals, capacity)
+                self.watched_counts = np.resize(self.watched_counts, capacity)
+            i = self.users_index[user_name]
+            self.label_sums[i] = 0.0
+            self.label_counts[i] = 0
+            self.totals[i] = 0.0
+            self.watched_counts[i] = 0
+
+        return self.users_index[user_name]
+
+    # Add score (positive: one more watched program, negative: one less) to the running sums of row i
+    def accumulate(self, i, item_name, score, watched_change):
+
+        labels = self.items_labels.get(item_name)
+        if labels is None:
+            raise KeyError("program %s has no portrait, register it with setItemLabels" % item_name)
+
+        self.totals[i] += score
+        self.watched_counts[i] += watched_change
+        self.label_sums[i, labels] += score
+        self.label_counts[i, labels] += watched_change
+
+        # A user or label without watched programs is exactly zero again, whatever rounding has accumulated
+        if self.watched_counts[i] == 0:
+            self.totals[i] = 0.0
+        emptied = labels[self.label_counts[i, labels] == 0]
+        self.label_sums[i, emptied] = 0.0
+
+    # Rating event: user_name has watched item_name with the implicit score (a new rating or a changed one)
+    # A score <= 0 means the user has not watched the program, the rating is removed
+    def setRating(self, user_name, item_name, score):
+
+        if score <= 0:
+            return self.removeRating(user_name, item_name)
+
+        i = self.userRow(user_name)
+        old_score = self.users_ratings[i].get(item_name)
+        if old_score is None:
+            self.accumulate(i, item_name, score, 1)
+        else:
+            self.accumulate(i, item_name, score - old_score, 0)
+        self.users_ratings[i][item_name] = score
+
+        if instrumentation.enabled:
+            instrumentation.count('profiles.events')
+
+    # Rating event: the rating of user_name for item_name is withdrawn; unknown ratings are ignored
+    def removeRating(self, user_name, item_name):
+
+        if user_name not in self.users_index:
+            return
+        i = self.users_index[user_name]
+        old_score = self.users_ratings[i].pop(item_name, None)
+        if old_score is not None:
+            self.accumulate(i, item_name, -old_score, -1)
+
+        if instrumentation.enabled:
+            instrumentation.count('profiles.events')
+
+    # Recompute the running sums of one user from his ratings
+    def rebuildUser(self, user_name):
+
+        i = self.users_index[user_name]
+        ratings = self.users_ratings[i]
+        self.label_sums[i] = 0.0
+        self.label_counts[i] = 0
+        self.totals[i] = 0.0
+        self.watched_counts[i] = 0
+        for item_name in ratings:
+            self.accumulate(i, item_name, ratings[item_name], 1)
+
+    # Multiply the ratings of some users (default all) by factor, e.g. a time decay applied to all of them at once; the counts do not change
+    def scaleRatings(self, factor, users_names=None):
+
+        rows = range(len(self.users_names)) if users_names is None else [self.users_index[name] for name in users_names if name in self.users_index]
+        rows = np.asarray(rows, dtype=np.int64)
+        self.label_sums[rows] *= factor
+        self.totals[rows] *= factor
+        for i in rows:
+            ratings = self.users_ratings[i]
+            for item_name in ratings:
+                ratings[item_name] *= factor
+
+    # Portraits of the users in rows (default all), users x labels, the values of CB.createUsersProfilesMatrix up to floating
+    # point rounding (the batch sums the centered scores, the store subtracts label_count * average from running sums, which
+    # can differ in the last bits, e.g. by about 1e-15 after thousands of events)
+    def profilesMatrix(self, rows=None):
+
+        rows = np.arange(len(self.users_names)) if rows is None else np.asarray(rows, dtype=np.int64)
+        counts = self.watched_counts[rows]
+        users_average_scores = np.divide(self.totals[rows], counts, out=np.zeros(len(rows)), where=counts > 0)
+
+        label_counts = self.label_counts[rows]
+        score = self.label_sums[rows] - label_counts * users_average_scores[:, np.newaxis]
+        # If the calculated value is too small, set it to 0 directly
+        score[np.abs(score) < 1e-6] = 0.0
+
+        return np.divide(score, label_counts, out=np.zeros_like(score), where=label_counts > 0)
+
+    # Portraits of users given by name, zero for users the store does not hold (nothing watched yet)
+    def profilesOfUsers(self, users_names):
+
+        known = np.array([name in self.users_index for name in users_names], dtype=bool)
+        profiles = np.zeros((len(users_names), len(self.labels_names)))
+        profiles[known] = self.profilesMatrix([self.users_index[name] for name in np.asarray(users_names, dtype=object)[known]])
+        return profiles
+
+    # Portrait of one user in the format of CB.createUsersProfiles: {'label1': 1.1, 'label2': 0.5, ...}
+    def profile(self, user_name):
+        values = self.profilesMatrix([self.users_index[user_name]])[0]
+        return {self.labels_names[l]: float(values[l]) for l in range(len(self.labels_names))}
+
+
+# Create a profile store holding all users of a rating store
+# Parameter Description:
+# rating_store: RatingStore
+# items_profiles_matrix: portraits of the programs of rating_store, rows in its column order
+def createProfileStore(labels_names, rating_store, items_profiles_matrix):
+
+    store = ProfileStore(labels_names, rating_store.items_names, items_profiles_matrix)
+    has_label = (np.asarray(items_profiles_matrix) > 0).astype(np.float64)
+
+    ratings = rating_store.users_to_items
+    watched = ratings.copy()
+    watched.data = (ratings.data > 0).astype(np.float64)
+    ratings = ratings.multiply(watched).tocsr()
+
+    store.users_names = list(rating_store.users_names)
+    store.users_index = dict(rating_store.users_index)
+    store.users_ratings = []
+    for i in range(len(store.users_names)):
+        (columns, scores) = rating_store.userItems(i)
+        store.users_ratings.append({rating_store.items_names[j]: float(score) for (j, score) in zip(columns, scores) if score > 0})
+
+    # All running sums at once
+    store.label_sums = np.asarray(ratings @ has_label)
+    store.label_counts = np.rint(np.asarray(watched @ has_label)).astype(np.int64)
+    store.totals = np.asarray(ratings.sum(axis=1)).ravel()
+    store.watched_counts = np.rint(np.asarray(watched.sum(axis=1)).ravel()).astype(np.int64)
+
+    return store
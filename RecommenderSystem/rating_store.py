@@ -0,0 +1,297 @@
+# Code description:
+# Sparse storage of the implicit rating matrix "all users x all programs they have watched"
+# Real viewing data is almost entirely zeros, so instead of the dense matrix read from Excel plus the
+# users_to_items / items_to_users Python lists built by UserCF.createUsersDict and createItemsDict,
+# the ratings are kept once as a CSR matrix (user -> items) and once as a CSC matrix (item -> users, the inverted table).
+
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+
+# Sparse rating store
+# Parameter Description:
+# users_names / items_names: names in row / column order
+# users_index = {user name: row}, items_index = {program name: column}
+# users_to_items: CSR matrix users x items, only positive implicit scores are stored
+# items_to_users: the same matrix in CSC format, column j lists the users that have watched program j
+#                 (derived from users_to_items unless given, e.g. when both are loaded from memory-mapped files)
+# dtype: type of the stored scores, float32 halves the memory of the scores
+class RatingStore:
+
+    def __init__(self, users_names, items_names, users_to_items, items_to_users=None, dtype=np.float64):
+
+        self.users_names = list(users_names)
+        self.items_names = list(items_names)
+        self.users_index = {name: i for i, name in enumerate(self.users_names)}
+        self.items_index = {name: j for j, name in enumerate(self.items_names)}
+
+        self.users_to_items = sparse.csr_matrix(users_to_items, dtype=dtype)
+        self.users_to_items.sum_duplicates()
+        self.users_to_items.sort_indices()
+        if items_to_users is None:
+            self.items_to_users = self.users_to_items.tocsc()
+            self.items_to_users.sort_indices()
+        else:
+            self.items_to_users = sparse.csc_matrix(items_to_users, dtype=dtype)
+
+    @property
+    def shape(self):
+        return self.users_to_items.shape
+
+    # Column positions and scores of the programs watched by the user in row i
+    def userItems(self, i):
+        start = self.users_to_items.indptr[i]
+        end = self.users_to_items.indptr[i + 1]
+        return (self.users_to_items.indices[start:end], self.users_to_items.data[start:end])
+
+    # Row positions and scores of the users that have watched the program in column j
+    def itemUsers(self, j):
+        start = self.items_to_users.indptr[j]
+        end = self.items_to_users.indptr[j + 1]
+        return (self.items_to_users.indices[start:end], self.items_to_users.data[start:end])
+
+    # Replace the complete watch history of some users, adding users and programs that are not known yet
+    # Parameter Description:
+    # users_ratings = {user name: [[program name, implicit score], ...], ...} (the format of users_dict)
+    # The new rows are spliced into the CSR matrix and only the columns they touch are rewritten in the CSC matrix;
+    # the entries of the other users are only copied, in runs, never converted or sorted again.
+    # Returns (changed_rows, changed_columns): the rows replaced and the programs whose score changed for at least one of them
+    def replaceUsersRatings(self, users_ratings):
+
+        rows = array('q')
+        columns = array('q')
+        scores = array('d')
+        for user_name in users_ratings:
+            i = internName(user_name, self.users_index, self.users_names)
+            for (item_name, score) in users_ratings[user_name]:
+                if score > 0:
+                    rows.append(i)
+                    columns.append(internName(item_name, self.items_index, self.items_names))
+                    scores.append(score)
+        rows = np.frombuffer(rows, dtype=np.int64)
+        columns = np.frombuffer(columns, dtype=np.int64)
+        scores = np.frombuffer(scores, dtype=np.float64)
+
+        changed_rows = np.array(sorted(self.users_index[user_name] for user_name in users_ratings), dtype=np.int64)
+        shape = (len(self.users_names), len(self.items_names))
+        dtype = self.users_to_items.dtype
+        ratings = self.users_to_items
+
+        # New rows of the changed users, numbered by their position in changed_rows (duplicate pairs are summed)
+        new_rows = sparse.coo_matrix((scores, (np.searchsorted(changed_rows, rows), columns)), shape=(len(changed_rows), shape[1])).tocsr()
+        new_rows.sort_indices()
+        new_rows.data = new_rows.data.astype(dtype)
+
+        # Old rows of the changed users in the same numbering (users added just now have none)
+        known = np.nonzero(changed_rows < ratings.shape[0])[0]
+        old_rows = ratings[changed_rows[known]].tocoo()
+        before = sparse.coo_matrix((old_rows.data, (known[old_rows.row], old_rows.col)), shape=(len(changed_rows), shape[1])).tocsr()
+
+        # Programs whose score differs between the old and the new rows of the changed users
+        difference = (new_rows - before).tocoo()
+        changed_columns = np.unique(difference.col[difference.data != 0])
+
+        # Users x items: splice the new rows in place of the old ones
+        self.users_to_items = sparse.csr_matrix(spliceCompressed(ratings.indptr, ratings.indices, ratings.data, changed_rows,
+                                                                 np.diff(new_rows.indptr), new_rows.indices, new_rows.data, shape[0]),
+                                                shape=shape)
+
+        # Items x users: only the columns where a changed user had or now has a rating are rewritten
+        ratings = self.items_to_users
+        touched = np.union1d(before.indices, new_rows.indices)
+        (kept_columns, kept_rows, kept_data) = gatherColumns(ratings, touched)
+        kept = ~np.isin(kept_rows, changed_rows)
+        new_entries = new_rows.tocoo()
+        touched_columns = np.concatenate([kept_columns[kept], np.searchsorted(touched, new_entries.col)])
+        touched_rows = np.concatenate([kept_rows[kept], changed_rows[new_entries.row]])
+        touched_data = np.concatenate([kept_data[kept], new_entries.data]).astype(dtype)
+        order = np.lexsort((touched_rows, touched_columns))
+        self.items_to_users = sparse.csc_matrix(spliceCompressed(ratings.indptr, ratings.indices, ratings.data, touched,
+                                                                 np.bincount(touched_columns, minlength=len(touched)),
+                                                                 touched_rows[order], touched_data[order], shape[1]),
+                                                shape=shape)
+
+        return (changed_rows, changed_columns)
+
+    # Multiply the ratings of the users in rows by factor in both matrices, without rebuilding them
+    def scaleUsersRatings(self, rows, factor):
+
+        factors = np.ones(self.shape[0], dtype=self.users_to_items.dtype)
+        factors[np.asarray(rows, dtype=np.int64)] = factor
+        for matrix in (self.users_to_items, self.items_to_users):
+            # Matrices loaded from memory-mapped files are read-only, they are copied once
+            if not matrix.data.flags.writeable:
+                matrix.data = matrix.data.copy()
+        self.users_to_items.data *= np.repeat(factors, np.diff(self.users_to_items.indptr))
+        self.items_to_users.data *= factors[self.items_to_users.indices]
+
+    # users_dict in the format of UserCF.createUsersDict, read from the CSR matrix on access
+    def usersDict(self):
+        return UsersDictView(self)
+
+    # items_dict in the format of UserCF.createItemsDict, read from the CSC matrix on access
+    def itemsDict(self):
+        return ItemsDictView(self)
+
+
+# Read-only view of a RatingStore that behaves like users_to_items = {User one: [['Program one', 3.2], ...], ...}
+# so that UserCF.findSimilarUsers and userCF can run on the sparse store without building the lists up front
+class UsersDictView:
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, user_name):
+        (columns, scores) = self.store.userItems(self.store.users_index[user_name])
+        items_names = self.store.items_names
+        return [[items_names[columns[k]], scores[k]] for k in range(len(columns))]
+
+    def __contains__(self, user_name):
+        return user_name in self.store.users_index
+
+    def __iter__(self):
+        return iter(self.store.users_names)
+
+    def __len__(self):
+        return len(self.store.users_names)
+
+    def keys(self):
+        return list(self.store.users_names)
+
+
+# Read-only view of a RatingStore that behaves like items_to_users = {Program 1: [User 1, User 3], ...}
+class ItemsDictView:
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, item_name):
+        (rows, scores) = self.store.itemUsers(self.store.items_index[item_name])
+        users_names = self.store.users_names
+        return [users_names[i] for i in rows]
+
+    def __contains__(self, item_name):
+        return item_name in self.store.items_index
+
+    def __iter__(self):
+        return iter(self.store.items_names)
+
+    def __len__(self):
+        return len(self.store.items_names)
+
+    def keys(self):
+        return list(self.store.items_names)
+
+
+# Replace the slices of some major positions (rows of a CSR, columns of a CSC matrix) of compressed sparse arrays
+# Parameter Description:
+# indptr / indices / data: arrays of the matrix, indptr may be shorter than majors_num + 1 (new positions are empty)
+# majors: sorted positions replaced, counts: number of new entries of each, new_indices / new_data: the new entries, grouped in
+#         the order of majors
+# majors_num: number of major positions of the result
+# Returns (data, indices, indptr) of the result
+def spliceCompressed(indptr, indices, data, majors, counts, new_indices, new_data, majors_num):
+
+    indptr = np.concatenate([indptr, np.full(majors_num + 1 - len(indptr), indptr[-1], dtype=indptr.dtype)])
+    new_indptr = np.concatenate([[0], np.cumsum(counts)])
+
+    indices_pieces = []
+    data_pieces = []
+    previous = 0
+    for k in range(len(majors)):
+        indices_pieces += [indices[previous:indptr[majors[k]]], new_indices[new_indptr[k]:new_indptr[k + 1]]]
+        data_pieces += [data[previous:indptr[majors[k]]], new_data[new_indptr[k]:new_indptr[k + 1]]]
+        previous = indptr[majors[k] + 1]
+    indices_pieces.append(indices[previous:])
+    data_pieces.append(data[previous:])
+
+    sizes = np.diff(indptr)
+    sizes[majors] = counts
+    index_dtype = np.int64 if sizes.sum() > np.iinfo(np.int32).max else np.int32
+    result_indptr = np.concatenate([[0], np.cumsum(sizes)]).astype(index_dtype)
+
+    return (np.concatenate(data_pieces).astype(data.dtype, copy=False), np.concatenate(indices_pieces).astype(index_dtype), result_indptr)
+
+
+# Entries of some columns of a CSC matrix: (position in columns, row, score) of each
+# columns: sorted, those beyond the matrix (programs added since) come last and have no entries
+def gatherColumns(matrix, columns):
+
+    columns = columns[columns < matrix.shape[1]]
+    starts = matrix.indptr[columns]
+    ends = matrix.indptr[columns + 1]
+    sizes = ends - starts
+    # Positions of the entries in the data array, one run starts..ends-1 per column
+    positions = np.repeat(starts - np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes) + np.arange(sizes.sum())
+
+    return (np.repeat(np.arange(len(columns)), sizes), matrix.indices[positions].astype(np.int64), matrix.data[positions])
+
+
+# Map names to consecutive integer positions, adding names that are not known yet
+# names_index = {name: position}, names = [name at position 0, name at position 1, ...]
+def internName(name, names_index, names):
+    position = names_index.get(name)
+    if position is None:
+        position = len(names)
+        names_index[name] = position
+        names.append(name)
+    return position
+
+
+# Create a rating store directly from (user, program, implicit score) triples, without building the dense matrix
+# Parameter Description:
+# triples: any iterable of (user name, program name, implicit score), e.g. rows of the per-user rating files
+# users_names / items_names: optional fixed row / column order, names not listed are appended in order of appearance
+# Scores that are not positive mean the user has not actually watched the program and are dropped.
+# A (user, program) pair that appears several times gets the sum of its scores.
+def createRatingStore(triples, users_names=None, items_names=None):
+
+    users_names = list(users_names) if users_names is not None else []
+    items_names = list(items_names) if items_names is not None else []
+    users_index = {name: i for i, name in enumerate(users_names)}
+    items_index = {name: j for j, name in enumerate(items_names)}
+
+    # Typed arrays instead of Python lists keep memory at 8 bytes per value
+    rows = array('q')
+    columns = array('q')
+    scores = array('d')
+
+    for (user_name, item_name, score) in triples:
+        if not score > 0:
+            continue
+        rows.append(internName(user_name, users_index, users_names))
+        columns.append(internName(item_name, items_index, items_names))
+        scores.append(score)
+
+    return createRatingStoreFromArrays(np.frombuffer(rows, dtype=np.int64), np.frombuffer(columns, dtype=np.int64),
+                                       np.frombuffer(scores, dtype=np.float64), users_names, items_names)
+
+
+# Create a rating store from parallel arrays of row positions, column positions and implicit scores
+def createRatingStoreFromArrays(rows, columns, scores, users_names, items_names):
+
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+
+    keep = scores > 0
+    users_to_items = sparse.coo_matrix((scores[keep], (rows[keep], columns[keep])),
+                                       shape=(len(users_names), len(items_names))).tocsr()
+
+    return RatingStore(users_names, items_names, users_to_items)
+
+
+# Create a rating store from the DataFrame of "Rating matrix of all users for the programs they have watched"
+# The first column holds the user names, the remaining column headers are the program names.
+def createRatingStoreFromDataFrame(df):
+
+    (m, n) = df.shape
+    data_array = np.array(df.iloc[:m + 1, 1:], dtype=np.float64)
+    users_names = np.array(df.iloc[:m + 1, 0]).tolist()
+    items_names = np.array(df.columns)[1:].tolist()
+
+    (rows, columns) = np.nonzero(data_array > 0)
+
+    return createRatingStoreFromArrays(rows, columns, data_array[rows, columns], users_names, items_names)
@@ -0,0 +1,234 @@
+# Code description:
+# Sliding-window, time-decayed implicit ratings, maintained incrementally from timestamped watch events
+# The rating matrix is meant to hold "the ratings of the programs watched in the past three months". Instead of rebuilding
+# it from 90 days of logs every day, the window keeps the events it holds and the per (user, program) sums of their scores:
+# - addEvents adds new events, advance(now) evicts the events that have left the window, both only touch the sums of
+#   the (user, program) pairs concerned
+# - publish() writes the rows of the users whose sums changed into the RatingStore (replaceUsersRatings), so the
+#   users_dict / items_dict views and the seen-item sets derived from them follow, and applies the same changes to an
+#   optional profile_store.ProfileStore
+# Time decay: an event of score s at time t counts s * 2^(-(now - t) / half_life). All ratings decay by the same factor
+# between two moments, so the sums are kept relative to a reference time t0 (an event is added as s * 2^((t - t0) / half_life))
+# and nothing has to be recomputed at every event: the current ratings are the stored ones times scale(now).
+# t0 is moved forward to now (the sums and the published rows multiplied once) as soon as it is more than one half life
+# old, so the published ratings are never more than twice the decayed ones. That is enough for the similarities and the
+# rankings of CB, UserCF and ItemCF, which do not change when all ratings are multiplied by one factor; consumers that
+# depend on the absolute scale (e.g. the 1 + alpha * r confidence of ALS) should multiply by scale() or call rebase() first.
+# Timestamps are seconds (e.g. Unix time).
+
+from collections import deque
+
+import numpy as np
+
+import instrumentation
+from id_interning import IdMap
+
+DAY = 24 * 3600
+# Window of the rating matrix: three months
+WINDOW = 90 * DAY
+# t0 is moved forward once now - t0 exceeds this many half lives (published values at most 2^REBASE_HALF_LIVES times the decayed ones)
+REBASE_HALF_LIVES = 1
+
+
+# Parameter Description:
+# rating_store: RatingStore the window publishes into; rows of users without events are left as they are, the row of a user
+#               is replaced by his windowed ratings once he has events (see snapshotEvents to bring an existing snapshot in)
+# window: length of the window in seconds
+# half_life: seconds after which an event counts half, None for no decay (plain sums over the window)
+# now: current time, events at or before now - window are out of the window
+# profile_store: optional ProfileStore kept in step with the published ratings (its programs must have portraits)
+# result_cache: optional result_cache.ResultCache (or RecommendService) whose results of the changed users publish invalidates
+class RatingWindow:
+
+    def __init__(self, rating_store, window=WINDOW, half_life=None, now=0.0, profile_store=None, result_cache=None):
+
+        self.rating_store = rating_store
+        self.window = window
+        self.half_life = half_life
+        self.now = now
+        self.reference_time = now
+        self.profile_store = profile_store
+        self.result_cache = result_cache
+
+        self.users = IdMap()
+        self.items = IdMap()
+        # sums[user id] = {item id: sum of the (relative) scores}, counts[user id] = {item id: number of events}
+        self.sums = {}
+        self.counts = {}
+        # Blocks of events in the window, each sorted by time: [user ids, item ids, times, relative scores, first live event]
+        self.blocks = deque()
+        self.events_num = 0
+        self.dirty = set()
+
+    def __len__(self):
+        return self.events_num
+
+    # Factor turning the stored (relative) ratings into the decayed ratings at time now (default the current time)
+    def scale(self, now=None):
+        if self.half_life is None:
+            return 1.0
+        return 2.0 ** (-((self.now if now is None else now) - self.reference_time) / self.half_life)
+
+    # Relative score of events, scores * 2^((t - t0) / half_life)
+    def relativeScores(self, timestamps, scores):
+        if self.half_life is None:
+            return scores
+        return scores * np.exp2((timestamps - self.reference_time) / self.half_life)
+
+    # Add deltas to the sums of (user, item) pairs; a pair whose last event is gone is removed exactly
+    def applyDeltas(self, users_ids, items_ids, scores, counts):
+
+        keys = users_ids * len(self.items) + items_ids
+        (keys, inverse) = np.unique(keys, return_inverse=True)
+        scores_sums = np.bincount(inverse, weights=scores, minlength=len(keys))
+        counts_sums = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+
+        for k in range(len(keys)):
+            (i, j) = divmod(int(keys[k]), len(self.items))
+            user_sums = self.sums.setdefault(i, {})
+            user_counts = self.counts.setdefault(i, {})
+            count = user_counts.get(j, 0) + int(counts_sums[k])
+            if count > 0:
+                user_sums[j] = user_sums.get(j, 0.0) + float(scores_sums[k])
+                user_counts[j] = count
+            else:
+                user_sums.pop(j, None)
+                user_counts.pop(j, None)
+            self.dirty.add((i, j))
+
+    # Add watch events
+    # Parameter Description:
+    # users_names / items_names / timestamps: one entry per event
+    # scores: implicit score of every event (default 1 per viewing)
+    # Events already out of the window are ignored. Returns the number of events added.
+    def addEvents(self, users_names, items_names, timestamps, scores=None):
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        scores = np.ones(len(timestamps)) if scores is None else np.asarray(scores, dtype=np.float64)
+        live = (timestamps > self.now - self.window) & (scores > 0)
+
+        # The IDs of the pairs are user * items + item, so the items are interned first
+        items_ids = self.items.internMany(np.asarray(items_names, dtype=object)[live])
+        users_ids = self.users.internMany(np.asarray(users_names, dtype=object)[live])
+        (timestamps, scores) = (timestamps[live], self.relativeScores(timestamps[live], scores[live]))
+        if len(timestamps) == 0:
+            return 0
+
+        order = np.argsort(timestamps, kind='stable')
+        block = [users_ids[order], items_ids[order], timestamps[order], scores[order], 0]
+        self.blocks.append(block)
+        self.events_num += len(timestamps)
+        self.applyDeltas(block[0], block[1], block[3], np.ones(len(timestamps)))
+
+        # Merge like a binary counter: a block is only merged into an older one holding at most twice its live events, so
+        # adding events one call at a time leaves O(log events) blocks for advance to search and every event is merged O(log) times
+        while len(self.blocks) > 1 and liveEvents(self.blocks[-2]) <= 2 * liveEvents(self.blocks[-1]):
+            newer = self.blocks.pop()
+            older = self.blocks.pop()
+            merged = [np.concatenate([older[k][older[4]:], newer[k][newer[4]:]]) for k in range(4)]
+            order = np.argsort(merged[2], kind='stable')
+            self.blocks.append([merged[0][order], merged[1][order], merged[2][order], merged[3][order], 0])
+
+        if instrumentation.enabled:
+            instrumentation.count('window.events_added', len(timestamps))
+
+        return len(timestamps)
+
+    # Move the window to now and evict the events that have left it; returns the number of events evicted
+    def advance(self, now):
+
+        self.now = max(self.now, now)
+        cutoff = self.now - self.window
+        evicted = 0
+
+        for block in self.blocks:
+            (users_ids, items_ids, timestamps, scores, start) = block
+            end = int(np.searchsorted(timestamps, cutoff, side='right'))
+            if end > start:
+                self.applyDeltas(users_ids[start:end], items_ids[start:end], -scores[start:end], -np.ones(end - start))
+                block[4] = end
+                evicted += end - start
+        # Blocks whose events are all gone are dropped
+        self.blocks = deque(block for block in self.blocks if block[4] < len(block[2]))
+        self.events_num -= evicted
+
+        if self.half_life is not None and self.now - self.reference_time > REBASE_HALF_LIVES * self.half_life:
+            self.rebase()
+
+        if instrumentation.enabled:
+            instrumentation.count('window.events_evicted', evicted)
+
+        return evicted
+
+    # Move the reference time to now: the stored values, and the published ratings and profile sums of the users of the
+    # window, are multiplied by one factor; rows of users the window has never seen are left as they are
+    def rebase(self):
+
+        factor = self.scale()
+        for i in self.sums:
+            user_sums = self.sums[i]
+            for j in user_sums:
+                user_sums[j] *= factor
+        for block in self.blocks:
+            block[3] = block[3] * factor
+        self.reference_time = self.now
+
+        store = self.rating_store
+        users_names = [name for name in self.users.names if name in store.users_index]
+        store.scaleUsersRatings([store.users_index[name] for name in users_names], factor)
+
+        if self.profile_store is not None:
+            self.profile_store.scaleRatings(factor, users_names)
+        if self.result_cache is not None:
+            self.result_cache.invalidateUsers(users_names)
+
+    # Write the changed rows into the rating store (and the profile store)
+    # Returns (changed_rows, changed_columns) of RatingStore.replaceUsersRatings, e.g. for ResultCache.invalidateUsers or
+    # neighbor_table.updateNeighborTable
+    @instrumentation.timed('window.publish')
+    def publish(self):
+
+        changed_users = sorted(set(i for (i, j) in self.dirty))
+        users_ratings = {}
+        for i in changed_users:
+            user_sums = self.sums.get(i, {})
+            users_ratings[self.users.names[i]] = [[self.items.names[j], user_sums[j]] for j in sorted(user_sums)]
+        (changed_rows, changed_columns) = self.rating_store.replaceUsersRatings(users_ratings)
+
+        if self.profile_store is not None:
+            for (i, j) in sorted(self.dirty):
+                score = self.sums.get(i, {}).get(j)
+                if score is None:
+                    self.profile_store.removeRating(self.users.names[i], self.items.names[j])
+                else:
+                    self.profile_store.setRating(self.users.names[i], self.items.names[j], score)
+
+        if self.result_cache is not None:
+            self.result_cache.invalidateUsers([self.rating_store.users_names[i] for i in changed_rows])
+
+        self.dirty.clear()
+        return (changed_rows, changed_columns)
+
+    # Current decayed ratings of one user: [[program name, rating], ...] (the format of users_dict)
+    def userRatings(self, user_name, now=None):
+        if user_name not in self.users:
+            return []
+        scale = self.scale(now)
+        user_sums = self.sums.get(self.users.id(user_name), {})
+        return [[self.items.names[j], user_sums[j] * scale] for j in sorted(user_sums)]
+
+
+# Number of events of a block still in the window
+def liveEvents(block):
+    return len(block[2]) - block[4]
+
+
+# Events that bring the ratings of a RatingStore snapshot into a window, all at one timestamp
+# Returns (users_names, items_names, timestamps, scores) for RatingWindow.addEvents
+def snapshotEvents(rating_store, timestamp):
+
+    ratings = rating_store.users_to_items.tocoo()
+    users_names = np.asarray(rating_store.users_names, dtype=object)[ratings.row]
+    items_names = np.asarray(rating_store.items_names, dtype=object)[ratings.col]
+
+    return (users_names, items_names, np.full(ratings.nnz, float(timestamp)), np.asarray(ratings.data, dtype=np.float64))
@@ -0,0 +1,316 @@
+# Code description:
+# Local asyncio HTTP recommendation service
+# Loads a compiled model (see model_artifacts.py) once and answers
+#   GET /recommend?user=<user name>&method=cb|usercf|als|hybrid&n=<number of programs>
+# with {"user": ..., "method": ..., "items": [[program name, recommendation index], ...]}.
+# Requests that arrive within a few milliseconds of each other are grouped into one vectorized scoring call
+# (hybrid_fusion.HybridRecommender over CB.contentBasedBatch / UserCF.userCFBatch). Every method has a bounded queue; when it is full the service answers
+# 503 at once instead of letting latency grow without limit (backpressure).
+# Results are kept in a result_cache.ResultCache (service cache=...). Changes of the business filters (scorer.item_filters),
+# and programs reaching their expiry time, invalidate the whole cache on their own; call invalidateUsers when users' ratings change (e.g. with RatingWindow(...,
+# result_cache=service) or after RatingStore.replaceUsersRatings) and invalidateCatalog when the candidates change.
+# Other endpoints: GET /health, GET /users?limit=<n> (user names, used by load_generator.py),
+# GET /metrics (stage timers and work counters of instrumentation.py in the Prometheus text format, ?format=json for JSON)
+# With a profile_store.ProfileStore (RecommendService(..., profile_store=...), kept in step by a RatingWindow publishing into
+# the model's rating store) CB serves the current portraits instead of the compiled ones.
+# UserCF reads its neighbors from a neighbor table of the model (neighbor_table.py .npz file or out_of_core_similarity.py
+# directory) when one is given.
+# The method 'als' is served when an ALS model is given (serve loads the one saved next to the compiled model, see ALS.py);
+# als_weight > 0 gives ALS that share of the hybrid's collaborative part 1 - w1 (als_weight = 1 - w1 replaces UserCF).
+# Usage: python recommend_service.py <compiled model directory> [port] [sqlite file of a cache shared between processes, - for none]
+#        [neighbor table, - for none] [ALS weight]
+
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+import instrumentation
+from CB import topNToRecommendItems
+from hybrid_fusion import createHybridRecommender, hybridWeights
+from result_cache import ResultCache
+
+METHODS = ('cb', 'usercf', 'als', 'hybrid')
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error',
+                503: 'Service Unavailable'}
+
+
+# Scores batches of users against the model; all methods share the once-loaded matrices
+class BatchScorer:
+
+    def __init__(self, model, K=2, w1=0.7, neighbor_table=None, profile_store=None, als_model=None, als_weight=0.0):
+        self.model = model
+        self.weights = hybridWeights(w1, als_weight)
+        if als_model is None and als_weight > 0:
+            raise ValueError("an ALS weight needs an ALS model")
+        # Seen bitmaps plus any business filters (blocked or expired titles) added at run time live in recommender.item_filters
+        self.recommender = createHybridRecommender(model, K, als_model=als_model, neighbor_table=neighbor_table, profile_store=profile_store)
+        # Methods that can be served: 'als' only with an ALS model
+        self.methods = tuple(method for method in METHODS if method in self.recommender.engines or method == 'hybrid')
+        self.item_filters = self.recommender.item_filters
+
+    # Top lists of one method for the users in rows, Ns[k] programs for rows[k]
+    # Returns (top_indices, top_scores) with one row per user and max(Ns) columns, row k is filled up to Ns[k]
+    # The top-n of one engine is the first n of its top-max(Ns), but the fused list depends on n (scores are normalized over
+    # each engine's top-n), so the engines are asked once for max(Ns) and the fusion runs once per distinct n.
+    def score(self, method, rows, Ns):
+        rows = np.asarray(rows, dtype=np.int64)
+        Ns = np.asarray(Ns, dtype=np.int64)
+        N = int(Ns.max())
+        if method != 'hybrid':
+            return self.recommender.recommendBy(method, rows, N)
+
+        engine_results = {name: self.recommender.engines[name](rows, N) for name in self.weights if self.weights[name] > 0}
+        top_indices = np.full((len(rows), N), -1, dtype=np.int64)
+        top_scores = np.full((len(rows), N), -np.inf)
+        for n in np.unique(Ns):
+            same = Ns == n
+            results = {name: (engine_results[name][0][same], engine_results[name][1][same]) for name in engine_results}
+            (top_indices[same, :n], top_scores[same, :n]) = self.recommender.recommend(rows[same], int(n), self.weights, engine_results=results)
+        return (top_indices, top_scores)
+
+
+# Groups the requests of one method into micro-batches
+# Parameter Description:
+# max_batch: most requests scored in one call
+# max_wait: seconds the first request of a batch waits for more requests to arrive
+# max_queue: requests waiting beyond this are rejected (submit returns None)
+class MicroBatcher:
+
+    def __init__(self, scorer, method, executor, max_batch=256, max_wait=0.002, max_queue=4096):
+        self.scorer = scorer
+        self.method = method
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.batches = 0
+        self.batched_requests = 0
+
+    # Queue one request, returns a future for (program positions, scores), or None when the queue is full
+    def submit(self, row, N):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((row, N, future))
+        except asyncio.QueueFull:
+            return None
+        return future
+
+    async def run(self):
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            rows = [row for (row, N, future) in batch]
+            Ns = [N for (row, N, future) in batch]
+            try:
+                # Scoring runs in a worker thread (numpy releases the GIL) so that the event loop keeps accepting requests
+                (top_indices, top_scores) = await loop.run_in_executor(self.executor, self.scorer.score, self.method, rows, Ns)
+            except Exception as error:
+                for (row, n, future) in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for k in range(len(batch)):
+                (row, n, future) = batch[k]
+                if not future.done():
+                    future.set_result((top_indices[k][:n], top_scores[k][:n]))
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+
+class RecommendService:
+
+    def __init__(self, model, K=2, w1=0.7, max_batch=256, max_wait=0.002, max_queue=4096, max_n=100, cache=None, neighbor_table=None,
+                 profile_store=None, als_model=None, als_weight=0.0):
+        self.model = model
+        self.max_n = max_n
+        self.cache = cache
+        self.scorer = BatchScorer(model, K, w1, neighbor_table, profile_store, als_model, als_weight)
+        # One scoring thread: batches of different methods run one after another, which bounds the work in flight
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {method: MicroBatcher(self.scorer, method, self.executor, max_batch, max_wait, max_queue) for method in self.scorer.methods}
+        self.tasks = []
+        # Every cached list may change when a business filter or the seen index changes
+        self.scorer.item_filters.addListener(self.invalidateCatalog)
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.tasks = [asyncio.create_task(self.batchers[method].run()) for method in self.batchers]
+        self.server = await asyncio.start_server(self.handleConnection, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+    def invalidateUser(self, user_name):
+        self.invalidateUsers([user_name])
+
+    def invalidateUsers(self, users_names):
+        if self.cache is not None:
+            self.cache.invalidateUsers(users_names)
+
+    def invalidateCatalog(self):
+        if self.cache is not None:
+            self.cache.invalidateCatalog()
+
+    async def handleRequest(self, method, target):
+
+        if method != 'GET':
+            return (405, {'error': 'only GET is supported'})
+
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if url.path == '/health':
+            return (200, {'status': 'ok', 'users': len(self.model.users_names), 'candidates': len(self.model.candidates_names),
+                          'batches': {name: [self.batchers[name].batches, self.batchers[name].batched_requests] for name in self.batchers},
+                          'cache': None if self.cache is None else self.cache.stats()})
+
+        if url.path == '/metrics':
+            if query.get('format', [''])[0] == 'json':
+                return (200, instrumentation.snapshot())
+            return (200, instrumentation.dumpPrometheus())
+
+        if url.path == '/users':
+            try:
+                limit = int(query.get('limit', ['1000'])[0])
+            except ValueError:
+                return (400, {'error': 'limit must be an integer'})
+            if limit < 0:
+                return (400, {'error': 'limit must not be negative'})
+            return (200, {'users': [str(name) for name in self.model.users_names[:limit]]})
+
+        if url.path != '/recommend':
+            return (404, {'error': 'unknown path %s' % url.path})
+
+        user_name = query.get('user', [None])[0]
+        recommend_method = query.get('method', ['hybrid'])[0]
+        try:
+            N = int(query.get('n', ['5'])[0])
+        except ValueError:
+            return (400, {'error': 'n must be an integer'})
+        if recommend_method not in self.batchers:
+            return (400, {'error': 'method must be one of %s' % ', '.join(self.batchers)})
+        if not 0 < N <= self.max_n:
+            return (400, {'error': 'n must be between 1 and %d' % self.max_n})
+        if user_name not in self.model.rating_store.users_index:
+            return (404, {'error': 'unknown user %s' % user_name})
+
+        # Programs that expired since the last request invalidate the cached lists (through the filters' listener)
+        self.scorer.item_filters.checkExpiry()
+        (items, token) = (None, None) if self.cache is None else self.cache.getWithToken(user_name, recommend_method, N)
+        if items is None:
+            future = self.batchers[recommend_method].submit(self.model.rating_store.users_index[user_name], N)
+            if future is None:
+                return (503, {'error': 'overloaded, retry later'})
+
+            (top_indices, top_scores) = await future
+            items = topNToRecommendItems(top_indices, top_scores, self.model.candidates_names)
+            if self.cache is not None:
+                # Not stored if the user or the catalog was invalidated while the request was being scored
+                self.cache.put(user_name, recommend_method, N, items, token=token)
+
+        return (200, {'user': user_name, 'method': recommend_method, 'items': items})
+
+    # Minimal HTTP/1.1 with keep-alive, enough for local clients and load_generator.py
+    async def handleConnection(self, reader, writer):
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    (name, separator, value) = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    content_length = int(headers.get('content-length', '0'))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    # The end of the body is unknown, the connection cannot be reused
+                    (status, body, keep_alive) = (400, {'error': 'invalid Content-Length'}, False)
+                else:
+                    if content_length > 0:
+                        await reader.readexactly(content_length)
+
+                    if len(parts) < 2:
+                        (status, body) = (400, {'error': 'malformed request line'})
+                    else:
+                        try:
+                            (status, body) = await self.handleRequest(parts[0], parts[1])
+                        except Exception as error:
+                            # A failed scoring batch (or any other error) still gets an answer
+                            (status, body) = (500, {'error': '%s: %s' % (type(error).__name__, error)})
+
+                if isinstance(body, str):
+                    (payload, content_type) = (body.encode('utf-8'), 'text/plain; version=0.0.4')
+                else:
+                    (payload, content_type) = (json.dumps(body, ensure_ascii=False).encode('utf-8'), 'application/json')
+                head = 'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n' % (status, HTTP_REASONS[status], content_type, len(payload))
+                if status == 503:
+                    head += 'Retry-After: 1\r\n'
+                head += 'Connection: %s\r\n\r\n' % ('keep-alive' if keep_alive else 'close')
+                writer.write(head.encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(model_dir, port, cache_path=None, neighbor_table_path=None, als_weight=0.0):
+
+    from ALS import alsModelPath, loadALSModel
+    from model_artifacts import loadModel
+    from neighbor_table import openNeighborTable
+
+    started = time.time()
+    neighbor_table = None if neighbor_table_path is None else openNeighborTable(neighbor_table_path)
+    als_model = loadALSModel(alsModelPath(model_dir)) if os.path.exists(alsModelPath(model_dir)) else None
+    service = RecommendService(loadModel(model_dir), cache=ResultCache(disk_path=cache_path), neighbor_table=neighbor_table,
+                               als_model=als_model, als_weight=als_weight)
+    server = await service.start(port=port)
+    print("Model loaded in %.2fs, listening on http://127.0.0.1:%d" % (time.time() - started, port))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    model_dir = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    cache_path = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != '-' else None
+    neighbor_table_path = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != '-' else None
+    als_weight = float(sys.argv[5]) if len(sys.argv) > 5 else 0.0
+
+    asyncio.run(serve(model_dir, port, cache_path, neighbor_table_path, als_weight))
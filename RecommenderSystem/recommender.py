@@ -0,0 +1,234 @@
+# Code description:
+# Single entry point of the recommender system
+#   python recommender.py ingest <watch log .csv/.parquet> [--output-dir DIR]
+#   python recommender.py build [--data-dir DIR | --ingested-dir DIR] [--model-dir DIR]
+#   python recommender.py train-als [--factors 32] [--iterations 15] [--threads T] [--model-dir DIR]
+#   python recommender.py recommend <user> [--method cb|usercf|als|hybrid] [-N 5] [-K 2] [--w1 0.7] [--als-weight 0] [--neighbor-table PATH] [--label-index] [--model-dir DIR] [--json]
+#   python recommender.py batch <output .jsonl> [--methods cb,usercf,als,hybrid] [-N 5] [-K 2] [--w1 0.7] [--als-weight 0] [--neighbor-table PATH] [--label-index] [--processes P] [--model-dir DIR]
+# build compiles the Excel files (or the output of ingest) once into the binary model of model_artifacts.py; recommend and
+# batch start from that model, memory-mapped, so a single query never pays for pandas or Excel parsing.
+# --neighbor-table reads the UserCF neighbors from a table of neighbor_table.py (.npz) or out_of_core_similarity.py (directory)
+# built from the same model instead of computing the similarities.
+# --label-index makes CB search the label_index.py inverted index of the candidates instead of scoring every candidate.
+# train-als saves an ALS model next to the compiled model; the method 'als' and --als-weight > 0 (ALS takes that share of the
+# hybrid's collaborative part 1 - w1 from UserCF, --als-weight 0.3 with --w1 0.7 replaces UserCF) need it.
+# Only the standard library is imported up front: every subcommand imports what it needs when it runs.
+# Default directories: $RECOMMENDER_DATA_DIR (else the data directory of the repository), $RECOMMENDER_MODEL_DIR (else
+# the model directory next to it).
+
+import argparse
+import json
+import os
+import sys
+
+REPOSITORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+DATA_DIR = os.environ.get('RECOMMENDER_DATA_DIR', os.path.join(REPOSITORY_DIR, 'data'))
+MODEL_DIR = os.environ.get('RECOMMENDER_MODEL_DIR', os.path.join(REPOSITORY_DIR, 'model'))
+INGESTED_DIR = os.path.join(DATA_DIR, 'ingested')
+
+RECOMMEND_METHODS = ('cb', 'usercf', 'als', 'hybrid')
+# Methods of batch without --methods: every method that needs no ALS model
+BATCH_METHODS = ('cb', 'usercf', 'hybrid')
+
+
+# Stream a watch log into the sparse matrices of watch_logs_to_matrices.py
+def ingestCommand(args):
+
+    from watch_logs_to_matrices import ingestWatchLogs, readWatchLogChunks, saveIngestedMatrices
+
+    (rating_store, items_labels_matrix, labels_names) = ingestWatchLogs(readWatchLogChunks(args.log, args.chunk_size))
+    saveIngestedMatrices(args.output_dir, rating_store, items_labels_matrix, labels_names)
+    print("users: %d, programs: %d, labels: %d, ratings: %d written to %s" % (len(rating_store.users_names), len(rating_store.items_names),
+                                                                             len(labels_names), rating_store.users_to_items.nnz, args.output_dir))
+
+
+# Compile the model from the Excel files, or from the output of ingest (every watched program is then a candidate)
+def buildCommand(args):
+
+    from model_artifacts import buildModelFromExcel, buildModelFromIngested, saveModel
+
+    model = buildModelFromIngested(args.ingested_dir) if args.ingested_dir else buildModelFromExcel(args.data_dir)
+    saveModel(model, args.model_dir)
+    print("Model of %d users and %d candidates written to %s" % (len(model.users_names), len(model.candidates_names), args.model_dir))
+
+
+# Train the ALS model of the compiled model and save it next to it
+def trainALSCommand(args):
+
+    from ALS import alsModelPath, createALSModelFromStore, saveALSModel
+    from model_artifacts import loadModel
+
+    model = loadModel(args.model_dir)
+    als_model = createALSModelFromStore(model.rating_store, args.factors, iterations=args.iterations, threads=args.threads)
+    saveALSModel(als_model, alsModelPath(args.model_dir))
+    print("ALS model of %d factors written to %s" % (als_model.factors, alsModelPath(args.model_dir)))
+
+
+# ALS model for the methods asked for: --als-model, else the one saved next to the model; None when no method uses ALS
+def loadALSOption(args, methods):
+
+    if 'als' not in methods and not ('hybrid' in methods and args.als_weight > 0):
+        return None
+
+    from ALS import alsModelPath, loadALSModel
+
+    path = args.als_model or alsModelPath(args.model_dir)
+    if not os.path.exists(path):
+        sys.exit("No ALS model at %s, train one with: recommender.py train-als --model-dir %s" % (path, args.model_dir))
+    return loadALSModel(path)
+
+
+# Engine weights of the hybrid from --w1 and --als-weight
+def hybridWeightsOption(args):
+
+    from hybrid_fusion import hybridWeights
+
+    try:
+        return hybridWeights(args.w1, args.als_weight)
+    except ValueError as error:
+        sys.exit(str(error))
+
+
+# Neighbor table given with --neighbor-table, None without the option
+def loadNeighborTableOption(args):
+
+    if args.neighbor_table is None:
+        return None
+
+    from neighbor_table import openNeighborTable
+
+    return openNeighborTable(args.neighbor_table)
+
+
+# Top-N of one user from the compiled model
+def recommendCommand(args):
+
+    import numpy as np
+
+    from CB import topNToRecommendItems
+    from model_artifacts import loadModel
+
+    model = loadModel(args.model_dir)
+    if args.user not in model.rating_store.users_index:
+        sys.exit("Unknown user: %s" % args.user)
+    rows = np.array([model.rating_store.users_index[args.user]])
+
+    if args.method == 'cb' and not args.label_index:
+        # CB only needs the portraits, the Pearson matrices of the other engines are not built
+        from CB import contentBasedBatch
+        from item_filters import ItemFilters, SeenItems
+
+        item_filters = ItemFilters(len(model.candidates_names), SeenItems(model.seen_candidates.indptr, model.seen_candidates.indices))
+        (top_indices, top_scores) = contentBasedBatch(model.users_profiles[rows], model.candidates_profiles, args.N,
+                                                      item_filters=item_filters, users_rows=rows)
+    else:
+        from hybrid_fusion import createHybridRecommender
+        from label_index import LabelIndex
+
+        weights = hybridWeightsOption(args)
+        label_index = LabelIndex(model.candidates_profiles) if args.label_index else None
+        recommender = createHybridRecommender(model, K=args.K, als_model=loadALSOption(args, [args.method]),
+                                              neighbor_table=loadNeighborTableOption(args), label_index=label_index)
+        if args.method == 'hybrid':
+            (top_indices, top_scores) = recommender.recommend(rows, args.N, weights, args.strategy)
+        else:
+            (top_indices, top_scores) = recommender.recommendBy(args.method, rows, args.N)
+
+    recommend_items = topNToRecommendItems(top_indices[0], top_scores[0], model.candidates_names)
+    if args.json:
+        print(json.dumps({'user': args.user, args.method: recommend_items}, ensure_ascii=False))
+    else:
+        for (item, degree) in recommend_items:
+            print("Program name: %s, recommendation index: %f" % (item, degree))
+
+
+# Top-N of every user, written as JSON lines by batch_recommend.py
+def batchCommand(args):
+
+    from batch_recommend import runBatch
+    from model_artifacts import loadModel
+
+    methods = args.methods
+    # Checked before the model is loaded
+    hybridWeightsOption(args)
+    written = runBatch(loadModel(args.model_dir), args.output, methods, args.N, args.K, args.w1, args.processes,
+                       neighbor_table=loadNeighborTableOption(args), als_model=loadALSOption(args, methods), als_weight=args.als_weight,
+                       label_index=args.label_index)
+    print("Recommendations for %d users written to %s" % (written, args.output))
+
+
+# argparse type of -N / -K: an integer of at least 1
+def positiveInt(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %d" % value)
+    return value
+
+
+# argparse type of --methods: comma-separated names from RECOMMEND_METHODS, returned as a list
+def methodsList(text):
+    methods = [method.strip() for method in text.split(',') if method.strip()]
+    unknown = [method for method in methods if method not in RECOMMEND_METHODS]
+    if not methods or unknown:
+        raise argparse.ArgumentTypeError("expected a comma-separated subset of %s, got %s" % (', '.join(RECOMMEND_METHODS), text))
+    return methods
+
+
+def createParser():
+
+    parser = argparse.ArgumentParser(prog='recommender.py', description="Program recommender: CB, UserCF, ALS and their hybrid")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help="build the rating and 01 matrices from a watch log")
+    ingest.add_argument('log', help="watch log, .csv (optionally compressed) or .parquet")
+    ingest.add_argument('--output-dir', default=INGESTED_DIR)
+    ingest.add_argument('--chunk-size', type=int, default=1000000, help="log rows held in memory at once")
+    ingest.set_defaults(run=ingestCommand)
+
+    build = subparsers.add_parser('build', help="compile the binary model")
+    build.add_argument('--data-dir', default=DATA_DIR, help="directory of the three Excel files")
+    build.add_argument('--ingested-dir', help="output directory of ingest, used instead of the Excel files")
+    build.add_argument('--model-dir', default=MODEL_DIR)
+    build.set_defaults(run=buildCommand)
+
+    train_als = subparsers.add_parser('train-als', help="train the ALS model of a compiled model and save it next to it")
+    train_als.add_argument('--model-dir', default=MODEL_DIR)
+    train_als.add_argument('--factors', type=int, default=32, help="length of the user and program vectors")
+    train_als.add_argument('--iterations', type=int, default=15)
+    train_als.add_argument('--threads', type=int, default=None, help="size of the thread pool (default: number of cores)")
+    train_als.set_defaults(run=trainALSCommand)
+
+    recommend = subparsers.add_parser('recommend', help="recommend programs to one user")
+    recommend.add_argument('user')
+    recommend.add_argument('--method', choices=RECOMMEND_METHODS, default='hybrid')
+    recommend.set_defaults(run=recommendCommand)
+
+    batch = subparsers.add_parser('batch', help="recommend programs to every user")
+    batch.add_argument('output', help="output .jsonl file, one user per line")
+    batch.add_argument('--methods', type=methodsList, default=list(BATCH_METHODS), help="comma-separated subset of %s" % ', '.join(RECOMMEND_METHODS))
+    batch.add_argument('--processes', type=int, default=None, help="size of the process pool (default: number of cores)")
+    batch.set_defaults(run=batchCommand)
+
+    for subparser in (recommend, batch):
+        subparser.add_argument('--model-dir', default=MODEL_DIR)
+        subparser.add_argument('-N', type=positiveInt, default=5, help="number of recommended programs")
+        subparser.add_argument('-K', type=positiveInt, default=2, help="number of UserCF neighbors")
+        subparser.add_argument('--w1', type=float, default=0.7, help="CB weight of the hybrid, UserCF gets 1 - w1 - als-weight")
+        subparser.add_argument('--als-weight', type=float, default=0.0, help="ALS weight of the hybrid, at most 1 - w1 (which replaces UserCF)")
+        subparser.add_argument('--als-model', help="ALS model saved by train-als (default: the one next to the model)")
+        subparser.add_argument('--neighbor-table', help="UserCF neighbor table of the model (.npz file or out-of-core directory), "
+                                                        "built with M >= K, min_overlap 1 and no min_similarity")
+        subparser.add_argument('--label-index', action='store_true', help="CB searches an inverted label index of the candidates")
+    recommend.add_argument('--strategy', choices=('weighted', 'interleave'), default='weighted')
+    recommend.add_argument('--json', action='store_true', help="print the result as one JSON object")
+
+    return parser
+
+
+def main(argv=None):
+    args = createParser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+# Code description:
+# Cache of recommendation results in front of contentBased / userCF / the hybrid mix
+# The same user asks for the same list many times per session, and the result only changes when his ratings change or
+# when the candidate catalog changes. Results are cached per (user, method, N, options):
+# - memory tier: LRU order, bounded by a number of entries and an estimated number of bytes, entries expire after ttl seconds
+# - invalidation: invalidateUser drops one user's results (call it when his ratings change, e.g. for the rows returned by
+#   RatingStore.replaceUsersRatings), invalidateCatalog drops everything by moving to a new catalog version
+# - optional disk tier: a sqlite file that several worker processes can share; a result computed by one process is found
+#   by the others. Invalidations are written to it as versions (one for the catalog, one per invalidated user), and every
+#   entry remembers the versions it was computed under: get reads the two current versions (one indexed lookup) before
+#   serving from memory, so an invalidation made by any process is seen by all the others at once.
+# - a result computed while its user or the catalog is invalidated must not be stored as fresh: getWithToken returns the
+#   versions its lookup saw, and put(token=...) (as getOrCompute does) only stores the result if they are still current.
+# Values must be JSON-serializable when the disk tier is used (e.g. [[program name, recommendation index], ...]).
+
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+# Rough size of a cached value in bytes, counting nested lists / tuples / dicts and their items
+def estimateSize(value):
+
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(estimateSize(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(estimateSize(key) + estimateSize(value[key]) for key in value)
+    return size
+
+
+def cacheKey(user_name, method, N, options=None):
+    return json.dumps([str(user_name), method, N, sorted((options or {}).items())], ensure_ascii=False)
+
+
+# Parameter Description:
+# max_entries / max_bytes: memory bound of the memory tier (max_bytes None: only max_entries)
+# ttl: seconds a result stays valid, None for no expiry
+# disk_path: optional sqlite file of the shared disk tier
+# clock: time source in seconds (wall time, shared with the other processes of the disk tier)
+class ResultCache:
+
+    def __init__(self, max_entries=100000, max_bytes=None, ttl=300.0, disk_path=None, clock=time.time):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # key -> (value, expiry time, size, user name, user version), oldest use first
+        self.entries = OrderedDict()
+        self.users_keys = {}
+        self.bytes = 0
+        self.catalog_version = 0
+        # user name -> number of invalidations, when there is no disk tier to hold the versions
+        self.users_versions = {}
+        self.counts = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0, 'stale_puts': 0}
+
+        self.disk = None
+        if disk_path is not None:
+            self.disk = sqlite3.connect(disk_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.disk.execute('PRAGMA journal_mode=WAL')
+            # Files written before results had a user version only hold cached values, they are started afresh
+            columns = [row[1] for row in self.disk.execute('PRAGMA table_info(results)')]
+            if columns and 'user_version' not in columns:
+                self.disk.execute('DROP TABLE results')
+            self.disk.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, user TEXT, value TEXT, expires REAL, '
+                              'catalog_version INTEGER, user_version INTEGER)')
+            self.disk.execute('CREATE INDEX IF NOT EXISTS results_user ON results (user)')
+            self.disk.execute('CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER)')
+            self.disk.execute("INSERT OR IGNORE INTO versions VALUES ('catalog', 0)")
+            self.disk.execute('CREATE TABLE IF NOT EXISTS user_versions (user TEXT PRIMARY KEY, version INTEGER)')
+            self.catalog_version = self.diskCatalogVersion()
+
+    def diskCatalogVersion(self):
+        return self.disk.execute("SELECT version FROM versions WHERE name = 'catalog'").fetchone()[0]
+
+    # Current (catalog version, user version) of the disk tier, 0 for a user that was never invalidated
+    def diskVersions(self, user_name):
+        return self.disk.execute("SELECT (SELECT version FROM versions WHERE name = 'catalog'), "
+                                 "(SELECT version FROM user_versions WHERE user = ?)", (str(user_name),)).fetchone()
+
+    # Versions a result of user_name is valid for; drops the memory tier when another process has changed the catalog (the lock is held)
+    def currentUserVersion(self, user_name):
+
+        if self.disk is None:
+            return self.users_versions.get(user_name, 0)
+        (catalog_version, user_version) = self.diskVersions(user_name)
+        if catalog_version != self.catalog_version:
+            self.counts['invalidations'] += len(self.entries)
+            self.clearMemory()
+            self.catalog_version = catalog_version
+        return user_version or 0
+
+    # Empty the memory tier (the lock is held)
+    def clearMemory(self):
+        self.entries.clear()
+        self.users_keys.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Remove one entry of the memory tier (the lock is held)
+    def discard(self, key):
+        (value, expires, size, user_name, user_version) = self.entries.pop(key)
+        self.bytes -= size
+        keys = self.users_keys.get(user_name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.users_keys[user_name]
+
+    # Cached value of (user, method, N, options), or None
+    def get(self, user_name, method, N, options=None):
+        return self.getWithToken(user_name, method, N, options)[0]
+
+    # (cached value or None, token): the token holds the versions the lookup saw, pass it to put with the value computed on a miss
+    def getWithToken(self, user_name, method, N, options=None):
+
+        key = cacheKey(user_name, method, N, options)
+        now = self.clock()
+        with self.lock:
+            user_version = self.currentUserVersion(user_name)
+            token = (self.catalog_version, user_version)
+            if key in self.entries:
+                (value, expires, size, name, entry_user_version) = self.entries[key]
+                if entry_user_version != user_version:
+                    # The user was invalidated by another process of the disk tier
+                    self.discard(key)
+                    self.counts['invalidations'] += 1
+                elif expires is None or expires > now:
+                    self.entries.move_to_end(key)
+                    self.counts['hits'] += 1
+                    return (value, token)
+                else:
+                    self.discard(key)
+                    self.counts['expirations'] += 1
+
+            if self.disk is not None:
+                row = self.disk.execute('SELECT value, expires FROM results WHERE key = ? AND catalog_version = ? AND user_version = ?',
+                                        (key, self.catalog_version, user_version)).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    value = json.loads(row[0])
+                    self.store(key, user_name, value, row[1], user_version)
+                    self.counts['disk_hits'] += 1
+                    return (value, token)
+
+            self.counts['misses'] += 1
+            return (None, token)
+
+    # Put an entry into the memory tier and evict the least recently used ones beyond the bounds (the lock is held)
+    def store(self, key, user_name, value, expires, user_version):
+
+        if key in self.entries:
+            self.discard(key)
+        size = estimateSize(value)
+        self.entries[key] = (value, expires, size, user_name, user_version)
+        self.users_keys.setdefault(user_name, set()).add(key)
+        self.bytes += size
+
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self.entries) > 1):
+            self.discard(next(iter(self.entries)))
+            self.counts['evictions'] += 1
+
+    # Store a result; with the token of the getWithToken that missed, nothing is stored if the user or the catalog has been
+    # invalidated since (the result may come from the old ratings). Returns whether the result was stored.
+    def put(self, user_name, method, N, value, options=None, token=None):
+
+        key = cacheKey(user_name, method, N, options)
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self.lock:
+            user_version = self.currentUserVersion(user_name)
+            if token is not None and token != (self.catalog_version, user_version):
+                self.counts['stale_puts'] += 1
+                return False
+            self.store(key, user_name, value, expires, user_version)
+            if self.disk is not None:
+                self.disk.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                                  (key, str(user_name), json.dumps(value, ensure_ascii=False), expires, self.catalog_version, user_version))
+            return True
+
+    # Cached value, or compute() stored (unless invalidated meanwhile) and returned on a miss
+    def getOrCompute(self, user_name, method, N, compute, options=None):
+
+        (value, token) = self.getWithToken(user_name, method, N, options)
+        if value is None:
+            value = compute()
+            self.put(user_name, method, N, value, options, token)
+        return value
+
+    # Drop the results of users whose ratings have changed
+    def invalidateUser(self, user_name):
+        self.invalidateUsers([user_name])
+
+    def invalidateUsers(self, users_names):
+
+        with self.lock:
+            if self.disk is not None:
+                self.disk.execute('BEGIN IMMEDIATE')
+            for user_name in users_names:
+                for key in list(self.users_keys.get(user_name, ())):
+                    self.discard(key)
+                    self.counts['invalidations'] += 1
+                if self.disk is None:
+                    self.users_versions[user_name] = self.users_versions.get(user_name, 0) + 1
+                else:
+                    # The new user version makes the other processes drop the entries of their memory tiers
+                    self.disk.execute('INSERT INTO user_versions VALUES (?, 1) ON CONFLICT (user) DO UPDATE SET version = version + 1',
+                                      (str(user_name),))
+                    self.disk.execute('DELETE FROM results WHERE user = ?', (str(user_name),))
+            if self.disk is not None:
+                self.disk.execute('COMMIT')
+
+    # Drop every result, e.g. after the candidate set or the business filters have changed
+    def invalidateCatalog(self):
+
+        with self.lock:
+            self.counts['invalidations'] += len(self.entries)
+            self.clearMemory()
+            if self.disk is not None:
+                self.disk.execute('BEGIN IMMEDIATE')
+                self.disk.execute("UPDATE versions SET version = version + 1 WHERE name = 'catalog'")
+                self.catalog_version = self.diskCatalogVersion()
+                self.disk.execute('DELETE FROM results WHERE catalog_version < ?', (self.catalog_version,))
+                self.disk.execute('COMMIT')
+            else:
+                self.catalog_version += 1
+
+    # Pick up a catalog invalidation made by another process of the disk tier (get and put do it on their own)
+    def syncCatalogVersion(self):
+
+        if self.disk is None:
+            return
+        with self.lock:
+            version = self.diskCatalogVersion()
+            if version != self.catalog_version:
+                self.clearMemory()
+                self.catalog_version = version
+
+    # Remove expired entries from both tiers (they are otherwise only dropped when they are looked up or evicted)
+    def purgeExpired(self):
+
+        now = self.clock()
+        with self.lock:
+            for key in [key for key in self.entries if self.entries[key][1] is not None and self.entries[key][1] <= now]:
+                self.discard(key)
+                self.counts['expirations'] += 1
+            if self.disk is not None:
+                self.disk.execute('DELETE FROM results WHERE expires IS NOT NULL AND expires <= ?', (now,))
+
+    # Hit / miss statistics and the current size of the memory tier
+    def stats(self):
+
+        with self.lock:
+            stats = dict(self.counts, entries=len(self.entries), bytes=self.bytes, catalog_version=self.catalog_version)
+        requests = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / requests if requests > 0 else 0.0
+        return stats
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
@@ -0,0 +1,77 @@
+# Code description:
+# Vectorized user-user similarity for the user-based collaborative filtering algorithm
+# Computes the same modified cosine similarity as UserCF.calCosDistByPearson for a whole block of users at once:
+# sim(user1, user2) = sigma_xy / sqrt(sigma_x * sigma_y)
+# where x / y are the implicit scores minus the user's average over ALL programs they have watched,
+# and the three sums only run over programs that user1 and user2 have watched together.
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+
+
+# Prepare the sparse matrices used by calPearsonSimilarityBlock
+# Parameter Description:
+# users_to_items: users x items rating matrix (scipy sparse, e.g. RatingStore.users_to_items, or dense)
+# Returns (centered, centered_square, watched), all CSR users x items with the same structure:
+# centered: score - user average score, centered_square: its square, watched: 1 for every watched program
+@instrumentation.timed('usercf.createPearsonMatrices')
+def createPearsonMatrices(users_to_items):
+
+    ratings = sparse.csr_matrix(users_to_items, dtype=np.float64, copy=True)
+    # Only a positive implicit score means the user has actually watched the program
+    ratings.data[ratings.data <= 0] = 0.0
+    ratings.eliminate_zeros()
+    ratings.sort_indices()
+
+    counts = np.diff(ratings.indptr)
+    rows = np.repeat(np.arange(ratings.shape[0]), counts)
+    sums = np.bincount(rows, weights=ratings.data, minlength=ratings.shape[0])
+    users_average_scores = np.divide(sums, counts, out=np.zeros(ratings.shape[0]), where=counts > 0)
+
+    # Built from the data arrays so that a score equal to the average keeps its (explicit zero) entry
+    centered = sparse.csr_matrix((ratings.data - users_average_scores[rows], ratings.indices, ratings.indptr), shape=ratings.shape)
+    centered_square = sparse.csr_matrix((centered.data * centered.data, ratings.indices, ratings.indptr), shape=ratings.shape)
+    watched = sparse.csr_matrix((np.ones_like(ratings.data), ratings.indices, ratings.indptr), shape=ratings.shape)
+
+    return (centered, centered_square, watched)
+
+
+# Similarity between a block of users and a block of (by default all) users
+# Parameter Description:
+# pearson_matrices: result of createPearsonMatrices
+# rows: row positions of the first block of users
+# columns: row positions of the second block of users, None means all users
+# Returns (similarities, overlaps), both dense len(rows) x len(columns):
+# similarities[a][b] = sim(rows[a], columns[b]), 0 if the denominator is 0 (in particular if nothing was watched together)
+# overlaps[a][b] = number of programs rows[a] and columns[b] have watched together
+@instrumentation.timed('usercf.similarityBlock')
+def calPearsonSimilarityBlock(pearson_matrices, rows, columns=None):
+
+    (centered, centered_square, watched) = pearson_matrices
+
+    rows_centered = centered[rows]
+    rows_square = centered_square[rows]
+    rows_watched = watched[rows]
+
+    if columns is None:
+        columns_centered = centered
+        columns_square = centered_square
+        columns_watched = watched
+    else:
+        columns_centered = centered[columns]
+        columns_square = centered_square[columns]
+        columns_watched = watched[columns]
+
+    # The watched (co-occurrence) masks restrict each sum to programs both users have watched
+    sigma_xy = (rows_centered @ columns_centered.T).toarray()
+    sigma_x = (rows_square @ columns_watched.T).toarray()
+    sigma_y = (rows_watched @ columns_square.T).toarray()
+    overlaps = (rows_watched @ columns_watched.T).toarray()
+
+    # If the denominator is 0, the similarity is 0
+    similarities = np.divide(sigma_xy, np.sqrt(sigma_x * sigma_y), out=np.zeros_like(sigma_xy),
+                             where=(sigma_x != 0.0) & (sigma_y != 0.0))
+
+    return (similarities, overlaps.astype(np.int64))
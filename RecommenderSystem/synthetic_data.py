@@ -0,0 +1,94 @@
+# Code description:
+# Seeded synthetic data in the shape of the real data
+# Generates users, programs and labels with a configurable size, rating density and popularity skew
+# (program j is picked with probability proportional to 1 / (j + 1) ** popularity_skew, like the long tail of real viewing),
+# and returns them as the structures the recommenders take: RatingStore, 01 label matrices, the DataFrame layout of
+# "Rating matrix of all users for the programs they have watched.xlsx", or the three Excel files themselves.
+# The same parameters and seed always give the same data.
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from rating_store import createRatingStoreFromArrays
+
+
+# Parameter Description:
+# users_num, items_num, labels_num: sizes
+# density: expected share of programs a user has watched (ratings = users_num * items_num * density)
+# popularity_skew: 0 for uniform program popularity, larger for a longer tail
+# labels_per_item: average number of labels of a program (at least 1)
+# candidates_num: size of the alternative recommended program set; half are watched programs, half are new ones
+# Returns {'rating_store', 'items_labels' (CSR, rows in rating_store column order), 'labels_names',
+#          'candidates_names', 'candidates_labels' (CSR)}
+def generateSyntheticData(users_num, items_num, labels_num, density=0.01, popularity_skew=1.0, labels_per_item=3, candidates_num=None, seed=0):
+
+    rng = np.random.default_rng(seed)
+    candidates_num = max(1, items_num // 2) if candidates_num is None else candidates_num
+
+    # Ratings: every user gets a binomial number of distinct programs drawn with the popularity weights
+    popularity = 1.0 / np.arange(1, items_num + 1) ** popularity_skew
+    popularity /= popularity.sum()
+    counts = np.minimum(rng.binomial(items_num, density, size=users_num), items_num)
+    rows = np.repeat(np.arange(users_num), counts)
+    columns = np.concatenate([rng.choice(items_num, size=count, replace=False, p=popularity) for count in counts]) if users_num > 0 else np.zeros(0, dtype=np.int64)
+    # Implicit scores in (0, 1], like the share of a program actually watched
+    scores = np.round(rng.uniform(0.01, 1.0, size=len(rows)), 5)
+
+    users_names = ['user %d' % i for i in range(users_num)]
+    items_names = ['program %d' % j for j in range(items_num)]
+    rating_store = createRatingStoreFromArrays(rows, columns.astype(np.int64), scores, users_names, items_names)
+
+    labels_names = ['label %d' % l for l in range(labels_num)]
+    items_labels = createRandomLabels(rng, items_num, labels_num, labels_per_item)
+
+    # Candidates: watched programs (so that seen filtering has something to do) and programs nobody has watched yet
+    watched_num = min(items_num, candidates_num // 2)
+    watched_candidates = np.sort(rng.choice(items_num, size=watched_num, replace=False))
+    new_num = candidates_num - watched_num
+    candidates_names = [items_names[j] for j in watched_candidates] + ['new program %d' % j for j in range(new_num)]
+    candidates_labels = sparse.vstack([items_labels[watched_candidates], createRandomLabels(rng, new_num, labels_num, labels_per_item)]).tocsr()
+
+    return {'rating_store': rating_store, 'items_labels': items_labels, 'labels_names': labels_names,
+            'candidates_names': candidates_names, 'candidates_labels': candidates_labels}
+
+
+# 01 matrix with 1 + Poisson(labels_per_item - 1) distinct labels per program
+def createRandomLabels(rng, items_num, labels_num, labels_per_item):
+
+    counts = np.minimum(1 + rng.poisson(max(labels_per_item - 1, 0), size=items_num), labels_num)
+    rows = np.repeat(np.arange(items_num), counts)
+    columns = np.concatenate([rng.choice(labels_num, size=count, replace=False) for count in counts]) if items_num > 0 else np.zeros(0, dtype=np.int64)
+
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(items_num, labels_num))
+
+
+# The data in the DataFrame layouts of the Excel files (dense, only for sizes the per-user scripts can handle)
+# Returns (ratings_df, items_labels_df, candidates_labels_df):
+# ratings_df: first column the user names, then one column per program (createUsersDict / createItemsDict / createRatingStoreFromDataFrame)
+# items_labels_df, candidates_labels_df: first column the program names, then one column per label
+def toDataFrames(data):
+
+    store = data['rating_store']
+    ratings_df = pd.DataFrame(store.users_to_items.toarray(), columns=store.items_names)
+    ratings_df.insert(0, 'User name', store.users_names)
+    items_labels_df = pd.DataFrame(data['items_labels'].toarray().astype(np.int64), columns=data['labels_names'])
+    items_labels_df.insert(0, 'Program name', store.items_names)
+    candidates_labels_df = pd.DataFrame(data['candidates_labels'].toarray().astype(np.int64), columns=data['labels_names'])
+    candidates_labels_df.insert(0, 'Program name', data['candidates_names'])
+
+    return (ratings_df, items_labels_df, candidates_labels_df)
+
+
+# Write the data as the three Excel files model_artifacts.buildModelFromExcel reads
+def saveSyntheticExcel(data, output_dir):
+
+    from model_artifacts import RATINGS_FILE, WATCHED_ITEMS_LABELS_FILE, CANDIDATES_LABELS_FILE
+
+    os.makedirs(output_dir, exist_ok=True)
+    (ratings_df, items_labels_df, candidates_labels_df) = toDataFrames(data)
+    ratings_df.to_excel(os.path.join(output_dir, RATINGS_FILE), index=False)
+    items_labels_df.to_excel(os.path.join(output_dir, WATCHED_ITEMS_LABELS_FILE), index=False)
+    candidates_labels_df.to_excel(os.path.join(output_dir, CANDIDATES_LABELS_FILE), index=False)
@@ -0,0 +1,167 @@
+# Code description:
+# Streaming ingestion of watch logs
+# Reads large CSV / Parquet watch logs with one row per viewing (user, program, implicit rating, labels) in bounded-size chunks and builds,
+# in one pass, the rating matrix "all users x programs they have watched" (as a RatingStore), the 01 matrix
+# "programs watched by users x their types" and the name -> ID dictionaries of users, programs and labels.
+# Only the current chunk and the aggregated sparse results are held in memory, never the whole log.
+# Usage: python watch_logs_to_matrices.py <watch log .csv/.parquet> <output directory>
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from label_vocabulary import LabelVocabulary
+from rating_store import RatingStore
+
+# Standard column names used inside the ingestion, the log's own column names are mapped onto them
+WATCH_LOG_COLUMNS = ['user', 'program', 'rating', 'labels']
+
+
+# Read a CSV or Parquet watch log chunk by chunk
+# Parameter Description:
+# path: .csv (optionally compressed) or .parquet file
+# chunk_size: number of log rows per chunk
+# columns: optional {standard column name: column name in the log}, e.g. {'program': 'Name of programme', 'labels': 'type'}
+# Yields DataFrames with the columns WATCH_LOG_COLUMNS
+def readWatchLogChunks(path, chunk_size=1000000, columns=None):
+
+    columns = dict(zip(WATCH_LOG_COLUMNS, WATCH_LOG_COLUMNS)) if columns is None else dict(zip(WATCH_LOG_COLUMNS, WATCH_LOG_COLUMNS), **columns)
+    renames = {columns[name]: name for name in WATCH_LOG_COLUMNS}
+    source_columns = [columns[name] for name in WATCH_LOG_COLUMNS]
+
+    if path.endswith('.parquet'):
+        # pyarrow is only needed for Parquet logs
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=source_columns):
+            yield batch.to_pandas().rename(columns=renames)
+    else:
+        dtypes = {columns['user']: str, columns['program']: str, columns['labels']: str}
+        for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=source_columns, dtype=dtypes):
+            yield chunk.rename(columns=renames)
+
+
+# Read the per-user files "User X ratings of the programs he has watched in the past three months.xls" as watch log chunks
+# Parameter Description:
+# users_files = {user name: path of that user's .xls file}
+def readUsersRatingFiles(users_files):
+
+    for user_name in users_files:
+        df = pd.read_excel(users_files[user_name])
+        yield pd.DataFrame({'user': user_name, 'program': df['Name of programme'].astype(str),
+                            'rating': df['implicit score'], 'labels': df['type'].astype(str)})
+
+
+# Map a column of names to integer IDs, adding unknown names to names_index / names in order of appearance
+# Only the distinct values of the column go through Python, the mapping itself is vectorized
+def internColumn(values, names_index, names):
+
+    for name in pd.unique(values):
+        if name not in names_index:
+            names_index[name] = len(names)
+            names.append(name)
+
+    return values.map(names_index).to_numpy(dtype=np.int64)
+
+
+# Grow a CSR matrix to a larger shape, keeping its entries; only the row pointers are extended, no entry is copied
+def resizeMatrix(matrix, shape):
+    if matrix.shape == shape:
+        return matrix
+    indptr = np.concatenate([matrix.indptr, np.full(shape[0] - matrix.shape[0], matrix.indptr[-1], dtype=matrix.indptr.dtype)])
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+# Sum of two partial rating matrices (duplicates summed), grown to the larger of their shapes
+def mergeParts(older, newer):
+    shape = (max(older.shape[0], newer.shape[0]), max(older.shape[1], newer.shape[1]))
+    return resizeMatrix(older, shape) + resizeMatrix(newer, shape)
+
+
+# Ingest watch log chunks
+# Parameter Description:
+# chunks: iterable of DataFrames with the columns WATCH_LOG_COLUMNS (readWatchLogChunks, readUsersRatingFiles)
+# labels_names: optional initial label vocabulary (fixes the order of the first columns), unknown labels are appended
+# (see label_vocabulary.LabelVocabulary, labels are lowercased and kept once)
+# Ratings of the same (user, program) pair are summed. A program keeps the labels of the first row it appears in.
+# Returns (rating_store, items_labels_matrix, labels_names):
+# items_labels_matrix: CSR 01 matrix, rows in the column order of rating_store, one column per label in labels_names
+def ingestWatchLogs(chunks, labels_names=None):
+
+    users_names = []
+    items_names = []
+    users_index = {}
+    items_index = {}
+    vocabulary = LabelVocabulary([] if labels_names is None else labels_names)
+
+    # Partial rating matrices, oldest first, each at most about half the size of the one before it
+    parts = []
+    # Label (row, column) pairs of programs seen so far, one array pair per chunk
+    labels_rows = []
+    labels_columns = []
+
+    for chunk in chunks:
+
+        chunk = chunk.dropna(subset=['user', 'program'])
+        rating = pd.to_numeric(chunk['rating'], errors='coerce').fillna(0.0).to_numpy(dtype=np.float64)
+        known_items_num = len(items_names)
+
+        rows = internColumn(chunk['user'].astype(str), users_index, users_names)
+        columns = internColumn(chunk['program'].astype(str), items_index, items_names)
+
+        # Only a positive implicit score means the user has actually watched the program
+        watched = rating > 0
+        shape = (len(users_names), len(items_names))
+        parts.append(sparse.coo_matrix((rating[watched], (rows[watched], columns[watched])), shape=shape).tocsr())
+        # Merge like a binary counter: a part is only merged into an older one that is at most twice its size, so every
+        # rating is merged O(log chunks) times instead of once per chunk
+        while len(parts) > 1 and parts[-2].nnz <= 2 * parts[-1].nnz:
+            parts[-2:] = [mergeParts(parts[-2], parts[-1])]
+
+        # Labels of the programs that appear for the first time in this chunk
+        first = (columns >= known_items_num) & ~pd.Series(columns).duplicated().to_numpy()
+        if first.any():
+            encoded = vocabulary.encode(chunk['labels'].to_numpy()[first]).tocoo()
+            labels_rows.append(columns[first][encoded.row])
+            labels_columns.append(encoded.col.astype(np.int64))
+
+    ratings = sparse.csr_matrix((len(users_names), len(items_names)), dtype=np.float64)
+    for part in parts:
+        ratings = mergeParts(ratings, part)
+    rating_store = RatingStore(users_names, items_names, ratings)
+
+    if labels_rows:
+        labels_rows = np.concatenate(labels_rows)
+        labels_columns = np.concatenate(labels_columns)
+    else:
+        labels_rows = np.zeros(0, dtype=np.int64)
+        labels_columns = np.zeros(0, dtype=np.int64)
+    items_labels_matrix = sparse.coo_matrix((np.ones(len(labels_rows)), (labels_rows, labels_columns)),
+                                            shape=(len(items_names), len(vocabulary))).tocsr()
+
+    return (rating_store, items_labels_matrix, vocabulary.labels_names)
+
+
+# Write the ingestion results: two sparse .npz matrices and the ID dictionaries as JSON
+def saveIngestedMatrices(output_dir, rating_store, items_labels_matrix, labels_names):
+
+    os.makedirs(output_dir, exist_ok=True)
+    sparse.save_npz(os.path.join(output_dir, 'ratings.npz'), rating_store.users_to_items)
+    sparse.save_npz(os.path.join(output_dir, 'items_labels.npz'), items_labels_matrix)
+    with open(os.path.join(output_dir, 'ids.json'), 'w', encoding='utf-8') as f:
+        json.dump({'users': rating_store.users_names, 'items': rating_store.items_names, 'labels': labels_names}, f, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+
+    (log_path, output_dir) = sys.argv[1:3]
+
+    (rating_store, items_labels_matrix, labels_names) = ingestWatchLogs(readWatchLogChunks(log_path))
+    saveIngestedMatrices(output_dir, rating_store, items_labels_matrix, labels_names)
+
+    print("users: %d, programs: %d, labels: %d, ratings: %d" % (len(rating_store.users_names), len(rating_store.items_names),
+                                                              len(labels_names), rating_store.users_to_items.nnz))